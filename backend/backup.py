@@ -0,0 +1,90 @@
+"""NDJSON backups of one user's data.
+
+An export is one JSON object per line: a header, the settings, every
+affirmation in list order, then every progress day, newest first:
+
+    {"type": "header", "format": "manifest-backup", "version": 1, "images": "reference"}
+    {"type": "settings", "data": {"morning_time": "08:00", ...}}
+    {"type": "affirmation", "data": {"id": "...", "text": "...", "image": "/api/images/<hash>", ...}}
+    {"type": "progress", "data": {"date": "2024-01-01", "completed_affirmations": ["..."], ...}}
+
+Images are either referenced by their /api/images URL, which only resolves
+on a server that already holds them, or inlined as data URLs. Progress
+days name affirmations by their exported ids; an import maps those to the
+ids the affirmations get on the way in.
+
+Both directions stream: an export is written while the storage cursors
+are read, and an import is parsed line by line as the body arrives (see
+read_lines), so neither holds more than a batch in memory.
+"""
+import zlib
+from typing import AsyncIterator
+
+import orjson
+
+BACKUP_FORMAT = "manifest-backup"
+BACKUP_VERSION = 1
+BACKUP_MEDIA_TYPE = "application/x-ndjson"
+GZIP_MEDIA_TYPE = "application/gzip"
+
+# Records are written to storage this many at a time
+IMPORT_BATCH_SIZE = 500
+
+# One line holds at most one inlined image
+MAX_LINE_BYTES = 16 * 1024 * 1024
+
+# Decompressed bytes produced per step, so a small gzip body can't expand
+# into memory all at once
+INFLATE_CHUNK_BYTES = 256 * 1024
+
+
+def backup_record(record_type: str, data: dict) -> bytes:
+    return orjson.dumps({"type": record_type, "data": data}) + b"\n"
+
+
+def backup_header(images: str) -> bytes:
+    return orjson.dumps({"type": "header", "format": BACKUP_FORMAT, "version": BACKUP_VERSION, "images": images}) + b"\n"
+
+
+def check_header(record: dict) -> None:
+    if record.get("format") != BACKUP_FORMAT:
+        raise ValueError(f"not a {BACKUP_FORMAT} file")
+    if record.get("version") != BACKUP_VERSION:
+        raise ValueError(f"unsupported version {record.get('version')}")
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def read_lines(chunks: AsyncIterator[bytes], gzipped: bool = False) -> AsyncIterator[bytes]:
+    """Non-blank lines of an NDJSON body, inflating it first if `gzipped`.
+
+    The next chunk is only pulled once every line of the previous one has
+    been consumed, so a slow consumer slows the upload down.
+    """
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    buffer = b""
+    async for chunk in chunks:
+        pending = chunk
+        while pending:
+            if inflater is not None:
+                data = inflater.decompress(pending, INFLATE_CHUNK_BYTES)
+                pending = inflater.unconsumed_tail
+            else:
+                data, pending = pending, b""
+            *lines, buffer = (buffer + data).split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+            if len(buffer) > MAX_LINE_BYTES:
+                raise ValueError(f"line longer than {MAX_LINE_BYTES} bytes")
+    if inflater is not None and not inflater.eof:
+        raise ValueError("truncated gzip stream")
+    if buffer.strip():
+        yield buffer
@@ -0,0 +1,299 @@
+import asyncio
+import itertools
+import logging
+import secrets
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Generic, Optional, Tuple, TypeVar
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+Cache = TypeVar("Cache", "CountCache", "DocumentCache")
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+class MongoCounter:
+    """A counter document shared by every worker: {_id: key, value: n}."""
+
+    def __init__(self, collection: AsyncIOMotorCollection, key: str):
+        self.collection = collection
+        self.key = key
+
+    async def read(self) -> Optional[int]:
+        document = await self.collection.find_one({"_id": self.key})
+        return document["value"] if document else None
+
+    async def seed(self, value: int) -> int:
+        # Only the first worker to seed wins; everyone else adopts its value
+        document = await self.collection.find_one_and_update(
+            {"_id": self.key},
+            {"$setOnInsert": {"value": value}},
+            upsert=True,
+            return_document=True,
+        )
+        return document["value"]
+
+    async def add(self, delta: int) -> None:
+        # No upsert: an unseeded counter is seeded from a real count on next read
+        await self.collection.update_one({"_id": self.key}, {"$inc": {"value": delta}})
+
+    async def set(self, value: int) -> None:
+        await self.collection.update_one({"_id": self.key}, {"$set": {"value": value}}, upsert=True)
+
+
+class ResourceVersions:
+    """Version tags for (key, resource) pairs, changed by every write.
+
+    Locally each tag combines a random per-process epoch with a process-wide
+    counter, so a tag is never reissued: not after a restart, nor after an
+    evicted entry comes back. That makes them safe to embed in ETags. With a
+    `shared` collection every worker reads and bumps the same counter
+    documents instead, at the cost of one primary-key lookup per check.
+    """
+
+    def __init__(self, shared: Optional[AsyncIOMotorCollection] = None, max_entries: int = 100000):
+        self.shared = shared
+        self.max_entries = max_entries
+        self.epoch = secrets.token_hex(4)
+        self._counter = itertools.count(1)
+        self._versions: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+
+    def _assign(self, entry: Tuple[str, str]) -> int:
+        version = self._versions[entry] = next(self._counter)
+        self._versions.move_to_end(entry)
+        if len(self._versions) > self.max_entries:
+            self._versions.popitem(last=False)
+        return version
+
+    async def get(self, key: str, resource: str) -> str:
+        if self.shared:
+            document = await self.shared.find_one({"_id": f"version:{key}:{resource}"})
+            return f"s{document['value'] if document else 0}"
+        version = self._versions.get((key, resource))
+        if version is None:
+            version = self._assign((key, resource))
+        return f"{self.epoch}.{version}"
+
+    async def bump(self, key: str, resource: str) -> None:
+        if self.shared:
+            await self.shared.update_one({"_id": f"version:{key}:{resource}"}, {"$inc": {"value": 1}}, upsert=True)
+        else:
+            self._assign((key, resource))
+
+
+class CountCache:
+    """Caches a collection count in process.
+
+    Endpoints that change the count call adjust() so the cache is written
+    through. After `ttl` seconds the value is refreshed in the background
+    while the stale value keeps being served, so readers only wait on the
+    database for the very first load. With a `shared` counter, the first load
+    reads that document instead of counting, and each refresh writes a fresh
+    count back to it; an increment lost between a count and the seed is
+    corrected within `ttl`, and every worker agrees again after its own.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[int]], ttl: float = 60.0, shared: Optional[MongoCounter] = None):
+        self.loader = loader
+        self.ttl = ttl
+        self.shared = shared
+        self.stats = CacheStats()
+        self._value: Optional[int] = None
+        self._loaded_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def _load(self) -> int:
+        self.stats.refreshes += 1
+        value = await self.shared.read() if self.shared else None
+        if value is None:
+            value = await self.loader()
+            if self.shared:
+                value = await self.shared.seed(value)
+        self._value = value
+        self._loaded_at = time.monotonic()
+        return value
+
+    async def _recount(self) -> int:
+        self.stats.refreshes += 1
+        value = await self.loader()
+        if self.shared:
+            await self.shared.set(value)
+        self._value = value
+        self._loaded_at = time.monotonic()
+        return value
+
+    async def _background_refresh(self):
+        try:
+            await self._recount()
+        except Exception:
+            logger.exception("Count cache refresh failed; serving the stale value")
+        finally:
+            self._refresh_task = None
+
+    async def get(self) -> int:
+        if self._value is None:
+            self.stats.misses += 1
+            return await self._load()
+        self.stats.hits += 1
+        if time.monotonic() - self._loaded_at > self.ttl and self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._background_refresh())
+        return self._value
+
+    async def adjust(self, delta: int) -> None:
+        if self._value is not None:
+            self._value = max(self._value + delta, 0)
+        if self.shared:
+            await self.shared.add(delta)
+
+    def invalidate(self) -> None:
+        self._value = None
+
+    def describe(self) -> dict:
+        return {
+            **self.stats.as_dict(),
+            "value": self._value,
+            "age_seconds": round(time.monotonic() - self._loaded_at, 3) if self._value is not None else None,
+            "ttl_seconds": self.ttl,
+            "shared": self.shared is not None,
+        }
+
+
+class DocumentCache:
+    """Serves a single document from memory.
+
+    Every local write goes through set() or invalidate(), which bump a
+    version counter; a load that raced with a write is never marked fresh.
+    Other workers' writes are picked up via CacheMap.watch() (a Mongo
+    change stream) or, failing that, after `ttl` seconds.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[dict]], ttl: Optional[float] = None):
+        self.loader = loader
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self.version = 0
+        self._document: Optional[dict] = None
+        self._loaded_version = -1
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        if self._document is None or self._loaded_version != self.version:
+            return False
+        return self.ttl is None or time.monotonic() - self._loaded_at <= self.ttl
+
+    async def get(self) -> dict:
+        if self._fresh():
+            self.stats.hits += 1
+            return dict(self._document)
+        self.stats.misses += 1
+        async with self._lock:
+            # Another request may have loaded it while we waited
+            if not self._fresh():
+                version = self.version
+                document = await self.loader()
+                self.stats.refreshes += 1
+                if version == self.version:
+                    self._store(document)
+                else:
+                    return dict(document)
+            return dict(self._document)
+
+    def _store(self, document: dict) -> None:
+        self._document = dict(document)
+        self._loaded_version = self.version
+        self._loaded_at = time.monotonic()
+
+    def set(self, document: dict) -> None:
+        """Write-through after a successful update."""
+        self.version += 1
+        self._store(document)
+
+    def invalidate(self) -> None:
+        self.version += 1
+
+    def describe(self) -> dict:
+        return {
+            **self.stats.as_dict(),
+            "version": self.version,
+            "cached": self._fresh(),
+            "ttl_seconds": self.ttl,
+        }
+
+
+class CacheMap(Generic[Cache]):
+    """One cache per key (e.g. per user), created by `factory` on first use.
+
+    At most `max_entries` caches are kept; the least recently used one is
+    dropped beyond that, so memory stays bounded however many users there are.
+    """
+
+    def __init__(self, factory: Callable[[str], Cache], max_entries: int = 10000):
+        self.factory = factory
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._caches: "OrderedDict[str, Cache]" = OrderedDict()
+
+    def __getitem__(self, key: str) -> Cache:
+        cache = self._caches.get(key)
+        if cache is None:
+            cache = self._caches[key] = self.factory(key)
+            if len(self._caches) > self.max_entries:
+                self._caches.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._caches.move_to_end(key)
+        return cache
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        if key is None:
+            self._caches.clear()
+        else:
+            self._caches.pop(key, None)
+
+    async def watch(self, collection: AsyncIOMotorCollection, key_field: str) -> None:
+        """Invalidate the cache of every changed document's `key_field` until cancelled.
+
+        Change streams need a replica set; on a standalone server this logs
+        once and returns, leaving the TTL as the only cross-worker signal.
+        """
+        try:
+            async with collection.watch(full_document="updateLookup") as stream:
+                logger.info("Watching %s for changes", collection.name)
+                async for change in stream:
+                    # Deletes carry no document, so drop every cache for those
+                    self.invalidate((change.get("fullDocument") or {}).get(key_field))
+        except OperationFailure as e:
+            logger.warning("Change stream on %s unavailable (%s); relying on TTL", collection.name, e)
+
+    def describe(self) -> dict:
+        totals: Dict[str, int] = {"hits": 0, "misses": 0, "refreshes": 0}
+        for cache in self._caches.values():
+            for name in totals:
+                totals[name] += getattr(cache.stats, name)
+        lookups = totals["hits"] + totals["misses"]
+        return {
+            **totals,
+            "hit_rate": round(totals["hits"] / lookups, 4) if lookups else None,
+            "entries": len(self._caches),
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,71 @@
+"""MongoDB client settings, read from the environment.
+
+Every process creates its own client when the app starts up, after uvicorn
+or gunicorn has forked its workers, so a pool is never shared between
+processes. Unset variables keep the driver defaults.
+
+    MONGO_MAX_POOL_SIZE                connections per worker
+    MONGO_TOTAL_POOL_SIZE              connections across all workers; split over WEB_CONCURRENCY
+    MONGO_MIN_POOL_SIZE                connections kept open (and opened at startup)
+    MONGO_MAX_IDLE_TIME_MS             close connections idle for this long
+    MONGO_WAIT_QUEUE_TIMEOUT_MS        give up waiting for a free connection after this long
+    MONGO_SERVER_SELECTION_TIMEOUT_MS  fail requests (and startup) when no server answers
+    MONGO_CONNECT_TIMEOUT_MS
+    MONGO_SOCKET_TIMEOUT_MS
+    MONGO_COMPRESSORS                  e.g. "zstd,snappy,zlib"; zstd needs zstandard, snappy python-snappy
+    MONGO_READ_PREFERENCE              e.g. "primaryPreferred", "secondaryPreferred", "nearest"
+"""
+import asyncio
+import logging
+import os
+from typing import List
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+INT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+}
+STRING_OPTIONS = {
+    "MONGO_COMPRESSORS": "compressors",
+    "MONGO_READ_PREFERENCE": "readPreference",
+}
+
+
+def worker_count() -> int:
+    # The variable gunicorn and uvicorn both read for their default --workers
+    return max(int(os.environ.get("WEB_CONCURRENCY", "1")), 1)
+
+
+def client_options() -> dict:
+    options = {option: int(os.environ[name]) for name, option in INT_OPTIONS.items() if os.environ.get(name)}
+    options.update({option: os.environ[name] for name, option in STRING_OPTIONS.items() if os.environ.get(name)})
+    total = os.environ.get("MONGO_TOTAL_POOL_SIZE")
+    if total:
+        options["maxPoolSize"] = max(int(total) // worker_count(), 1)
+    if "maxPoolSize" in options and options.get("minPoolSize", 0) > options["maxPoolSize"]:
+        options["minPoolSize"] = options["maxPoolSize"]
+    return options
+
+
+def create_client(url: str, event_listeners: List[monitoring.CommandListener]) -> AsyncIOMotorClient:
+    options = client_options()
+    logger.info("Connecting to MongoDB with %s", options or "driver defaults")
+    return AsyncIOMotorClient(url, event_listeners=event_listeners, **options)
+
+
+async def warm_up(db: AsyncIOMotorDatabase, connections: int) -> None:
+    """Fail fast on an unreachable server, then open `connections` pooled
+    connections so the first requests don't pay for the handshakes."""
+    await db.command("ping")
+    if connections > 1:
+        # Concurrent commands each check out their own connection
+        await asyncio.gather(*(db.command("ping") for _ in range(connections)))
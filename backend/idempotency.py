@@ -0,0 +1,284 @@
+"""Idempotency-Key support for the API's writes.
+
+A client that retries a POST, PUT or DELETE with the same Idempotency-Key
+header gets the first attempt's response again, marked with
+Idempotent-Replayed: true, instead of the write running twice. Keys are
+scoped to the user (X-User-Id), method and path. A retry that arrives
+while the first attempt is still running waits for its response rather
+than doing the work alongside it.
+
+Only complete responses below 500 are remembered, so a retry after a
+server error runs again. Reusing a key for a different request body is a
+client bug and gets 422.
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import orjson
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import DuplicateKeyError
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+MUTATING_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+MAX_KEY_LENGTH = 255
+
+# Larger responses are sent but not remembered
+MAX_STORED_BYTES = 1024 * 1024
+
+# How often a worker waiting on another worker's first attempt looks for its response
+POLL_INTERVAL = 0.05
+
+
+class StoredResponse(NamedTuple):
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+    # sha256 of the request body that produced it
+    fingerprint: str
+
+
+class IdempotencyConflict(Exception):
+    """The first attempt with this key is still running in another worker."""
+
+
+class IdempotencyKeys:
+    """First responses by key, kept `ttl` seconds.
+
+    Locally an LRU of at most `max_entries` responses, and concurrent
+    duplicates in this process wait on the first one's future. With a
+    `shared` collection (TTL-indexed on expires_at) the first attempt also
+    inserts a "running" document, so a duplicate arriving at another
+    worker polls for the response instead of running; it gives up with
+    IdempotencyConflict after `wait` seconds. A worker that dies mid-request
+    leaves its document to expire after `running_ttl` seconds.
+    """
+
+    def __init__(self, ttl: float = 86400.0, max_entries: int = 10000,
+                 shared: Optional[AsyncIOMotorCollection] = None, wait: float = 10.0, running_ttl: float = 60.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self.wait = wait
+        self.running_ttl = running_ttl
+        self.replayed = 0
+        self.coalesced = 0
+        self._responses: "OrderedDict[str, Tuple[float, StoredResponse]]" = OrderedDict()
+        self._running: Dict[str, asyncio.Future] = {}
+
+    def _lookup(self, key: str) -> Optional[StoredResponse]:
+        entry = self._responses.get(key)
+        if entry is None:
+            return None
+        expires, response = entry
+        if expires <= time.monotonic():
+            del self._responses[key]
+            return None
+        self._responses.move_to_end(key)
+        return response
+
+    def _remember(self, key: str, response: StoredResponse) -> None:
+        self._responses[key] = (time.monotonic() + self.ttl, response)
+        self._responses.move_to_end(key)
+        if len(self._responses) > self.max_entries:
+            self._responses.popitem(last=False)
+
+    async def _claim_shared(self, key: str) -> Optional[StoredResponse]:
+        """None once this worker owns `key`; the stored response if another worker finished it first."""
+        deadline = time.monotonic() + self.wait
+        while True:
+            expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.running_ttl)
+            try:
+                await self.shared.insert_one({"_id": key, "state": "running", "expires_at": expires_at})
+                return None
+            except DuplicateKeyError:
+                pass
+            document = await self.shared.find_one({"_id": key})
+            if document is not None and document["state"] == "done":
+                return StoredResponse(
+                    document["status"],
+                    [(name.encode("latin-1"), value.encode("latin-1")) for name, value in document["headers"]],
+                    document["body"],
+                    document["fingerprint"],
+                )
+            if time.monotonic() >= deadline:
+                raise IdempotencyConflict(key)
+            # A missing document expired with its worker; the next insert takes it over
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def _save_shared(self, key: str, response: StoredResponse) -> None:
+        await self.shared.update_one({"_id": key}, {"$set": {
+            "state": "done",
+            "status": response.status,
+            "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in response.headers],
+            "body": response.body,
+            "fingerprint": response.fingerprint,
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl),
+        }})
+
+    async def respond(self, key: str, execute: Callable[[], Awaitable[Optional[StoredResponse]]]) -> Optional[StoredResponse]:
+        """The response to replay for `key`, or None after running `execute` for it here.
+
+        `execute` sends its response itself and returns it if it should be
+        remembered. When it doesn't, a waiting duplicate runs it again.
+        """
+        while True:
+            response = self._lookup(key)
+            if response is not None:
+                self.replayed += 1
+                return response
+            running = self._running.get(key)
+            if running is None:
+                break
+            self.coalesced += 1
+            # Shielded so a client giving up doesn't cancel the first attempt's future
+            response = await asyncio.shield(running)
+            if response is not None:
+                self.replayed += 1
+                return response
+
+        future = asyncio.get_running_loop().create_future()
+        self._running[key] = future
+        response = None
+        try:
+            if self.shared is not None:
+                response = await self._claim_shared(key)
+                if response is not None:
+                    self._remember(key, response)
+                    self.replayed += 1
+                    return response
+            try:
+                response = await execute()
+            except BaseException:
+                if self.shared is not None:
+                    await self.shared.delete_one({"_id": key, "state": "running"})
+                raise
+            if response is not None:
+                self._remember(key, response)
+            if self.shared is not None:
+                if response is not None:
+                    await self._save_shared(key, response)
+                else:
+                    await self.shared.delete_one({"_id": key, "state": "running"})
+            return None
+        finally:
+            del self._running[key]
+            future.set_result(response)
+
+    def describe(self) -> dict:
+        return {
+            "entries": len(self._responses),
+            "running": len(self._running),
+            "replayed": self.replayed,
+            "coalesced": self.coalesced,
+            "shared": self.shared is not None,
+        }
+
+
+async def send_json(send: Send, status: int, body: dict, headers: Sequence[Tuple[bytes, bytes]] = ()) -> None:
+    content = orjson.dumps(body)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(content)).encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": content})
+
+
+class IdempotencyMiddleware:
+    """Runs writes carrying an Idempotency-Key through `keys`, replaying their first response."""
+
+    def __init__(self, app: ASGIApp, keys: IdempotencyKeys):
+        self.app = app
+        self.keys = keys
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] not in MUTATING_METHODS:
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        idempotency_key = headers.get("idempotency-key")
+        if idempotency_key is None:
+            await self.app(scope, receive, send)
+            return
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            await send_json(send, 400, {"detail": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"})
+            return
+
+        scoped = "\n".join([headers.get("x-user-id", ""), scope["method"], scope["path"], idempotency_key])
+        key = hashlib.sha256(scoped.encode()).hexdigest()
+        # The body is hashed as it streams past, so large imports aren't buffered
+        body_hash = hashlib.sha256()
+        body_complete = False
+
+        async def hashing_receive() -> Message:
+            nonlocal body_complete
+            message = await receive()
+            if message["type"] == "http.request":
+                body_hash.update(message.get("body", b""))
+                body_complete = not message.get("more_body", False)
+            elif message["type"] == "http.disconnect":
+                body_complete = True
+            return message
+
+        async def fingerprint() -> str:
+            # Whatever the route didn't read still counts towards the fingerprint
+            while not body_complete:
+                await hashing_receive()
+            return body_hash.hexdigest()
+
+        async def execute() -> Optional[StoredResponse]:
+            capture = ResponseCapture(send)
+            await self.app(scope, hashing_receive, capture.send)
+            return capture.response(await fingerprint())
+
+        try:
+            response = await self.keys.respond(key, execute)
+        except IdempotencyConflict:
+            await send_json(send, 409, {"detail": "A request with this Idempotency-Key is still in progress"},
+                            [(b"retry-after", b"1")])
+            return
+        if response is None:
+            return
+        if response.fingerprint != await fingerprint():
+            await send_json(send, 422, {"detail": "Idempotency-Key was already used for a different request"})
+            return
+        await send({
+            "type": "http.response.start",
+            "status": response.status,
+            "headers": [*response.headers, (b"idempotent-replayed", b"true")],
+        })
+        await send({"type": "http.response.body", "body": response.body})
+
+
+class ResponseCapture:
+    """Passes a response through to `send` while keeping a copy to replay."""
+
+    def __init__(self, send: Send):
+        self.downstream = send
+        self.status = 500
+        self.headers: List[Tuple[bytes, bytes]] = []
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.complete = False
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+            self.headers = list(message.get("headers", []))
+        elif message["type"] == "http.response.body":
+            body = message.get("body", b"")
+            self.size += len(body)
+            if self.size <= MAX_STORED_BYTES:
+                self.chunks.append(body)
+            self.complete = not message.get("more_body", False)
+        await self.downstream(message)
+
+    def response(self, fingerprint: str) -> Optional[StoredResponse]:
+        if not self.complete or self.status >= 500 or self.size > MAX_STORED_BYTES:
+            return None
+        return StoredResponse(self.status, self.headers, b"".join(self.chunks), fingerprint)
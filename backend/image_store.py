@@ -0,0 +1,295 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+from PIL import Image, ImageOps
+
+IMAGE_URL_PREFIX = "/api/images/"
+
+_DATA_URL_RE = re.compile(r"^data:(?P<content_type>[\w.+-]+/[\w.+-]+)?(?:;[\w=-]+)*;base64,(?P<data>.*)$", re.S)
+_IMAGE_URL_RE = re.compile(r"^(?:https?://[^/]+)?" + re.escape(IMAGE_URL_PREFIX) + r"(?P<hash>[0-9a-f]{64})(?:[/?].*)?$")
+
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+CHUNK_SIZE = 256 * 1024
+
+# Longest edge in pixels for each served variant. "original" is the upload
+# with metadata stripped, capped so camera-roll originals stay reasonable.
+IMAGE_VARIANTS = {
+    "thumb": 256,
+    "screen": 1080,
+    "original": 2048,
+}
+DEFAULT_LIST_VARIANT = "thumb"
+VARIANT_FORMAT = "WEBP"
+VARIANT_CONTENT_TYPE = "image/webp"
+VARIANT_QUALITY = 80
+
+
+class Blob:
+    """A stored blob: its metadata plus an async iterator over its bytes."""
+
+    def __init__(self, key: str, content_type: str, length: int, chunks: AsyncIterator[bytes]):
+        self.key = key
+        self.content_type = content_type
+        self.length = length
+        self.chunks = chunks
+
+
+class BlobStore:
+    """Interface for content-addressed binary storage.
+
+    Keys are chosen by the caller (normally a sha256 hex digest), so writing
+    the same key twice is a no-op.
+    """
+
+    async def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    async def put(self, key: str, data: bytes, content_type: str) -> None:
+        raise NotImplementedError
+
+    async def open(self, key: str) -> Optional[Blob]:
+        raise NotImplementedError
+
+    async def read(self, key: str) -> Optional[bytes]:
+        blob = await self.open(key)
+        if blob is None:
+            return None
+        return b"".join([chunk async for chunk in blob.chunks])
+
+
+class GridFSBlobStore(BlobStore):
+    def __init__(self, database: AsyncIOMotorDatabase, bucket_name: str = "images"):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name=bucket_name, chunk_size_bytes=CHUNK_SIZE)
+        self.files = database[f"{bucket_name}.files"]
+
+    async def exists(self, key: str) -> bool:
+        return await self.files.find_one({"filename": key}, projection={"_id": 1}) is not None
+
+    async def put(self, key: str, data: bytes, content_type: str) -> None:
+        if await self.exists(key):
+            return
+        await self.bucket.upload_from_stream(key, data, metadata={"content_type": content_type})
+
+    async def open(self, key: str) -> Optional[Blob]:
+        try:
+            stream = await self.bucket.open_download_stream_by_name(key)
+        except NoFile:
+            return None
+
+        async def chunks():
+            while True:
+                chunk = await stream.readchunk()
+                if not chunk:
+                    break
+                yield chunk
+
+        content_type = (stream.metadata or {}).get("content_type", "application/octet-stream")
+        return Blob(key, content_type, stream.length, chunks())
+
+
+class FileSystemBlobStore(BlobStore):
+    """Stores each blob as a file, fanned out by the first two key characters."""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    async def exists(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    async def put(self, key: str, data: bytes, content_type: str) -> None:
+        path = self._path(key)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.with_suffix(".type").write_text(content_type)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+    async def open(self, key: str) -> Optional[Blob]:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        type_path = path.with_suffix(".type")
+        content_type = type_path.read_text() if type_path.exists() else "application/octet-stream"
+
+        async def chunks():
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        return Blob(key, content_type, path.stat().st_size, chunks())
+
+
+def create_blob_store(database: Optional[AsyncIOMotorDatabase]) -> BlobStore:
+    # Without MongoDB (STORAGE_BACKEND=sqlite) images default to the filesystem
+    backend = os.environ.get("IMAGE_STORE", "gridfs" if database is not None else "filesystem")
+    if backend == "filesystem":
+        return FileSystemBlobStore(Path(os.environ.get("IMAGE_STORE_PATH", "images")))
+    if backend == "gridfs":
+        if database is None:
+            raise ValueError("IMAGE_STORE=gridfs needs STORAGE_BACKEND=mongo")
+        return GridFSBlobStore(database)
+    raise ValueError(f"Unknown IMAGE_STORE: {backend}")
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def variant_key(image_hash: str, variant: str) -> str:
+    return image_hash if variant == "original" else f"{image_hash}-{variant}"
+
+
+def image_url(image_hash: str, variant: Optional[str] = None) -> str:
+    url = f"{IMAGE_URL_PREFIX}{image_hash}"
+    return f"{url}?size={variant}" if variant else url
+
+
+def image_urls(image_hash: str) -> Dict[str, str]:
+    return {variant: image_url(image_hash, variant) for variant in IMAGE_VARIANTS}
+
+
+def is_image_hash(value: str) -> bool:
+    return bool(_HASH_RE.match(value))
+
+
+def parse_image_url(value: str) -> Optional[str]:
+    """Return the hash if `value` points at one of our own image URLs."""
+    match = _IMAGE_URL_RE.match(value)
+    return match.group("hash") if match else None
+
+
+def decode_data_url(value: str) -> tuple:
+    """Decode a `data:<type>;base64,...` string (or bare base64) into (bytes, content_type)."""
+    match = _DATA_URL_RE.match(value)
+    if match:
+        payload = match.group("data")
+        content_type = match.group("content_type") or "application/octet-stream"
+    else:
+        payload = value
+        content_type = "image/jpeg"
+    try:
+        data = base64.b64decode(payload, validate=False)
+    except (binascii.Error, ValueError):
+        raise ValueError("Image is not valid base64")
+    if not data:
+        raise ValueError("Image is empty")
+    return data, content_type
+
+
+def render_variant(data: bytes, max_size: int) -> bytes:
+    """Decode an image, drop its metadata and re-encode it no larger than max_size.
+
+    Runs in a worker process, so it only takes and returns plain bytes.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            image = ImageOps.exif_transpose(source)
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            out = io.BytesIO()
+            # No exif/icc arguments are passed, so no metadata is written
+            image.save(out, VARIANT_FORMAT, quality=VARIANT_QUALITY, method=4)
+            return out.getvalue()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise ValueError("Image could not be decoded")
+
+
+def render_variants(data: bytes) -> Dict[str, bytes]:
+    return {variant: render_variant(data, size) for variant, size in IMAGE_VARIANTS.items()}
+
+
+class ImagePipeline:
+    """Ingests uploads into a BlobStore and serves cached (hash, size) variants.
+
+    Decoding and resizing run in a process pool so large uploads never block
+    the event loop.
+    """
+
+    def __init__(self, store: Optional[BlobStore] = None, workers: Optional[int] = None):
+        # The store may be attached later, once the database client exists
+        self.store = store
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, func, *args):
+        self.start()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM on a huge upload); start fresh next time
+            self._executor = None
+            raise
+
+    async def ingest(self, value: str) -> str:
+        """Store an uploaded image and all its variants; return its content hash.
+
+        Accepts either a data URL from the picker or a URL previously returned
+        by the API (the edit screen sends the existing image back unchanged).
+        The hash is taken over the uploaded bytes, so re-uploading the same
+        picture skips decoding entirely.
+        """
+        existing = parse_image_url(value)
+        if existing:
+            if not await self.store.exists(existing):
+                raise ValueError("Referenced image does not exist")
+            return existing
+        data, _ = decode_data_url(value)
+        image_hash = content_hash(data)
+        if await self.store.exists(image_hash):
+            return image_hash
+
+        rendered = await self._run(render_variants, data)
+        # Write the original last: its presence marks the ingest as complete
+        for variant, variant_data in rendered.items():
+            if variant != "original":
+                await self.store.put(variant_key(image_hash, variant), variant_data, VARIANT_CONTENT_TYPE)
+        await self.store.put(image_hash, rendered["original"], VARIANT_CONTENT_TYPE)
+        return image_hash
+
+    async def open_variant(self, image_hash: str, variant: str) -> Optional[Blob]:
+        """Open a variant, rendering and caching it first if it is missing."""
+        key = variant_key(image_hash, variant)
+        blob = await self.store.open(key)
+        if blob is not None or variant == "original":
+            return blob
+        source = await self.store.read(image_hash)
+        if source is None:
+            return None
+        data = await self._run(render_variant, source, IMAGE_VARIANTS[variant])
+        await self.store.put(key, data, VARIANT_CONTENT_TYPE)
+        return await self.store.open(key)
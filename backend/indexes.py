@@ -0,0 +1,227 @@
+"""Index declarations and query-plan checks for the API's collections.
+
+Run directly to ensure indexes and report any query that still scans a
+whole collection:
+
+    python indexes.py            # ensure indexes
+    python indexes.py --explain  # ensure indexes, then explain every query
+"""
+import argparse
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Every per-user collection leads with user_id, so a user's queries touch
+# only their own slice of the index however many users share the database
+INDEXES = {
+    "affirmations": [
+        # Listing order, keyset pagination and "next order" lookups
+        IndexModel([("user_id", ASCENDING), ("order", ASCENDING), ("_id", ASCENDING)], name="user_order_id"),
+        IndexModel([("user_id", ASCENDING), ("is_example", ASCENDING)], name="user_is_example"),
+        # Delta sync: what changed after a sequence
+        IndexModel([("user_id", ASCENDING), ("seq", ASCENDING)], name="user_seq"),
+    ],
+    "daily_progress": [
+        # One document per user and day; also makes concurrent upserts for a new day safe
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING)], name="user_date_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("seq", ASCENDING)], name="user_seq"),
+    ],
+    "progress_rollups": [
+        IndexModel(
+            [("user_id", ASCENDING), ("granularity", ASCENDING), ("start", DESCENDING)],
+            name="user_granularity_start",
+        ),
+    ],
+    "settings": [
+        IndexModel([("user_id", ASCENDING)], name="user_unique", unique=True),
+    ],
+    "tombstones": [
+        IndexModel([("user_id", ASCENDING), ("seq", ASCENDING)], name="user_seq"),
+    ],
+    # The scheduler reads across users by fire minute
+    "reminders": [
+        IndexModel([("next_fire", ASCENDING)], name="next_fire"),
+        IndexModel([("claim", ASCENDING)], name="claim", sparse=True),
+        IndexModel([("user_id", ASCENDING)], name="user"),
+    ],
+    # A day's unfolded tail, and what the compactor has left to fold
+    "practice_events": [
+        IndexModel([("user_id", ASCENDING), ("date", ASCENDING), ("seq", ASCENDING)], name="user_date_seq"),
+        IndexModel([("compacted", ASCENDING), ("seq", ASCENDING)], name="compacted_seq"),
+    ],
+    # Keys are looked up by _id; MongoDB drops each one at its expires_at
+    "idempotency_keys": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# Single-user indexes replaced by the ones above; date_unique in particular
+# would stop two users from practicing on the same day
+OBSOLETE_INDEXES = {
+    "affirmations": ["order_id", "is_example"],
+    "daily_progress": ["date_unique"],
+    "progress_rollups": ["granularity_start"],
+}
+
+
+class RegisteredQuery(NamedTuple):
+    name: str
+    collection: str
+    filter: dict
+    sort: Optional[list] = None
+    limit: int = 0
+    count: bool = False
+
+
+# Every query shape the API issues against a non-trivial collection
+QUERIES = [
+    RegisteredQuery(
+        "list affirmations", "affirmations", {"user_id": "default"},
+        sort=[("order", ASCENDING), ("_id", ASCENDING)],
+    ),
+    RegisteredQuery(
+        "page affirmations", "affirmations", {"user_id": "default", "order": {"$gt": 0}},
+        sort=[("order", ASCENDING), ("_id", ASCENDING)], limit=50,
+    ),
+    RegisteredQuery(
+        "previous affirmation", "affirmations", {"user_id": "default", "order": {"$lt": 0}},
+        sort=[("order", DESCENDING), ("_id", DESCENDING)], limit=1,
+    ),
+    RegisteredQuery("count affirmations", "affirmations", {"user_id": "default"}, count=True),
+    RegisteredQuery("count examples", "affirmations", {"user_id": "default", "is_example": True}, count=True),
+    RegisteredQuery("progress for a day", "daily_progress", {"user_id": "default", "date": "2024-01-01"}, limit=1),
+    RegisteredQuery(
+        "progress history", "daily_progress", {"user_id": "default"}, sort=[("date", DESCENDING)], limit=7,
+    ),
+    RegisteredQuery(
+        "progress history page", "daily_progress", {"user_id": "default", "date": {"$lt": "2024-01-01"}},
+        sort=[("date", DESCENDING)], limit=7,
+    ),
+    RegisteredQuery(
+        "completed days", "daily_progress", {"user_id": "default", "completion_percentage": {"$gte": 100}},
+        sort=[("date", ASCENDING)],
+    ),
+    RegisteredQuery(
+        "progress summary", "progress_rollups", {"user_id": "default", "granularity": "week"},
+        sort=[("start", DESCENDING)], limit=12,
+    ),
+    RegisteredQuery("settings", "settings", {"user_id": "default"}, limit=1),
+    RegisteredQuery(
+        "changed affirmations", "affirmations", {"user_id": "default", "seq": {"$gt": 0}}, sort=[("seq", ASCENDING)],
+    ),
+    RegisteredQuery(
+        "changed progress", "daily_progress", {"user_id": "default", "seq": {"$gt": 0}}, sort=[("seq", ASCENDING)],
+    ),
+    RegisteredQuery(
+        "deleted affirmations", "tombstones", {"user_id": "default", "seq": {"$gt": 0}, "collection": "affirmations"},
+    ),
+    RegisteredQuery("due reminders", "reminders", {"next_fire": {"$lte": 0}}),
+    RegisteredQuery("claimed reminders", "reminders", {"claim": "token"}, limit=1000),
+    RegisteredQuery(
+        "unfolded practice events", "practice_events",
+        {"user_id": "default", "date": "2024-01-01", "seq": {"$gt": 0}}, sort=[("seq", ASCENDING)],
+    ),
+    RegisteredQuery(
+        "pending practice events", "practice_events", {"compacted": False, "seq": {"$lt": 0}},
+        sort=[("seq", ASCENDING)], limit=1000,
+    ),
+]
+
+
+async def drop_obsolete_indexes(db: AsyncIOMotorDatabase) -> None:
+    for collection, names in OBSOLETE_INDEXES.items():
+        existing = await db[collection].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection].drop_index(name)
+                logger.info("Dropped obsolete index %s.%s", collection, name)
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create every declared index, failing if one can't be built.
+
+    Without the unique indexes concurrent upserts write duplicate days and
+    settings, so serving without them isn't safe. MongoStorage.prepare
+    merges duplicates written before the indexes existed first.
+    """
+    await drop_obsolete_indexes(db)
+    for collection, models in INDEXES.items():
+        try:
+            await db[collection].create_indexes(models)
+        except OperationFailure as e:
+            raise RuntimeError(f"Could not create indexes on {collection}: {e}") from e
+
+
+def plan_stages(plan: dict) -> List[str]:
+    """Flatten a winning plan tree into its stage names."""
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("inputStage", "queryPlan", "outerStage", "innerStage"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+
+async def explain_query(db: AsyncIOMotorDatabase, query: RegisteredQuery) -> dict:
+    if query.count:
+        explanation = await db.command({
+            "explain": {"count": query.collection, "query": query.filter},
+            "verbosity": "queryPlanner",
+        })
+    else:
+        cursor = db[query.collection].find(query.filter)
+        if query.sort:
+            cursor = cursor.sort(query.sort)
+        if query.limit:
+            cursor = cursor.limit(query.limit)
+        explanation = await cursor.explain()
+    stages = plan_stages(explanation["queryPlanner"]["winningPlan"])
+    return {
+        "name": query.name,
+        "collection": query.collection,
+        "stages": stages,
+        "collscan": "COLLSCAN" in stages,
+    }
+
+
+async def explain_queries(db: AsyncIOMotorDatabase) -> List[dict]:
+    return [await explain_query(db, query) for query in QUERIES]
+
+
+async def main():
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Ensure indexes and check query plans")
+    parser.add_argument("--explain", action="store_true", help="Explain every registered query")
+    args = parser.parse_args()
+
+    load_dotenv(Path(__file__).parent / ".env")
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    db = client[os.environ["DB_NAME"]]
+    # Merges duplicate days and settings the unique indexes would reject first
+    from storage import MongoStorage
+    await MongoStorage(db).prepare()
+    print("Indexes ensured")
+
+    scans = 0
+    if args.explain:
+        for result in await explain_queries(db):
+            scans += result["collscan"]
+            flag = "COLLSCAN" if result["collscan"] else "ok"
+            print(f"{flag:8} {result['name']:24} {' <- '.join(result['stages'])}")
+    client.close()
+    raise SystemExit(1 if scans else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,156 @@
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest
+from prometheus_client import Counter as PrometheusCounter
+from pymongo import monitoring
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# Most API calls finish in single-digit milliseconds; the top buckets catch image renders
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last body byte",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_COMMAND_LATENCY = Histogram(
+    "mongodb_command_duration_seconds",
+    "Server round trip per MongoDB command",
+    ["collection", "operation", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+DB_DOCUMENTS = PrometheusCounter(
+    "mongodb_documents_total",
+    "Documents returned (reads) or affected (writes) by MongoDB commands",
+    ["collection", "operation"],
+)
+STORAGE_OPERATION_LATENCY = Histogram(
+    "sqlite_operation_duration_seconds",
+    "Time spent running one storage operation against the embedded SQLite database",
+    ["operation", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def metrics_response() -> Response:
+    """Prometheus text exposition of every metric above.
+
+    With several workers, set PROMETHEUS_MULTIPROC_DIR so each one writes
+    its samples there and any worker can report the sum.
+    """
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+class MetricsMiddleware:
+    """Records REQUEST_LATENCY for every HTTP request.
+
+    Requests are labelled by route template (/api/affirmations/{affirmation_id})
+    rather than raw path, so label cardinality stays fixed.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the scope it was handed
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(
+                scope["method"], route.path if route else "unmatched", str(status)
+            ).observe(time.perf_counter() - start)
+
+
+def command_collection(command_name: str, command: dict) -> str:
+    if command_name == "getMore":
+        return command.get("collection", "")
+    target = command.get(command_name)
+    return target if isinstance(target, str) else ""
+
+
+def reply_documents(command_name: str, reply: dict) -> int:
+    """Documents a command returned or touched, read from its reply."""
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    if command_name == "findAndModify":
+        return 1 if reply.get("value") else 0
+    n = reply.get("n")
+    return n if isinstance(n, int) else 0
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """Per-command metrics for a MongoClient: counts, latency and documents.
+
+    Register it with AsyncIOMotorClient(..., event_listeners=[monitor]).
+    Handshakes and heartbeats aren't commands here, so the numbers cover
+    what the application itself asked the database to do. Commands slower
+    than `slow_query_ms` are logged with their full text.
+    """
+
+    def __init__(self, slow_query_ms: Optional[float] = None):
+        self.slow_query_ms = slow_query_ms
+        self.commands = Counter()
+        self.failures = Counter()
+        # Started events carry the command, finished ones only its duration
+        self._in_flight: Dict[Tuple[int, object], Tuple[str, Optional[dict]]] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        self.commands[event.command_name] += 1
+        self._in_flight[(event.request_id, event.connection_id)] = (
+            command_collection(event.command_name, event.command),
+            event.command if self.slow_query_ms is not None else None,
+        )
+
+    def _finished(self, event, outcome: str) -> Tuple[str, float]:
+        collection, command = self._in_flight.pop((event.request_id, event.connection_id), ("", None))
+        seconds = event.duration_micros / 1e6
+        DB_COMMAND_LATENCY.labels(collection, event.command_name, outcome).observe(seconds)
+        if command is not None and seconds * 1000 >= self.slow_query_ms:
+            logger.warning(
+                "Slow MongoDB %s on %s (%.1f ms, %s): %.500s",
+                event.command_name, collection, seconds * 1000, outcome, command,
+            )
+        return collection, seconds
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        collection, _ = self._finished(event, "ok")
+        DB_DOCUMENTS.labels(collection, event.command_name).inc(reply_documents(event.command_name, event.reply))
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self.failures[event.command_name] += 1
+        self._finished(event, "error")
+
+    def describe(self) -> dict:
+        return {
+            "total": sum(self.commands.values()),
+            "commands": dict(self.commands),
+            "failures": dict(self.failures),
+        }
@@ -0,0 +1,218 @@
+"""Server-side reminder scheduling.
+
+settings.notification_times is normalized into reminders, one per enabled
+time, each stamped with "next_fire": the next minute (counted from the
+epoch, UTC) at which that time of day comes round in the user's timezone.
+Storage indexes reminders by next_fire, so NotificationScheduler, waking
+once a minute, finds what is due with a range scan over that minute's
+bucket instead of reading every user's settings. Due reminders go to a
+DeliverySink in batches and move on to their next day.
+
+Ticks claim the reminders they deliver, so several workers can each run a
+scheduler without sending anything twice.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import secrets
+import time
+from datetime import datetime, time as time_of_day, timedelta, timezone as dt_timezone
+from pathlib import Path
+from typing import Callable, List, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEZONE = "UTC"
+
+# Due reminders are read, delivered and rescheduled this many at a time
+REMINDER_BATCH_SIZE = 1000
+
+# A claim older than this many minutes belongs to a worker that died mid-tick
+CLAIM_TIMEOUT_MINUTES = 5
+
+_TIME_RE = re.compile(r"^([01]\d|2[0-3]):[0-5]\d$")
+
+
+def is_timezone(name: str) -> bool:
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+
+def current_minute() -> int:
+    return int(time.time() // 60)
+
+
+def next_fire_minute(clock_time: str, timezone: str, after_minute: int) -> int:
+    """The first minute after `after_minute` at which the clock in `timezone` reads `clock_time` ("HH:MM").
+
+    A time skipped by a DST change fires at the shifted time; one repeated
+    by it fires the first time round.
+    """
+    zone = ZoneInfo(timezone)
+    hour, minute = (int(part) for part in clock_time.split(":"))
+    day = datetime.fromtimestamp(after_minute * 60, zone).date()
+    while True:
+        fire = int(datetime.combine(day, time_of_day(hour, minute), zone).timestamp()) // 60
+        if fire > after_minute:
+            return fire
+        day += timedelta(days=1)
+
+
+def reminders_from_settings(user_id: str, settings: dict, after_minute: int) -> List[dict]:
+    """One reminder per enabled notification time, none while notifications are off.
+
+    Entries without a valid "HH:MM" time are skipped; the device may still
+    schedule them locally.
+    """
+    if not settings.get("notifications_enabled", True):
+        return []
+    timezone = settings.get("timezone") or DEFAULT_TIMEZONE
+    if not is_timezone(timezone):
+        timezone = DEFAULT_TIMEZONE
+    return [
+        {
+            "user_id": user_id,
+            "notification_id": str(entry.get("id", "")),
+            "label": entry.get("label", ""),
+            "time": entry["time"],
+            "timezone": timezone,
+            "next_fire": next_fire_minute(entry["time"], timezone, after_minute),
+        }
+        for entry in settings.get("notification_times", [])
+        if entry.get("enabled", True) and isinstance(entry.get("time"), str) and _TIME_RE.match(entry["time"])
+    ]
+
+
+def notification(reminder: dict, minute: int) -> dict:
+    """What a sink receives for one due reminder."""
+    return {
+        "user_id": reminder["user_id"],
+        "notification_id": reminder["notification_id"],
+        "label": reminder["label"],
+        "time": reminder["time"],
+        "timezone": reminder["timezone"],
+        "due_at": datetime.fromtimestamp(reminder["next_fire"] * 60, dt_timezone.utc).isoformat(),
+        "sent_at": datetime.fromtimestamp(minute * 60, dt_timezone.utc).isoformat(),
+    }
+
+
+class DeliverySink:
+    """Where due notifications go. A push service would be another implementation."""
+
+    async def deliver(self, notifications: List[dict]) -> None:
+        raise NotImplementedError
+
+
+class LogSink(DeliverySink):
+    async def deliver(self, notifications):
+        for item in notifications:
+            logger.info("Reminder %s for %s at %s", item["notification_id"], item["user_id"], item["due_at"])
+
+
+class FileSink(DeliverySink):
+    """Appends each notification to a file as one JSON line."""
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def _append(self, lines: str) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+    async def deliver(self, notifications):
+        lines = "".join(json.dumps(item) + "\n" for item in notifications)
+        await asyncio.get_running_loop().run_in_executor(None, self._append, lines)
+
+
+class QueueSink(DeliverySink):
+    """Puts each notification on an asyncio queue; for tests and in-process consumers."""
+
+    def __init__(self, queue: Optional[asyncio.Queue] = None):
+        self.queue = queue if queue is not None else asyncio.Queue()
+
+    async def deliver(self, notifications):
+        for item in notifications:
+            await self.queue.put(item)
+
+
+def create_sink() -> DeliverySink:
+    backend = os.environ.get("NOTIFICATION_SINK", "log")
+    if backend == "log":
+        return LogSink()
+    if backend == "file":
+        return FileSink(Path(os.environ.get("NOTIFICATION_SINK_PATH", "notifications.ndjson")))
+    raise ValueError(f"Unknown NOTIFICATION_SINK: {backend}")
+
+
+class NotificationScheduler:
+    """Delivers due reminders once a minute.
+
+    Reminders more than `max_late_minutes` overdue, say after downtime,
+    are moved on to their next day without being sent.
+    """
+
+    def __init__(self, storage, sink: DeliverySink, batch_size: int = REMINDER_BATCH_SIZE,
+                 max_late_minutes: int = 30, clock: Callable[[], float] = time.time):
+        self.storage = storage
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_late_minutes = max_late_minutes
+        self.clock = clock
+        self.delivered = 0
+        self.skipped = 0
+
+    async def backfill(self) -> int:
+        """Index the reminders of settings saved before the scheduler existed; returns how many."""
+        if await self.storage.count_reminders():
+            return 0
+        minute = int(self.clock() // 60)
+        count = 0
+        async for settings in self.storage.all_settings():
+            reminders = reminders_from_settings(settings["user_id"], settings, minute)
+            if reminders:
+                await self.storage.set_reminders(settings["user_id"], reminders)
+                count += len(reminders)
+        return count
+
+    async def tick(self, minute: int) -> int:
+        """Deliver every reminder due at or before `minute`; returns how many went out."""
+        token = secrets.token_hex(8)
+        await self.storage.claim_due_reminders(minute, token, stale_before=minute - CLAIM_TIMEOUT_MINUTES)
+        delivered = 0
+        while True:
+            # Rescheduling releases the claim, so each read picks up the next batch
+            batch = await self.storage.claimed_reminders(token, self.batch_size)
+            if not batch:
+                break
+            due = [reminder for reminder in batch if minute - reminder["next_fire"] <= self.max_late_minutes]
+            if due:
+                await self.sink.deliver([notification(reminder, minute) for reminder in due])
+            await self.storage.reschedule_reminders([
+                (reminder["_id"], next_fire_minute(reminder["time"], reminder["timezone"], minute))
+                for reminder in batch
+            ])
+            delivered += len(due)
+            self.skipped += len(batch) - len(due)
+        self.delivered += delivered
+        return delivered
+
+    async def run(self) -> None:
+        backfilled = await self.backfill()
+        if backfilled:
+            logger.info("Indexed %d reminders from existing settings", backfilled)
+        while True:
+            try:
+                await self.tick(int(self.clock() // 60))
+            except Exception:
+                logger.exception("Delivering reminders failed")
+            # Wake at the start of the next minute
+            await asyncio.sleep(60 - self.clock() % 60)
+
+    def describe(self) -> dict:
+        return {"delivered": self.delivered, "skipped": self.skipped}
@@ -0,0 +1,115 @@
+"""Write-behind practice log.
+
+With PRACTICE_EVENT_LOG=1, mark-complete appends one event per tap to
+practice_events instead of updating the day's progress document, so a burst
+of taps is a burst of inserts rather than updates contending for the same
+document. PracticeCompactor folds the log into daily progress every few
+seconds and hands each folded day to a callback (rollups, streak).
+
+Every day records in "folded_seq" the sequence of the last event folded
+into it. Readers merge the day with its events after that sequence (see
+merge_unfolded), so what they see doesn't depend on when the compactor last
+ran, and folding an event twice is a no-op. Events are kept after folding,
+marked compacted, as a record of every practice.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from storage import apply_completions, new_document_id, next_sequence, sync_token
+
+logger = logging.getLogger(__name__)
+
+# Events are read and folded this many at a time
+COMPACT_BATCH_SIZE = 1000
+
+
+def practice_event(user_id: str, day: str, affirmation_id: str) -> dict:
+    return {
+        "user_id": user_id,
+        "date": day,
+        "affirmation_id": affirmation_id,
+        "seq": next_sequence(),
+        "created_at": datetime.utcnow().isoformat(),
+        "compacted": False,
+    }
+
+
+def unwritten_day(user_id: str, day: str, total: int) -> dict:
+    """A day no event has been folded into yet; the compactor writes it under its own id."""
+    return {
+        "_id": new_document_id(),
+        "user_id": user_id,
+        "date": day,
+        "completed_affirmations": [],
+        "total_affirmations": total,
+        "completion_percentage": 0.0,
+        "practice_count": 0,
+    }
+
+
+def merge_unfolded(progress: dict, events: List[dict], total: int) -> dict:
+    """A day as readers see it: its document plus the events not yet folded into it."""
+    if not events:
+        return progress
+    return apply_completions(progress, [event["affirmation_id"] for event in events], total, len(events))
+
+
+class PracticeCompactor:
+    """Folds logged practice events into daily progress every `interval` seconds.
+
+    Only events sequenced more than `grace_ms` ago are folded, so one still
+    being inserted with an earlier sequence can't land below a day's
+    folded_seq and be skipped. `on_folded(user_id, progress, applied)` runs
+    for every day that changed. Several workers may each run a compactor.
+    """
+
+    def __init__(self, storage, totals: Callable[[str], Awaitable[int]],
+                 on_folded: Callable[[str, dict, int], Awaitable[None]], interval: float = 1.0,
+                 grace_ms: float = 2000, batch_size: int = COMPACT_BATCH_SIZE):
+        self.storage = storage
+        self.totals = totals
+        self.on_folded = on_folded
+        self.interval = interval
+        self.grace_ms = grace_ms
+        self.batch_size = batch_size
+        self.events = 0
+        self.days = 0
+
+    async def tick(self) -> int:
+        """Fold every event old enough; returns how many were read."""
+        before_seq = sync_token(None, self.grace_ms)
+        count = 0
+        while True:
+            events = await self.storage.pending_practice_events(before_seq, self.batch_size)
+            if not events:
+                break
+            # In sequence order within each day, as the taps happened
+            by_day: Dict[Tuple[str, str], List[dict]] = {}
+            for event in events:
+                by_day.setdefault((event["user_id"], event["date"]), []).append(event)
+            for (user_id, day), day_events in by_day.items():
+                progress, applied = await self.storage.fold_practice_events(
+                    user_id, day, day_events, await self.totals(user_id)
+                )
+                if applied:
+                    self.days += 1
+                    await self.on_folded(user_id, progress, applied)
+            await self.storage.mark_practice_events_compacted([event["_id"] for event in events])
+            count += len(events)
+            if len(events) < self.batch_size:
+                break
+        self.events += count
+        return count
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Compacting practice events failed")
+            await asyncio.sleep(self.interval)
+
+    def describe(self) -> dict:
+        return {"events": self.events, "days": self.days}
@@ -0,0 +1,97 @@
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+GRANULARITIES = ("week", "month")
+
+
+def period_of(day: str, granularity: str) -> dict:
+    """The rollup period a YYYY-MM-DD day falls into."""
+    d = date.fromisoformat(day)
+    if granularity == "week":
+        year, week, weekday = d.isocalendar()
+        start = d - timedelta(days=weekday - 1)
+        return {"period": f"{year}-W{week:02d}", "start": start.isoformat(), "end": (start + timedelta(days=6)).isoformat()}
+    start = d.replace(day=1)
+    next_month = (start + timedelta(days=32)).replace(day=1)
+    return {"period": d.strftime("%Y-%m"), "start": start.isoformat(), "end": (next_month - timedelta(days=1)).isoformat()}
+
+
+def rollup_id(user_id: str, granularity: str, period: str) -> str:
+    return f"{user_id}:{granularity}:{period}"
+
+
+def rollup_update(user_id: str, day: str, granularity: str, completion: float, practice_delta: int) -> UpdateOne:
+    # Completion is stored per day and overwritten, so replays and late
+    # writes for the same day don't skew the mean; practice_count just adds up
+    period = period_of(day, granularity)
+    return UpdateOne(
+        {"_id": rollup_id(user_id, granularity, period["period"])},
+        {
+            "$set": {f"days.{day}": completion, "user_id": user_id, "granularity": granularity, **period},
+            "$inc": {"practice_count": practice_delta},
+        },
+        upsert=True,
+    )
+
+
+async def record_progress(db: AsyncIOMotorDatabase, progress: dict, practice_delta: int) -> None:
+    """Fold one day's updated progress into its week and month rollups."""
+    await record_progress_many(db, [(progress, practice_delta)])
+
+
+async def record_progress_many(db: AsyncIOMotorDatabase, updates: List[Tuple[dict, int]]) -> None:
+    """Like record_progress for several days, in a single bulk write."""
+    if not updates:
+        return
+    await db.progress_rollups.bulk_write([
+        rollup_update(progress["user_id"], progress["date"], granularity, progress["completion_percentage"], practice_delta)
+        for progress, practice_delta in updates
+        for granularity in GRANULARITIES
+    ], ordered=False)
+
+
+def summary_helper(rollup: dict) -> dict:
+    completions = list(rollup.get("days", {}).values())
+    return {
+        "period": rollup["period"],
+        "start": rollup["start"],
+        "end": rollup["end"],
+        "days_practiced": len(completions),
+        "mean_completion": round(sum(completions) / len(completions), 2) if completions else 0.0,
+        "practice_count": rollup.get("practice_count", 0),
+    }
+
+
+async def get_summary(db: AsyncIOMotorDatabase, user_id: str, granularity: str, periods: int) -> List[dict]:
+    rollups = await db.progress_rollups.find({"user_id": user_id, "granularity": granularity}).sort("start", -1).limit(periods).to_list(periods)
+    return [summary_helper(r) for r in rollups]
+
+
+def add_to_rollups(rollups: Dict[str, dict], progress: dict) -> None:
+    """Fold one day of progress into `rollups`, keyed by rollup_id, while rebuilding."""
+    if not progress.get("practice_count"):
+        return
+    for granularity in GRANULARITIES:
+        period = period_of(progress["date"], granularity)
+        rollup = rollups.setdefault(rollup_id(progress["user_id"], granularity, period["period"]), {
+            "user_id": progress["user_id"], "granularity": granularity, **period, "days": {}, "practice_count": 0,
+        })
+        rollup["days"][progress["date"]] = progress["completion_percentage"]
+        rollup["practice_count"] += progress["practice_count"]
+
+
+async def rebuild_rollups(db: AsyncIOMotorDatabase, user_id: Optional[str] = None) -> int:
+    """Recompute one user's rollups, or everyone's, in one pass over daily_progress."""
+    scope = {"user_id": user_id} if user_id is not None else {}
+    rollups: Dict[str, dict] = {}
+    cursor = db.daily_progress.find(scope, {"user_id": 1, "date": 1, "completion_percentage": 1, "practice_count": 1})
+    async for progress in cursor:
+        add_to_rollups(rollups, progress)
+
+    await db.progress_rollups.delete_many(scope)
+    if rollups:
+        await db.progress_rollups.insert_many([{"_id": key, **rollup} for key, rollup in rollups.items()])
+    return len(rollups)
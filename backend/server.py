@@ -1,30 +1,210 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, BackgroundTasks, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from contextlib import asynccontextmanager
 import os
+import zlib
+import base64
+import orjson
+import hashlib
+import asyncio
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, field_validator
+from typing import Callable, Dict, List, Optional, Set
+from urllib.parse import urlencode
 from datetime import datetime, date
-from bson import ObjectId
-from pymongo import UpdateOne
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from streaks import advance, streak_state
+from database import client_options, warm_up, worker_count
+from storage import (
+    DEFAULT_USER_ID, ORDER_GAP, MongoStorage, Storage, create_storage, is_document_id, next_sequence, reserve_sequences,
+    sync_token,
+)
+from monitoring import CommandMonitor, MetricsMiddleware, metrics_response
+from compression import CompressionMiddleware
+from notifications import (
+    DEFAULT_TIMEZONE, NotificationScheduler, create_sink, current_minute, is_timezone, reminders_from_settings,
+)
+from backup import (
+    BACKUP_MEDIA_TYPE, GZIP_MEDIA_TYPE, IMPORT_BATCH_SIZE, backup_header, backup_record, check_header, gzip_chunks,
+    read_lines,
+)
+from practice_log import PracticeCompactor, merge_unfolded, practice_event, unwritten_day
+from idempotency import IdempotencyKeys, IdempotencyMiddleware
+from caching import CacheMap, CountCache, DocumentCache, MongoCounter, ResourceVersions
+from image_store import (
+    DEFAULT_LIST_VARIANT, IMAGE_VARIANTS, ImagePipeline, create_blob_store, image_url, image_urls, is_image_hash,
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Storage is MongoDB or embedded SQLite, per STORAGE_BACKEND (see storage.py).
+# It is created in lifespan(), once per worker process; with MongoDB, the
+# client uses the pool settings described in database.py.
+# SLOW_QUERY_MS logs every command slower than that, with its full text
+slow_query_ms = os.environ.get("SLOW_QUERY_MS")
+db_commands = CommandMonitor(slow_query_ms=float(slow_query_ms) if slow_query_ms else None)
+storage: Optional[Storage] = None
+# Set only on the MongoDB backend, for the features that need a shared
+# server: shared counters, the settings change stream and the command monitor
+db: Optional[AsyncIOMotorDatabase] = None
+
+# Image blobs live outside the affirmation documents, keyed by content hash;
+# the blob store is attached once the storage exists
+image_pipeline = ImagePipeline(workers=int(os.environ.get("IMAGE_WORKERS", "2")))
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Every document belongs to a user. Authentication happens in front of the
+# API, which passes the user on in X-User-Id; requests without it (and data
+# written before users existed) belong to DEFAULT_USER_ID.
+USER_ID_PATTERN = r"^[A-Za-z0-9_.@:-]{1,128}$"
+
+# Caches are kept per user, for at most CACHE_MAX_USERS recently active users
+CACHE_MAX_USERS = int(os.environ.get("CACHE_MAX_USERS", "10000"))
+
+# Only create, delete and seed change the number of affirmations, so the hot
+# practice path reads the count from memory. CACHE_BACKING=mongo shares the
+# counter between workers through the counters collection (MongoDB only).
+CACHE_BACKING = os.environ.get("CACHE_BACKING", "local")
+
+def affirmation_count_cache(user_id: str) -> CountCache:
+    return CountCache(
+        lambda: storage.count_affirmations(user_id),
+        ttl=float(os.environ.get("COUNT_CACHE_TTL", "60")),
+        shared=MongoCounter(db.counters, f"affirmations:{user_id}") if CACHE_BACKING == "mongo" else None,
+    )
+
+affirmation_counts = CacheMap(affirmation_count_cache, max_entries=CACHE_MAX_USERS)
+
+# Settings change only on PUT /api/settings and when a day completes.
+# SETTINGS_CHANGE_STREAM=1 keeps several workers coherent; otherwise other
+# workers' edits show up after SETTINGS_CACHE_TTL seconds.
+DEFAULT_SETTINGS = {
+    "morning_time": "08:00",
+    "night_time": "20:00",
+    "notifications_enabled": True,
+    "notification_times": [
+        {"id": "morning", "time": "08:00", "label": "Morning", "enabled": True},
+        {"id": "night", "time": "20:00", "label": "Night", "enabled": True}
+    ],
+    "current_streak": 0,
+    "longest_streak": 0,
+    "last_practice_date": None,
+    "timezone": DEFAULT_TIMEZONE
+}
+
+# Saving any of these re-derives the user's server-side reminders. Reminders
+# are delivered by a NotificationScheduler when NOTIFICATION_SCHEDULER=1;
+# claims keep workers that all run one from sending a reminder twice.
+REMINDER_FIELDS = {"notification_times", "notifications_enabled", "timezone"}
+scheduler: Optional[NotificationScheduler] = None
+
+async def load_user_settings(user_id: str) -> dict:
+    settings, created = await storage.load_settings(user_id, DEFAULT_SETTINGS)
+    if created:
+        # Users who never save their settings are reminded at the default times
+        await storage.set_reminders(user_id, reminders_from_settings(user_id, settings, current_minute()))
+    return settings
+
+settings_caches = CacheMap(
+    lambda user_id: DocumentCache(
+        lambda: load_user_settings(user_id), ttl=float(os.environ.get("SETTINGS_CACHE_TTL", "30"))
+    ),
+    max_entries=CACHE_MAX_USERS,
+)
+
+# Conditional GETs are answered from these versions alone, without touching
+# the collections; every write to a user's resource bumps its version
+resource_versions = ResourceVersions()
+
+# A write retried with the same Idempotency-Key header gets the first
+# response back instead of running again, for IDEMPOTENCY_TTL seconds.
+# CACHE_BACKING=mongo shares keys between workers via a TTL-indexed collection.
+idempotency_keys = IdempotencyKeys(ttl=float(os.environ.get("IDEMPOTENCY_TTL", "86400")), max_entries=CACHE_MAX_USERS)
+API_CACHE_CONTROL = "private, no-cache"
+
+# Listings are paged by keyset cursors; streamed responses flush at this size
+MAX_PAGE_SIZE = 500
+STREAM_CHUNK_BYTES = 64 * 1024
 
-# Create the main app without a prefix
-app = FastAPI()
+# Every write stamps a change sequence; a sync token is a sequence the client
+# has seen everything up to. Tokens trail the clock by SYNC_GRACE_MS, so a
+# write still in flight when the token was issued is sent again next time.
+SYNC_GRACE_MS = int(os.environ.get("SYNC_GRACE_MS", "2000"))
+
+# A move that leaves less than this between neighbours respaces the user's
+# list after the response, long before a gap runs out
+MIN_ORDER_GAP = int(os.environ.get("MIN_ORDER_GAP", "16"))
+rebalancing: Set[str] = set()
+
+# PRACTICE_EVENT_LOG=1 makes mark-complete an insert into the practice log,
+# folded into daily progress and the streak every PRACTICE_COMPACT_INTERVAL
+# seconds; reads of a day merge in what isn't folded yet. See practice_log.py.
+PRACTICE_EVENT_LOG = os.environ.get("PRACTICE_EVENT_LOG") == "1"
+compactor: Optional[PracticeCompactor] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global storage, db, scheduler, compactor
+    # Created here rather than at import, so each worker forked by uvicorn or
+    # gunicorn opens its own pool
+    storage = create_storage(event_listeners=[db_commands], slow_query_ms=db_commands.slow_query_ms)
+    db = storage.db if isinstance(storage, MongoStorage) else None
+    image_pipeline.store = create_blob_store(db)
+    if CACHE_BACKING == "mongo" and db is None:
+        raise RuntimeError("CACHE_BACKING=mongo needs STORAGE_BACKEND=mongo")
+    if CACHE_BACKING == "mongo":
+        resource_versions.shared = db.counters
+        idempotency_keys.shared = db.idempotency_keys
+    elif worker_count() > 1:
+        logger.warning("CACHE_BACKING=local with %d workers: counts and ETags can go stale across workers",
+                       worker_count())
+    if db is not None:
+        await warm_up(db, client_options().get("minPoolSize", 1))
+    
+    await storage.prepare()
+    await migrate_inline_images()
+    settings_watcher = None
+    if os.environ.get("SETTINGS_CHANGE_STREAM") == "1" and db is not None:
+        settings_watcher = asyncio.create_task(settings_caches.watch(db.settings, "user_id"))
+    reminder_worker = None
+    if os.environ.get("NOTIFICATION_SCHEDULER") == "1":
+        scheduler = NotificationScheduler(storage, create_sink())
+        reminder_worker = asyncio.create_task(scheduler.run())
+    compactor_worker = None
+    if PRACTICE_EVENT_LOG:
+        compactor = PracticeCompactor(
+            storage,
+            lambda user_id: affirmation_counts[user_id].get(),
+            practice_folded,
+            interval=float(os.environ.get("PRACTICE_COMPACT_INTERVAL", "1")),
+            grace_ms=SYNC_GRACE_MS,
+        )
+        compactor_worker = asyncio.create_task(compactor.run())
+    
+    yield
+    
+    if settings_watcher:
+        settings_watcher.cancel()
+    if reminder_worker:
+        reminder_worker.cancel()
+    if compactor_worker:
+        compactor_worker.cancel()
+    await storage.close()
+    image_pipeline.shutdown()
+
+# Create the main app without a prefix; orjson serializes responses
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+async def current_user(x_user_id: Optional[str] = Header(None, pattern=USER_ID_PATTERN)) -> str:
+    return x_user_id or DEFAULT_USER_ID
+
 # Helper function to convert ObjectId to string
 def affirmation_helper(affirmation) -> dict:
     return {
@@ -33,9 +213,115 @@ def affirmation_helper(affirmation) -> dict:
         "order": affirmation["order"],
         "is_example": affirmation.get("is_example", False),
         "created_at": affirmation["created_at"],
-        "image": affirmation.get("image", None)
+        **affirmation_image_fields(affirmation)
     }
 
+def affirmation_image_fields(affirmation) -> dict:
+    image_hash = affirmation.get("image_hash")
+    if not image_hash:
+        # Legacy documents may still carry an inline data URL
+        return {"image": affirmation.get("image", None), "images": None}
+    return {"image": image_url(image_hash, DEFAULT_LIST_VARIANT), "images": image_urls(image_hash)}
+
+# Response fields of an affirmation and the document fields each is built from
+AFFIRMATION_FIELD_SOURCES = {
+    "text": ["text"],
+    "order": ["order"],
+    "is_example": ["is_example"],
+    "created_at": ["created_at"],
+    "image": ["image_hash", "image"],
+    "images": ["image_hash"],
+}
+AFFIRMATION_VIEWS = {
+    "full": list(AFFIRMATION_FIELD_SOURCES),
+    "summary": ["text", "order", "image"],
+}
+
+def parse_affirmation_fields(view: str, fields: Optional[str]) -> List[str]:
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in selected if f not in AFFIRMATION_FIELD_SOURCES and f != "id"]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        return [f for f in selected if f != "id"]
+    if view not in AFFIRMATION_VIEWS:
+        raise HTTPException(status_code=400, detail=f"view must be one of: {', '.join(AFFIRMATION_VIEWS)}")
+    return AFFIRMATION_VIEWS[view]
+
+def affirmation_document_fields(fields: List[str]) -> List[str]:
+    return [source for field in fields for source in AFFIRMATION_FIELD_SOURCES[field]]
+
+def affirmation_row(affirmation, fields: List[str]) -> dict:
+    # Like affirmation_helper, but only builds the requested fields
+    row = {"id": str(affirmation["_id"])}
+    image_fields = affirmation_image_fields(affirmation) if "image" in fields or "images" in fields else {}
+    for field in fields:
+        if field in image_fields:
+            row[field] = image_fields[field]
+        elif field == "is_example":
+            row[field] = affirmation.get("is_example", False)
+        else:
+            row[field] = affirmation.get(field)
+    return row
+
+def list_response(rows: List[dict], limit: Optional[int], next_cursor: Callable[[], dict]) -> ORJSONResponse:
+    headers = {}
+    if limit is not None and len(rows) == limit:
+        # A full page means there may be more; hand back the keyset to continue from
+        headers["X-Next-Cursor"] = urlencode(next_cursor())
+    return ORJSONResponse(rows, headers=headers)
+
+def stream_response(cursor, row: Callable[[dict], dict], response_format: str) -> StreamingResponse:
+    """Serialize rows while iterating the storage cursor, so memory stays bounded by one batch."""
+    async def body():
+        buffer = bytearray(b"[" if response_format == "json" else b"")
+        separator = b"," if response_format == "json" else b"\n"
+        first = True
+        async for document in cursor:
+            if not first and response_format == "json":
+                buffer += separator
+            buffer += orjson.dumps(row(document))
+            if response_format == "ndjson":
+                buffer += separator
+            first = False
+            if len(buffer) >= STREAM_CHUNK_BYTES:
+                yield bytes(buffer)
+                buffer.clear()
+        if response_format == "json":
+            buffer += b"]"
+        yield bytes(buffer)
+
+    media_type = "application/json" if response_format == "json" else "application/x-ndjson"
+    return StreamingResponse(body(), media_type=media_type)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match uses weak comparison, so W/ prefixes don't matter
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*":
+        return True
+    opaque = lambda tag: tag.strip().removeprefix("W/")
+    return opaque(etag) in [opaque(tag) for tag in if_none_match.split(",")]
+
+async def resource_etag(request: Request, user_id: str, resource: str, *variant: str) -> str:
+    """Weak ETag for one user's view of a resource, built without reading it.
+
+    Take it before querying: if a write lands in between, the response goes
+    out under the older version, which that write's bump has already retired.
+    """
+    version = await resource_versions.get(user_id, resource)
+    query = urlencode(sorted(request.query_params.multi_items()))
+    key = "|".join([user_id, request.url.path, query, *variant])
+    return f'W/"{version}-{hashlib.sha1(key.encode()).hexdigest()[:12]}"'
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": API_CACHE_CONTROL})
+
+async def store_image(image: str) -> str:
+    try:
+        return await image_pipeline.ingest(image)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 def progress_helper(progress) -> dict:
     return {
         "id": str(progress["_id"]),
@@ -55,9 +341,17 @@ def settings_helper(settings) -> dict:
         "notifications_enabled": settings.get("notifications_enabled", True),
         "current_streak": settings.get("current_streak", 0),
         "longest_streak": settings.get("longest_streak", 0),
-        "last_practice_date": settings.get("last_practice_date", None)
+        "last_practice_date": settings.get("last_practice_date", None),
+        "timezone": settings.get("timezone", DEFAULT_TIMEZONE)
     }
 
+def check_day(value: str) -> str:
+    # Days are stored and compared as YYYY-MM-DD strings, and rollups parse them
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise ValueError("date must be a valid YYYY-MM-DD day")
+
 # Define Models
 class AffirmationCreate(BaseModel):
     text: str
@@ -76,11 +370,24 @@ class AffirmationResponse(BaseModel):
     is_example: bool
     created_at: str
     image: Optional[str] = None
+    images: Optional[Dict[str, str]] = None
 
 class DailyProgressCreate(BaseModel):
     date: str
     affirmation_id: str
 
+    _check_date = field_validator("date")(check_day)
+
+class PracticeEvent(BaseModel):
+    date: str
+    affirmation_id: str
+    timestamp: Optional[str] = None
+
+    _check_date = field_validator("date")(check_day)
+
+class PracticeBatch(BaseModel):
+    events: List[PracticeEvent]
+
 class DailyProgressResponse(BaseModel):
     id: str
     date: str
@@ -94,6 +401,7 @@ class SettingsUpdate(BaseModel):
     night_time: Optional[str] = None
     notifications_enabled: Optional[bool] = None
     notification_times: Optional[List[dict]] = None
+    timezone: Optional[str] = None
 
 class SettingsResponse(BaseModel):
     id: str
@@ -104,6 +412,7 @@ class SettingsResponse(BaseModel):
     current_streak: int
     longest_streak: int
     last_practice_date: Optional[str] = None
+    timezone: str = DEFAULT_TIMEZONE
 
 class NotificationTime(BaseModel):
     id: str
@@ -114,6 +423,10 @@ class NotificationTime(BaseModel):
 class ReorderRequest(BaseModel):
     affirmation_ids: List[str]
 
+class MoveRequest(BaseModel):
+    before: Optional[str] = None
+    after: Optional[str] = None
+
 # Routes
 @api_router.get("/")
 async def root():
@@ -121,75 +434,137 @@ async def root():
 
 # Affirmation endpoints
 @api_router.get("/affirmations", response_model=List[AffirmationResponse])
-async def get_affirmations():
-    affirmations = await db.affirmations.find().sort("order", 1).to_list(1000)
-    return [affirmation_helper(aff) for aff in affirmations]
+async def get_affirmations(
+    request: Request,
+    view: str = "full",
+    fields: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after_order: Optional[int] = None,
+    after_id: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    user_id: str = Depends(current_user),
+):
+    selected = parse_affirmation_fields(view, fields)
+    if after_id and not is_document_id(after_id):
+        raise HTTPException(status_code=400, detail="Invalid after_id")
+    etag = await resource_etag(request, user_id, "affirmations")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    # Keyset pagination on (order, _id); _id breaks ties between equal orders
+    after = (after_order, after_id) if after_order is not None else None
+    cursor = storage.list_affirmations(user_id, affirmation_document_fields(selected), after, limit)
+    # Rows are built from our own documents, so skip per-item response model validation
+    row = lambda aff: affirmation_row(aff, selected)
+    
+    if format == "ndjson" or limit is None:
+        response = stream_response(cursor, row, format)
+    else:
+        affirmations = [aff async for aff in cursor]
+        response = list_response(
+            [row(aff) for aff in affirmations],
+            limit,
+            lambda: {"after_order": affirmations[-1]["order"], "after_id": str(affirmations[-1]["_id"])},
+        )
+    response.headers.update({"ETag": etag, "Cache-Control": API_CACHE_CONTROL})
+    return response
 
 @api_router.post("/affirmations", response_model=AffirmationResponse)
-async def create_affirmation(affirmation: AffirmationCreate):
-    # Get the highest order number
-    last_affirmation = await db.affirmations.find_one(sort=[("order", -1)])
-    order = (last_affirmation["order"] + 1) if last_affirmation else 0
+async def create_affirmation(affirmation: AffirmationCreate, user_id: str = Depends(current_user)):
+    # Append: the current sequence sorts after every existing order, without a read
+    order = affirmation.order if affirmation.order is not None else next_sequence()
     
     affirmation_dict = {
+        "user_id": user_id,
         "text": affirmation.text,
-        "order": affirmation.order if affirmation.order is not None else order,
+        "order": order,
         "is_example": False,
-        "image": affirmation.image,
+        "image_hash": await store_image(affirmation.image) if affirmation.image else None,
         "created_at": datetime.utcnow().isoformat()
     }
     
-    result = await db.affirmations.insert_one(affirmation_dict)
-    affirmation_dict["_id"] = result.inserted_id
+    affirmation_dict["_id"] = await storage.insert_affirmation(affirmation_dict)
+    await affirmation_counts[user_id].adjust(1)
+    await resource_versions.bump(user_id, "affirmations")
     return affirmation_helper(affirmation_dict)
 
 @api_router.put("/affirmations/{affirmation_id}", response_model=AffirmationResponse)
-async def update_affirmation(affirmation_id: str, affirmation: AffirmationUpdate):
+async def update_affirmation(
+    affirmation_id: str, affirmation: AffirmationUpdate, user_id: str = Depends(current_user)
+):
     update_data = {k: v for k, v in affirmation.dict().items() if v is not None}
     
     if not update_data:
         raise HTTPException(status_code=400, detail="No fields to update")
     
-    result = await db.affirmations.find_one_and_update(
-        {"_id": ObjectId(affirmation_id)},
-        {"$set": update_data},
-        return_document=True
-    )
+    unset = []
+    if "image" in update_data:
+        # An empty image removes it, as it did when images were stored inline
+        image = update_data.pop("image")
+        update_data["image_hash"] = await store_image(image) if image else None
+        unset.append("image")
+    
+    result = await storage.update_affirmation(user_id, affirmation_id, update_data, unset)
     
     if not result:
         raise HTTPException(status_code=404, detail="Affirmation not found")
+    await resource_versions.bump(user_id, "affirmations")
     
     return affirmation_helper(result)
 
 @api_router.delete("/affirmations/{affirmation_id}")
-async def delete_affirmation(affirmation_id: str):
-    result = await db.affirmations.delete_one({"_id": ObjectId(affirmation_id)})
-    
-    if result.deleted_count == 0:
+async def delete_affirmation(affirmation_id: str, user_id: str = Depends(current_user)):
+    if not await storage.delete_affirmation(user_id, affirmation_id):
         raise HTTPException(status_code=404, detail="Affirmation not found")
+    await affirmation_counts[user_id].adjust(-1)
+    await resource_versions.bump(user_id, "affirmations")
     
     return {"message": "Affirmation deleted successfully"}
 
 @api_router.post("/affirmations/reorder")
-async def reorder_affirmations(request: ReorderRequest):
-    # Use bulk write to avoid N+1 query problem
-    operations = [
-        UpdateOne(
-            {"_id": ObjectId(affirmation_id)},
-            {"$set": {"order": index}}
-        )
-        for index, affirmation_id in enumerate(request.affirmation_ids)
-    ]
-    
-    if operations:
-        await db.affirmations.bulk_write(operations)
+async def reorder_affirmations(request: ReorderRequest, user_id: str = Depends(current_user)):
+    if request.affirmation_ids:
+        await storage.set_affirmation_orders(user_id, request.affirmation_ids)
+        await resource_versions.bump(user_id, "affirmations")
     
     return {"message": "Affirmations reordered successfully"}
 
+@api_router.post("/affirmations/{affirmation_id}/move", response_model=AffirmationResponse)
+async def move_affirmation(
+    affirmation_id: str, move: MoveRequest, background_tasks: BackgroundTasks, user_id: str = Depends(current_user)
+):
+    if (move.before is None) == (move.after is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of before or after")
+    anchor_id = move.after or move.before
+    if anchor_id == affirmation_id:
+        raise HTTPException(status_code=400, detail="Cannot move an affirmation next to itself")
+    
+    # Only the moved affirmation is written: it takes an order between its new neighbours
+    moved = await storage.move_affirmation(user_id, affirmation_id, anchor_id, after=move.after is not None)
+    if not moved:
+        raise HTTPException(status_code=404, detail="Affirmation not found")
+    affirmation, gap = moved
+    await resource_versions.bump(user_id, "affirmations")
+    if gap < MIN_ORDER_GAP and user_id not in rebalancing:
+        rebalancing.add(user_id)
+        background_tasks.add_task(rebalance_orders, user_id)
+    
+    return affirmation_helper(affirmation)
+
+async def rebalance_orders(user_id: str):
+    try:
+        count = await storage.rebalance_affirmation_orders(user_id)
+        await resource_versions.bump(user_id, "affirmations")
+        logger.info("Respaced %d affirmation orders for %s", count, user_id)
+    except Exception:
+        logger.exception("Rebalancing affirmation orders failed for %s", user_id)
+    finally:
+        rebalancing.discard(user_id)
+
 @api_router.post("/affirmations/seed")
-async def seed_example_affirmations():
+async def seed_example_affirmations(user_id: str = Depends(current_user)):
     # Check if examples already exist
-    existing = await db.affirmations.count_documents({"is_example": True})
+    existing = await storage.count_affirmations(user_id, is_example=True)
     if existing > 0:
         return {"message": "Example affirmations already exist"}
     
@@ -206,199 +581,521 @@ async def seed_example_affirmations():
     
     affirmations = [
         {
+            "user_id": user_id,
             "text": text,
-            "order": index,
+            "order": index * ORDER_GAP,
             "is_example": True,
             "created_at": datetime.utcnow().isoformat()
         }
         for index, text in enumerate(examples)
     ]
     
-    await db.affirmations.insert_many(affirmations)
+    await storage.insert_affirmations(affirmations)
+    await affirmation_counts[user_id].adjust(len(affirmations))
+    await resource_versions.bump(user_id, "affirmations")
     return {"message": f"Seeded {len(examples)} example affirmations"}
 
+# Image endpoints
+@api_router.get("/images/{image_hash}")
+async def get_image(image_hash: str, request: Request, size: str = "original"):
+    if not is_image_hash(image_hash):
+        raise HTTPException(status_code=404, detail="Image not found")
+    if size not in IMAGE_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"size must be one of: {', '.join(IMAGE_VARIANTS)}")
+    
+    # Content-addressed, so the hash is a strong validator and never changes
+    etag = f'"{image_hash}-{size}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    blob = await image_pipeline.open_variant(image_hash, size)
+    if not blob:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    headers["Content-Length"] = str(blob.length)
+    return StreamingResponse(blob.chunks, media_type=blob.content_type, headers=headers)
+
 # Daily Progress endpoints
 @api_router.get("/progress/today", response_model=DailyProgressResponse)
-async def get_today_progress():
+async def get_today_progress(request: Request, response: Response, user_id: str = Depends(current_user)):
     today = date.today().isoformat()
-    progress = await db.daily_progress.find_one({"date": today})
-    
-    if not progress:
-        # Create new progress for today
-        total_affirmations = await db.affirmations.count_documents({})
-        progress = {
-            "date": today,
-            "completed_affirmations": [],
-            "total_affirmations": total_affirmations,
-            "completion_percentage": 0.0,
-            "practice_count": 0
-        }
-        result = await db.daily_progress.insert_one(progress)
-        progress["_id"] = result.inserted_id
+    # Today's document changes at midnight, so the day is part of the tag
+    etag = await resource_etag(request, user_id, "progress", today)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    total_affirmations = await affirmation_counts[user_id].get()
+    
+    progress = await current_progress(user_id, today, total_affirmations)
     
+    response.headers.update({"ETag": etag, "Cache-Control": API_CACHE_CONTROL})
     return progress_helper(progress)
 
 @api_router.post("/progress/mark-complete")
-async def mark_affirmation_complete(data: DailyProgressCreate):
+async def mark_affirmation_complete(data: DailyProgressCreate, user_id: str = Depends(current_user)):
     today = data.date
     affirmation_id = data.affirmation_id
+    check_affirmation_id(affirmation_id)
     
-    # Get or create today's progress
-    progress = await db.daily_progress.find_one({"date": today})
-    
-    if not progress:
-        total_affirmations = await db.affirmations.count_documents({})
-        progress = {
-            "date": today,
-            "completed_affirmations": [],
-            "total_affirmations": total_affirmations,
-            "completion_percentage": 0.0,
-            "practice_count": 0
-        }
-        result = await db.daily_progress.insert_one(progress)
-        progress["_id"] = result.inserted_id
+    total = await affirmation_counts[user_id].get()
     
-    # Add affirmation to completed list if not already there
-    if affirmation_id not in progress["completed_affirmations"]:
-        progress["completed_affirmations"].append(affirmation_id)
+    if PRACTICE_EVENT_LOG:
+        # An insert alone; the compactor updates the day, rollups and streak
+        await storage.append_practice_event(practice_event(user_id, today, affirmation_id))
+        await resource_versions.bump(user_id, "progress")
+        return progress_helper(await current_progress(user_id, today, total))
     
-    # Update practice count
-    progress["practice_count"] += 1
+    # Single atomic upsert: concurrent taps can't lose increments or completions
+    progress = await storage.mark_complete(user_id, today, [affirmation_id], total)
     
-    # Calculate completion percentage
-    total = await db.affirmations.count_documents({})
-    completed_unique = len(progress["completed_affirmations"])
-    completion_percentage = (completed_unique / total * 100) if total > 0 else 0
-    
-    # Update in database
-    await db.daily_progress.update_one(
-        {"_id": progress["_id"]},
-        {
-            "$set": {
-                "completed_affirmations": progress["completed_affirmations"],
-                "total_affirmations": total,
-                "completion_percentage": completion_percentage,
-                "practice_count": progress["practice_count"]
-            }
-        }
-    )
+    await storage.record_progress([(progress, 1)])
+    await resource_versions.bump(user_id, "progress")
     
     # Update streak if all affirmations completed
-    if completed_unique == total and total > 0:
-        await update_streak(today)
-    
-    progress["completion_percentage"] = completion_percentage
-    progress["total_affirmations"] = total
+    if total > 0 and len(progress["completed_affirmations"]) >= total:
+        await update_streak(user_id, today)
     
     return progress_helper(progress)
 
-async def update_streak(today: str):
-    settings = await db.settings.find_one()
-    
-    if not settings:
-        settings = {
-            "morning_time": "08:00",
-            "night_time": "20:00",
-            "notifications_enabled": True,
-            "current_streak": 0,
-            "longest_streak": 0,
-            "last_practice_date": None
-        }
-        result = await db.settings.insert_one(settings)
-        settings["_id"] = result.inserted_id
+@api_router.post("/progress/mark-complete/batch", response_model=List[DailyProgressResponse])
+async def mark_affirmations_complete_batch(batch: PracticeBatch, user_id: str = Depends(current_user)):
+    """Apply practice events queued on the device, e.g. while offline."""
+    if not batch.events:
+        return []
+    for event in batch.events:
+        check_affirmation_id(event.affirmation_id)
     
-    last_practice = settings.get("last_practice_date")
-    current_streak = settings.get("current_streak", 0)
-    longest_streak = settings.get("longest_streak", 0)
+    # Group by day, keeping the order the affirmations were practiced in
+    completed_by_date: Dict[str, List[str]] = {}
+    practice_counts: Dict[str, int] = {}
+    for event in sorted(batch.events, key=lambda e: (e.date, e.timestamp or "")):
+        completed = completed_by_date.setdefault(event.date, [])
+        if event.affirmation_id not in completed:
+            completed.append(event.affirmation_id)
+        practice_counts[event.date] = practice_counts.get(event.date, 0) + 1
     
-    if last_practice:
-        last_date = datetime.fromisoformat(last_practice).date()
-        today_date = datetime.fromisoformat(today).date()
-        days_diff = (today_date - last_date).days
-        
-        if days_diff == 1:
-            # Consecutive day
-            current_streak += 1
-        elif days_diff > 1:
-            # Streak broken
-            current_streak = 1
-        # If same day (days_diff == 0), don't change streak
-    else:
-        current_streak = 1
+    total = await affirmation_counts[user_id].get()
     
-    longest_streak = max(current_streak, longest_streak)
+    # One write for every affected day
+    progress_list = await storage.mark_complete_days(user_id, completed_by_date, practice_counts, total)
+    await storage.record_progress([(p, practice_counts[p["date"]]) for p in progress_list])
+    await resource_versions.bump(user_id, "progress")
     
-    await db.settings.update_one(
-        {"_id": settings["_id"]},
-        {
-            "$set": {
-                "current_streak": current_streak,
-                "longest_streak": longest_streak,
-                "last_practice_date": today
-            }
-        }
-    )
+    # Streak is advanced in memory and written once for the whole batch
+    completed_days = [
+        p["date"] for p in progress_list
+        if total > 0 and len(p["completed_affirmations"]) >= total
+    ]
+    if completed_days:
+        settings = await settings_caches[user_id].get()
+        state = streak_state(settings)
+        new_state = state
+        for day in completed_days:
+            new_state = advance(new_state, day)
+        if new_state != state:
+            await save_streak(user_id, new_state)
+    
+    return ORJSONResponse([progress_helper(p) for p in progress_list])
+
+async def current_progress(user_id: str, day: str, total: int) -> dict:
+    if not PRACTICE_EVENT_LOG:
+        # Get or create the day's progress in one round trip
+        return await storage.get_or_create_progress(user_id, day, total)
+    # Only the compactor writes days, so a tap is an insert and two reads
+    # rather than another write contending for the day's document
+    progress = await storage.get_progress(user_id, day) or unwritten_day(user_id, day, total)
+    events = await storage.unfolded_practice_events(user_id, day, progress.get("folded_seq") or 0)
+    return merge_unfolded(progress, events, total)
+
+async def practice_folded(user_id: str, progress: dict, applied: int):
+    # What mark-complete does after its write, once the compactor has folded the taps in
+    await storage.record_progress([(progress, applied)])
+    await resource_versions.bump(user_id, "progress")
+    total = progress["total_affirmations"]
+    if total > 0 and len(progress["completed_affirmations"]) >= total:
+        await update_streak(user_id, progress["date"])
+
+def check_affirmation_id(affirmation_id: str):
+    if affirmation_id.startswith("$"):
+        # Would be read as a field path inside the update pipeline
+        raise HTTPException(status_code=400, detail="Invalid affirmation_id")
+
+async def update_streak(user_id: str, today: str):
+    settings = await settings_caches[user_id].get()
+    state = streak_state(settings)
+    new_state = advance(state, today)
+    if new_state != state:
+        await save_streak(user_id, new_state)
+
+async def save_streak(user_id: str, state: dict):
+    settings_caches[user_id].set(await storage.update_settings(user_id, state))
+    await resource_versions.bump(user_id, "settings")
+
+@api_router.post("/progress/streak/recompute")
+async def recompute_streak(user_id: str = Depends(current_user)):
+    # Repairs the incrementally maintained streak after edited or lost history;
+    # loading the settings first creates them for a new user
+    await settings_caches[user_id].get()
+    state = await storage.recompute_streak(user_id)
+    await save_streak(user_id, state)
+    return state
 
 @api_router.get("/progress/history")
-async def get_progress_history(days: int = 7):
-    progress_list = await db.daily_progress.find().sort("date", -1).limit(days).to_list(days)
-    return [progress_helper(p) for p in progress_list]
+async def get_progress_history(
+    days: int = Query(7, ge=1, le=MAX_PAGE_SIZE),
+    after_date: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    user_id: str = Depends(current_user),
+):
+    # Newest first; after_date continues from the oldest day of the previous page
+    cursor = storage.progress_history(user_id, after_date, days)
+    
+    if format == "ndjson":
+        return stream_response(cursor, progress_helper, format)
+    
+    progress_list = [p async for p in cursor]
+    return list_response(
+        [progress_helper(p) for p in progress_list],
+        days,
+        lambda: {"after_date": progress_list[-1]["date"]},
+    )
+
+@api_router.get("/progress/summary")
+async def get_progress_summary(
+    granularity: str = Query("week", pattern="^(week|month)$"),
+    periods: int = Query(12, alias="range", ge=1, le=MAX_PAGE_SIZE),
+    user_id: str = Depends(current_user),
+):
+    # Newest period first, served from the precomputed rollups
+    return await storage.progress_summary(user_id, granularity, periods)
+
+@api_router.post("/progress/summary/rebuild")
+async def rebuild_progress_summary(user_id: str = Depends(current_user)):
+    rebuilt = await storage.rebuild_rollups(user_id)
+    return {"message": f"Rebuilt {rebuilt} rollups"}
 
 # Settings endpoints
 @api_router.get("/settings", response_model=SettingsResponse)
-async def get_settings():
-    settings = await db.settings.find_one()
-    
-    if not settings:
-        # Create default settings with default notification times
-        settings = {
-            "morning_time": "08:00",
-            "night_time": "20:00",
-            "notifications_enabled": True,
-            "notification_times": [
-                {"id": "morning", "time": "08:00", "label": "Morning", "enabled": True},
-                {"id": "night", "time": "20:00", "label": "Night", "enabled": True}
-            ],
-            "current_streak": 0,
-            "longest_streak": 0,
-            "last_practice_date": None
-        }
-        result = await db.settings.insert_one(settings)
-        settings["_id"] = result.inserted_id
-    
-    return settings_helper(settings)
+async def get_settings(request: Request, response: Response, user_id: str = Depends(current_user)):
+    etag = await resource_etag(request, user_id, "settings")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers.update({"ETag": etag, "Cache-Control": API_CACHE_CONTROL})
+    return settings_helper(await settings_caches[user_id].get())
 
 @api_router.put("/settings", response_model=SettingsResponse)
-async def update_settings(settings_update: SettingsUpdate):
-    settings = await db.settings.find_one()
-    
-    if not settings:
-        # Create if doesn't exist
-        settings = {
-            "morning_time": "08:00",
-            "night_time": "20:00",
-            "notifications_enabled": True,
-            "current_streak": 0,
-            "longest_streak": 0,
-            "last_practice_date": None
-        }
-        result = await db.settings.insert_one(settings)
-        settings["_id"] = result.inserted_id
-    
+async def update_settings(settings_update: SettingsUpdate, user_id: str = Depends(current_user)):
+    settings = await settings_caches[user_id].get()
     update_data = {k: v for k, v in settings_update.dict().items() if v is not None}
+    if "timezone" in update_data and not is_timezone(update_data["timezone"]):
+        raise HTTPException(status_code=400, detail="Unknown timezone")
     
     if update_data:
-        await db.settings.update_one(
-            {"_id": settings["_id"]},
-            {"$set": update_data}
-        )
-        settings.update(update_data)
+        settings = await storage.update_settings(user_id, update_data)
+        settings_caches[user_id].set(settings)
+        await resource_versions.bump(user_id, "settings")
+        if REMINDER_FIELDS & update_data.keys():
+            await storage.set_reminders(user_id, reminders_from_settings(user_id, settings, current_minute()))
     
     return settings_helper(settings)
 
+# Backup endpoints
+BACKUP_SETTINGS_FIELDS = ("morning_time", "night_time", "notifications_enabled", "notification_times", "timezone")
+
+async def inline_image(image_hash: str) -> Optional[str]:
+    blob = await image_pipeline.store.open(image_hash)
+    if blob is None:
+        return None
+    data = b"".join([chunk async for chunk in blob.chunks])
+    return f"data:{blob.content_type};base64,{base64.b64encode(data).decode()}"
+
+@api_router.get("/export")
+async def export_backup(
+    images: str = Query("reference", pattern="^(reference|inline)$"),
+    gzip: bool = False,
+    user_id: str = Depends(current_user),
+):
+    """Stream the user's settings, affirmations and progress as NDJSON (see backup.py).
+
+    With gzip=true the body is a .ndjson.gz file to keep, rather than
+    transfer compression negotiated with Accept-Encoding.
+    """
+    async def records():
+        yield backup_header(images)
+        settings = settings_helper(await settings_caches[user_id].get())
+        yield backup_record("settings", {field: settings[field] for field in BACKUP_SETTINGS_FIELDS})
+        
+        fields = ["text", "order", "is_example", "created_at", "image"]
+        async for aff in storage.list_affirmations(user_id, affirmation_document_fields(fields)):
+            image = aff.get("image")
+            if aff.get("image_hash"):
+                image = await inline_image(aff["image_hash"]) if images == "inline" else image_url(aff["image_hash"])
+            yield backup_record("affirmation", {**affirmation_row(aff, fields[:-1]), "image": image})
+        
+        # Keyset pages of history, newest first
+        before = None
+        while True:
+            days = [p async for p in storage.progress_history(user_id, before, IMPORT_BATCH_SIZE)]
+            for day in days:
+                yield backup_record("progress", {k: v for k, v in progress_helper(day).items() if k != "id"})
+            if len(days) < IMPORT_BATCH_SIZE:
+                break
+            before = days[-1]["date"]
+    
+    async def body():
+        buffer = bytearray()
+        async for record in records():
+            buffer += record
+            if len(buffer) >= STREAM_CHUNK_BYTES:
+                yield bytes(buffer)
+                buffer.clear()
+        yield bytes(buffer)
+    
+    if gzip:
+        return StreamingResponse(gzip_chunks(body()), media_type=GZIP_MEDIA_TYPE, headers={
+            "Content-Disposition": 'attachment; filename="manifest-backup.ndjson.gz"',
+        })
+    return StreamingResponse(body(), media_type=BACKUP_MEDIA_TYPE, headers={
+        "Content-Disposition": 'attachment; filename="manifest-backup.ndjson"',
+    })
+
+@api_router.post("/import")
+async def import_backup(request: Request, user_id: str = Depends(current_user)):
+    """Add an export's affirmations and progress to the user's own; its settings replace theirs.
+
+    The body is NDJSON, gzipped if sent with Content-Encoding: gzip or as
+    application/gzip. Records are written in batches of IMPORT_BATCH_SIZE
+    as the body streams in. Imported affirmations go after the user's
+    existing ones; days the user already has are replaced. A malformed
+    record stops the import with a 400, keeping the batches written so far.
+    """
+    gzipped = (
+        request.headers.get("content-encoding", "").lower() == "gzip"
+        or request.headers.get("content-type", "").startswith(GZIP_MEDIA_TYPE)
+    )
+    imported = {"affirmations": 0, "progress": 0, "settings": 0, "skipped": 0, "missing_images": 0}
+    # Exported affirmation ids to new ones; days are remapped through it
+    new_ids: Dict[str, str] = {}
+    affirmations: List[dict] = []
+    exported_ids: List[str] = []
+    days: List[dict] = []
+    
+    async def flush_affirmations():
+        if affirmations:
+            # Appended in file order after everything the user has now. The
+            # range is reserved, so an affirmation created meanwhile sorts
+            # after the batch rather than into it
+            base_order = reserve_sequences(len(affirmations) * ORDER_GAP)
+            for index, affirmation in enumerate(affirmations):
+                affirmation["order"] = base_order + index * ORDER_GAP
+            new_ids.update(zip(exported_ids, await storage.insert_affirmations(affirmations)))
+            imported["affirmations"] += len(affirmations)
+            affirmations.clear()
+            exported_ids.clear()
+    
+    async def flush_days():
+        if days:
+            await storage.insert_progress(days)
+            imported["progress"] += len(days)
+            days.clear()
+    
+    async def import_image(image: Optional[str]) -> Optional[str]:
+        if not image:
+            return None
+        try:
+            return await image_pipeline.ingest(image)
+        except ValueError:
+            # A referenced image this server doesn't have, or one that doesn't decode
+            imported["missing_images"] += 1
+            return None
+    
+    line_number = 0
+    try:
+        async for line in read_lines(request.stream(), gzipped):
+            line_number += 1
+            record = orjson.loads(line)
+            record_type, data = record.get("type"), record.get("data")
+            if line_number == 1:
+                check_header(record)
+            elif record_type == "settings":
+                fields = {field: data[field] for field in BACKUP_SETTINGS_FIELDS if data.get(field) is not None}
+                if "timezone" in fields and not is_timezone(fields["timezone"]):
+                    del fields["timezone"]
+                await settings_caches[user_id].get()
+                settings = await storage.update_settings(user_id, fields)
+                settings_caches[user_id].set(settings)
+                await storage.set_reminders(user_id, reminders_from_settings(user_id, settings, current_minute()))
+                imported["settings"] += 1
+            elif record_type == "affirmation":
+                exported_ids.append(str(data.get("id", "")))
+                affirmations.append({
+                    "user_id": user_id,
+                    "text": str(data["text"]),
+                    "is_example": bool(data.get("is_example", False)),
+                    "image_hash": await import_image(data.get("image")),
+                    "created_at": str(data.get("created_at") or datetime.utcnow().isoformat()),
+                })
+                if len(affirmations) >= IMPORT_BATCH_SIZE:
+                    await flush_affirmations()
+            elif record_type == "progress":
+                # Days name affirmations, so every affirmation before them goes in first
+                await flush_affirmations()
+                completed = [new_ids.get(str(a), str(a)) for a in data.get("completed_affirmations", [])]
+                days.append({
+                    "user_id": user_id,
+                    "date": date.fromisoformat(data["date"]).isoformat(),
+                    "completed_affirmations": completed,
+                    "total_affirmations": int(data.get("total_affirmations", len(completed))),
+                    "completion_percentage": float(data.get("completion_percentage", 0)),
+                    "practice_count": int(data.get("practice_count", 0)),
+                })
+                if len(days) >= IMPORT_BATCH_SIZE:
+                    await flush_days()
+            else:
+                imported["skipped"] += 1
+        await flush_affirmations()
+        await flush_days()
+    except (ValueError, KeyError, TypeError, AttributeError, zlib.error) as e:
+        # orjson.JSONDecodeError is a ValueError
+        raise HTTPException(status_code=400, detail=f"Invalid backup at line {line_number}: {e}")
+    finally:
+        if imported["affirmations"]:
+            await affirmation_counts[user_id].adjust(imported["affirmations"])
+            await resource_versions.bump(user_id, "affirmations")
+        if imported["progress"]:
+            await storage.rebuild_rollups(user_id)
+            await recompute_streak(user_id)
+            await resource_versions.bump(user_id, "progress")
+        if imported["settings"]:
+            await resource_versions.bump(user_id, "settings")
+    
+    return imported
+
+# Sync endpoint
+@api_router.get("/sync")
+async def sync(since: Optional[str] = None, user_id: str = Depends(current_user)):
+    # Without a token the client gets everything; afterwards only what changed
+    try:
+        since_seq = int(since) if since else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+    token = sync_token(since_seq, SYNC_GRACE_MS)
+    changes = await storage.changes_since(user_id, since_seq)
+    settings = changes["settings"]
+    if settings is None and since_seq is None:
+        settings = await settings_caches[user_id].get()
+    return {
+        "token": str(token),
+        "full": since_seq is None,
+        "affirmations": [affirmation_helper(a) for a in changes["affirmations"]],
+        "deleted_affirmations": changes["deleted_affirmations"],
+        "progress": [progress_helper(p) for p in changes["progress"]],
+        "settings": settings_helper(settings) if settings is not None else None,
+    }
+
+# Bootstrap endpoint
+@api_router.get("/bootstrap")
+async def bootstrap(
+    response: Response,
+    history_days: int = Query(7, ge=1, le=MAX_PAGE_SIZE),
+    known: Optional[str] = None,
+    user_id: str = Depends(current_user),
+):
+    """What the app shows at launch, in one response.
+
+    Every section carries the version it was read at. Sections whose current
+    version the client passes back in `known` ("settings:<version>,...") come
+    without "data", so a repeat bootstrap only carries what changed.
+    """
+    today = date.today().isoformat()
+    # Versions are taken before reading, like resource_etag's
+    affirmations_version, progress_version, settings_version = await asyncio.gather(
+        resource_versions.get(user_id, "affirmations"),
+        resource_versions.get(user_id, "progress"),
+        resource_versions.get(user_id, "settings"),
+    )
+    versions = {
+        "affirmations": affirmations_version,
+        "today": f"{progress_version}.{today}",
+        "settings": settings_version,
+        "history": f"{progress_version}.{history_days}",
+    }
+    
+    async def load_affirmations():
+        fields = AFFIRMATION_VIEWS["full"]
+        cursor = storage.list_affirmations(user_id, affirmation_document_fields(fields))
+        return [affirmation_row(aff, fields) async for aff in cursor]
+    
+    async def load_today():
+        total_affirmations = await affirmation_counts[user_id].get()
+        return progress_helper(await current_progress(user_id, today, total_affirmations))
+    
+    async def load_settings():
+        return settings_helper(await settings_caches[user_id].get())
+    
+    async def load_history():
+        return [progress_helper(p) async for p in storage.progress_history(user_id, None, history_days)]
+    
+    loaders = {"affirmations": load_affirmations, "today": load_today, "settings": load_settings, "history": load_history}
+    known_versions = dict(part.split(":", 1) for part in (known or "").split(",") if ":" in part)
+    stale = [section for section in loaders if known_versions.get(section) != versions[section]]
+    
+    # The sections don't depend on each other, so their queries run concurrently
+    results = await asyncio.gather(*(loaders[section]() for section in stale))
+    body = {section: {"version": versions[section]} for section in loaders}
+    for section, data in zip(stale, results):
+        body[section]["data"] = data
+    response.headers["Cache-Control"] = API_CACHE_CONTROL
+    return body
+
+# Diagnostics endpoints
+@api_router.get("/diagnostics/cache")
+async def get_cache_stats():
+    return {
+        "affirmation_count": affirmation_counts.describe(),
+        "settings": settings_caches.describe(),
+        "idempotency": idempotency_keys.describe(),
+    }
+
+@api_router.get("/diagnostics/reminders")
+async def get_reminder_stats():
+    delivered = scheduler.describe() if scheduler else {}
+    return {"scheduler": scheduler is not None, "indexed": await storage.count_reminders(), **delivered}
+
+@api_router.get("/diagnostics/practice-log")
+async def get_practice_log_stats():
+    compacted = compactor.describe() if compactor else {}
+    return {"enabled": PRACTICE_EVENT_LOG, **compacted}
+
+@api_router.get("/diagnostics/db")
+async def get_db_stats():
+    # Commands sent by this worker since it started, and how its pool is sized
+    if db is None:
+        return {**storage.describe(), "backend": storage.name, "pid": os.getpid(), "workers": worker_count()}
+    return {
+        **db_commands.describe(),
+        "backend": storage.name,
+        "pid": os.getpid(),
+        "workers": worker_count(),
+        "client_options": client_options(),
+    }
+
+@api_router.get("/diagnostics/query-plans")
+async def get_query_plans():
+    plans = await storage.explain_queries()
+    return {"collscans": [p["name"] for p in plans if p["collscan"]], "queries": plans}
+
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # Prometheus scrape target: request and MongoDB latency histograms
+    return metrics_response()
+
+# Innermost, so replayed responses still get CORS headers and compression
+app.add_middleware(IdempotencyMiddleware, keys=idempotency_keys)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -407,6 +1104,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Negotiated brotli/gzip for bodies of at least COMPRESSION_MIN_SIZE bytes;
+# COMPRESSION_ENCODINGS="" turns compression off
+app.add_middleware(
+    CompressionMiddleware,
+    encodings=[e.strip() for e in os.environ.get("COMPRESSION_ENCODINGS", "br,gzip").split(",") if e.strip()],
+    minimum_size=int(os.environ.get("COMPRESSION_MIN_SIZE", "1024")),
+    gzip_level=int(os.environ.get("GZIP_LEVEL", "6")),
+    brotli_quality=int(os.environ.get("BROTLI_QUALITY", "4")),
+)
+
+# Outermost, so request latency includes compression and CORS
+app.add_middleware(MetricsMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -414,6 +1124,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+async def migrate_inline_images():
+    # Move images stored inline by older versions into the blob store
+    async for affirmation in storage.affirmations_with_inline_images():
+        try:
+            image_hash = await image_pipeline.ingest(affirmation["image"])
+        except ValueError:
+            logger.warning("Skipping unreadable inline image on affirmation %s", affirmation["_id"])
+            continue
+        await storage.replace_inline_image(affirmation["_id"], image_hash)
+        await resource_versions.bump(affirmation["user_id"], "affirmations")
+
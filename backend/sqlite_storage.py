@@ -0,0 +1,866 @@
+"""Embedded SQLite implementation of Storage.
+
+For single-user and small deployments that don't want to run a MongoDB
+server: everything lives in one file, and a request costs a function call
+on a local thread instead of a network round trip.
+
+    SQLITE_PATH     database file (default manifest.db)
+    SQLITE_THREADS  threads running statements, each with its own connection (default 4)
+
+The file runs in WAL mode, so readers never wait for the writer. Writes
+that read before they write (mark-complete, settings updates) run inside
+BEGIN IMMEDIATE, which serializes them across threads and processes the
+way MongoDB's single-document atomicity does. Every statement is a
+constant SQL string with bound parameters, so each connection prepares it
+once and reuses it from its statement cache.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from monitoring import STORAGE_OPERATION_LATENCY
+from rollups import GRANULARITIES, add_to_rollups, period_of, summary_helper
+from storage import (
+    LIST_BATCH_SIZE, ORDER_GAP, Storage, apply_completions, new_document_id, next_sequence, order_between, order_gap,
+)
+from streaks import streak_from_days
+
+logger = logging.getLogger(__name__)
+
+TABLES = """
+CREATE TABLE IF NOT EXISTS affirmations (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    is_example INTEGER NOT NULL DEFAULT 0,
+    image_hash TEXT,
+    created_at TEXT NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS daily_progress (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    completed_affirmations TEXT NOT NULL DEFAULT '[]',
+    total_affirmations INTEGER NOT NULL DEFAULT 0,
+    completion_percentage REAL NOT NULL DEFAULT 0,
+    practice_count INTEGER NOT NULL DEFAULT 0,
+    seq INTEGER NOT NULL DEFAULT 0,
+    folded_seq INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS progress_rollups (
+    user_id TEXT NOT NULL,
+    granularity TEXT NOT NULL,
+    period TEXT NOT NULL,
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    days TEXT NOT NULL DEFAULT '{}',
+    practice_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, granularity, period)
+) WITHOUT ROWID;
+
+-- Settings are a small schemaless document per user
+CREATE TABLE IF NOT EXISTS settings (
+    user_id TEXT PRIMARY KEY,
+    document TEXT NOT NULL
+) WITHOUT ROWID;
+
+-- Deleted documents, kept so delta sync can report the deletion
+CREATE TABLE IF NOT EXISTS tombstones (
+    user_id TEXT NOT NULL,
+    collection TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+
+-- Reminders due at a minute, across users; see notifications.py
+CREATE TABLE IF NOT EXISTS reminders (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    notification_id TEXT NOT NULL,
+    label TEXT NOT NULL DEFAULT '',
+    time TEXT NOT NULL,
+    timezone TEXT NOT NULL,
+    next_fire INTEGER NOT NULL,
+    claim TEXT,
+    claimed_at INTEGER
+);
+
+-- Append-only log of practice taps, folded into daily_progress; see practice_log.py
+CREATE TABLE IF NOT EXISTS practice_events (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    affirmation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    compacted INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Columns added after a table was first created: (table, column, definition)
+ADDED_COLUMNS = [
+    ("affirmations", "seq", "INTEGER NOT NULL DEFAULT 0"),
+    ("daily_progress", "seq", "INTEGER NOT NULL DEFAULT 0"),
+    ("daily_progress", "folded_seq", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+INDEXES = """
+-- Listing order, keyset pagination and "next order" lookups
+CREATE INDEX IF NOT EXISTS affirmations_user_position_id ON affirmations (user_id, position, id);
+CREATE INDEX IF NOT EXISTS affirmations_user_is_example ON affirmations (user_id, is_example);
+-- Delta sync: what changed after a sequence
+CREATE INDEX IF NOT EXISTS affirmations_user_seq ON affirmations (user_id, seq);
+
+-- One row per user and day; also what mark-complete upserts on
+CREATE UNIQUE INDEX IF NOT EXISTS daily_progress_user_date ON daily_progress (user_id, date);
+CREATE INDEX IF NOT EXISTS daily_progress_user_seq ON daily_progress (user_id, seq);
+
+CREATE INDEX IF NOT EXISTS progress_rollups_user_granularity_start
+    ON progress_rollups (user_id, granularity, start_date);
+
+CREATE INDEX IF NOT EXISTS tombstones_user_seq ON tombstones (user_id, seq);
+
+CREATE INDEX IF NOT EXISTS reminders_next_fire ON reminders (next_fire);
+-- Only reminders in flight are claimed
+CREATE INDEX IF NOT EXISTS reminders_claim ON reminders (claim) WHERE claim IS NOT NULL;
+CREATE INDEX IF NOT EXISTS reminders_user ON reminders (user_id);
+
+-- A day's unfolded tail, and what the compactor has left to fold
+CREATE INDEX IF NOT EXISTS practice_events_user_date_seq ON practice_events (user_id, date, seq);
+CREATE INDEX IF NOT EXISTS practice_events_pending ON practice_events (seq) WHERE compacted = 0;
+"""
+
+AFFIRMATION_COLUMNS = "id, user_id, text, position, is_example, image_hash, created_at, seq"
+LIST_AFFIRMATIONS = (
+    f"SELECT {AFFIRMATION_COLUMNS} FROM affirmations WHERE user_id = ? ORDER BY position, id LIMIT ?"
+)
+# Row values compare (position, id) lexicographically and still seek the index
+LIST_AFFIRMATIONS_AFTER = (
+    f"SELECT {AFFIRMATION_COLUMNS} FROM affirmations WHERE user_id = ? AND (position, id) > (?, ?)"
+    " ORDER BY position, id LIMIT ?"
+)
+# Sorts after every hex id, so a keyset without an id skips the whole position
+AFTER_LAST_ID = "~"
+# The affirmation next to a keyset on either side, skipping the one being moved
+NEXT_POSITION = (
+    "SELECT position FROM affirmations WHERE user_id = ? AND (position, id) > (?, ?) AND id != ?"
+    " ORDER BY position, id LIMIT 1"
+)
+PREVIOUS_POSITION = (
+    "SELECT position FROM affirmations WHERE user_id = ? AND (position, id) < (?, ?) AND id != ?"
+    " ORDER BY position DESC, id DESC LIMIT 1"
+)
+GET_POSITION = "SELECT position FROM affirmations WHERE id = ? AND user_id = ?"
+AFFIRMATION_IDS = "SELECT id FROM affirmations WHERE user_id = ? ORDER BY position, id"
+COUNT_AFFIRMATIONS = "SELECT COUNT(*) FROM affirmations WHERE user_id = ?"
+COUNT_AFFIRMATIONS_BY_EXAMPLE = "SELECT COUNT(*) FROM affirmations WHERE user_id = ? AND is_example = ?"
+INSERT_AFFIRMATION = (
+    "INSERT INTO affirmations (id, user_id, text, position, is_example, image_hash, created_at, seq)"
+    " VALUES (:id, :user_id, :text, :position, :is_example, :image_hash, :created_at, :seq)"
+)
+GET_AFFIRMATION = f"SELECT {AFFIRMATION_COLUMNS} FROM affirmations WHERE id = ? AND user_id = ?"
+DELETE_AFFIRMATION = "DELETE FROM affirmations WHERE id = ? AND user_id = ?"
+INSERT_TOMBSTONE = "INSERT INTO tombstones (user_id, collection, document_id, seq) VALUES (?, ?, ?, ?)"
+SET_POSITION = "UPDATE affirmations SET position = ?, seq = ? WHERE id = ? AND user_id = ?"
+# Columns update_affirmation may set, by document field
+AFFIRMATION_FIELD_COLUMNS = {"text": "text", "order": "position", "image_hash": "image_hash"}
+
+PROGRESS_COLUMNS = (
+    "id, user_id, date, completed_affirmations, total_affirmations, completion_percentage, practice_count, seq,"
+    " folded_seq"
+)
+GET_PROGRESS = f"SELECT {PROGRESS_COLUMNS} FROM daily_progress WHERE user_id = ? AND date = ?"
+INSERT_PROGRESS_IF_MISSING = (
+    "INSERT INTO daily_progress (id, user_id, date, total_affirmations, seq) VALUES (?, ?, ?, ?, ?)"
+    " ON CONFLICT (user_id, date) DO NOTHING"
+)
+UPSERT_PROGRESS = (
+    "INSERT INTO daily_progress (id, user_id, date, completed_affirmations, total_affirmations,"
+    " completion_percentage, practice_count, seq, folded_seq)"
+    " VALUES (:id, :user_id, :date, :completed_affirmations, :total_affirmations, :completion_percentage,"
+    " :practice_count, :seq, :folded_seq)"
+    " ON CONFLICT (user_id, date) DO UPDATE SET completed_affirmations = excluded.completed_affirmations,"
+    " total_affirmations = excluded.total_affirmations, completion_percentage = excluded.completion_percentage,"
+    " practice_count = excluded.practice_count, seq = excluded.seq, folded_seq = excluded.folded_seq"
+)
+PROGRESS_HISTORY = (
+    f"SELECT {PROGRESS_COLUMNS} FROM daily_progress WHERE user_id = ? ORDER BY date DESC LIMIT ?"
+)
+PROGRESS_HISTORY_BEFORE = (
+    f"SELECT {PROGRESS_COLUMNS} FROM daily_progress WHERE user_id = ? AND date < ? ORDER BY date DESC LIMIT ?"
+)
+COMPLETED_DAYS = (
+    "SELECT date FROM daily_progress WHERE user_id = ? AND completion_percentage >= 100 ORDER BY date"
+)
+ALL_PROGRESS = "SELECT user_id, date, completion_percentage, practice_count FROM daily_progress"
+USER_PROGRESS = ALL_PROGRESS + " WHERE user_id = ?"
+
+# Completion is stored per day and overwritten, so replays and late writes
+# for the same day don't skew the mean; practice_count just adds up
+UPSERT_ROLLUP = (
+    "INSERT INTO progress_rollups (user_id, granularity, period, start_date, end_date, days, practice_count)"
+    " VALUES (:user_id, :granularity, :period, :start, :end, json_object(:day, :completion), :practice_delta)"
+    " ON CONFLICT (user_id, granularity, period) DO UPDATE SET"
+    " days = json_set(progress_rollups.days, :day_path, :completion),"
+    " practice_count = progress_rollups.practice_count + excluded.practice_count"
+)
+INSERT_ROLLUP = (
+    "INSERT INTO progress_rollups (user_id, granularity, period, start_date, end_date, days, practice_count)"
+    " VALUES (:user_id, :granularity, :period, :start, :end, :days, :practice_count)"
+)
+PROGRESS_SUMMARY = (
+    "SELECT period, start_date, end_date, days, practice_count FROM progress_rollups"
+    " WHERE user_id = ? AND granularity = ? ORDER BY start_date DESC LIMIT ?"
+)
+
+GET_SETTINGS = "SELECT document FROM settings WHERE user_id = ?"
+INSERT_SETTINGS_IF_MISSING = "INSERT INTO settings (user_id, document) VALUES (?, ?) ON CONFLICT (user_id) DO NOTHING"
+SET_SETTINGS = "UPDATE settings SET document = ? WHERE user_id = ?"
+
+ALL_AFFIRMATIONS = f"SELECT {AFFIRMATION_COLUMNS} FROM affirmations WHERE user_id = ? ORDER BY position, id"
+CHANGED_AFFIRMATIONS = f"SELECT {AFFIRMATION_COLUMNS} FROM affirmations WHERE user_id = ? AND seq > ? ORDER BY seq"
+ALL_PROGRESS_DAYS = f"SELECT {PROGRESS_COLUMNS} FROM daily_progress WHERE user_id = ? ORDER BY date"
+CHANGED_PROGRESS = f"SELECT {PROGRESS_COLUMNS} FROM daily_progress WHERE user_id = ? AND seq > ? ORDER BY seq"
+DELETED_DOCUMENTS = "SELECT document_id FROM tombstones WHERE user_id = ? AND seq > ? AND collection = ?"
+
+SETTINGS_PAGE = "SELECT user_id, document FROM settings WHERE user_id > ? ORDER BY user_id LIMIT ?"
+
+REMINDER_COLUMNS = "id, user_id, notification_id, label, time, timezone, next_fire"
+DELETE_REMINDERS = "DELETE FROM reminders WHERE user_id = ?"
+INSERT_REMINDER = (
+    "INSERT INTO reminders (id, user_id, notification_id, label, time, timezone, next_fire)"
+    " VALUES (:id, :user_id, :notification_id, :label, :time, :timezone, :next_fire)"
+)
+COUNT_REMINDERS = "SELECT COUNT(*) FROM reminders"
+CLAIM_DUE_REMINDERS = (
+    "UPDATE reminders SET claim = ?, claimed_at = ?"
+    " WHERE next_fire <= ? AND (claim IS NULL OR claimed_at < ?)"
+)
+CLAIMED_REMINDERS = f"SELECT {REMINDER_COLUMNS} FROM reminders WHERE claim = ? LIMIT ?"
+RESCHEDULE_REMINDER = "UPDATE reminders SET next_fire = ?, claim = NULL, claimed_at = NULL WHERE id = ?"
+
+PRACTICE_EVENT_COLUMNS = "id, user_id, date, affirmation_id, seq, created_at, compacted"
+INSERT_PRACTICE_EVENT = (
+    f"INSERT INTO practice_events ({PRACTICE_EVENT_COLUMNS})"
+    " VALUES (:id, :user_id, :date, :affirmation_id, :seq, :created_at, :compacted)"
+)
+UNFOLDED_PRACTICE_EVENTS = (
+    f"SELECT {PRACTICE_EVENT_COLUMNS} FROM practice_events WHERE user_id = ? AND date = ? AND seq > ? ORDER BY seq"
+)
+PENDING_PRACTICE_EVENTS = (
+    f"SELECT {PRACTICE_EVENT_COLUMNS} FROM practice_events WHERE compacted = 0 AND seq < ? ORDER BY seq LIMIT ?"
+)
+MARK_PRACTICE_EVENT_COMPACTED = "UPDATE practice_events SET compacted = 1 WHERE id = ?"
+
+# Every statement shape the API runs against a non-trivial table, for
+# /api/diagnostics/query-plans; mirrors indexes.QUERIES
+QUERIES = [
+    ("list affirmations", "affirmations", LIST_AFFIRMATIONS, ("default", 50)),
+    ("page affirmations", "affirmations", LIST_AFFIRMATIONS_AFTER, ("default", 0, AFTER_LAST_ID, 50)),
+    ("previous affirmation", "affirmations", PREVIOUS_POSITION, ("default", 0, AFTER_LAST_ID, "")),
+    ("count affirmations", "affirmations", COUNT_AFFIRMATIONS, ("default",)),
+    ("count examples", "affirmations", COUNT_AFFIRMATIONS_BY_EXAMPLE, ("default", 1)),
+    ("progress for a day", "daily_progress", GET_PROGRESS, ("default", "2024-01-01")),
+    ("progress history", "daily_progress", PROGRESS_HISTORY, ("default", 7)),
+    ("progress history page", "daily_progress", PROGRESS_HISTORY_BEFORE, ("default", "2024-01-01", 7)),
+    ("completed days", "daily_progress", COMPLETED_DAYS, ("default",)),
+    ("progress summary", "progress_rollups", PROGRESS_SUMMARY, ("default", "week", 12)),
+    ("settings", "settings", GET_SETTINGS, ("default",)),
+    ("changed affirmations", "affirmations", CHANGED_AFFIRMATIONS, ("default", 0)),
+    ("changed progress", "daily_progress", CHANGED_PROGRESS, ("default", 0)),
+    ("deleted affirmations", "tombstones", DELETED_DOCUMENTS, ("default", 0, "affirmations")),
+    ("due reminders", "reminders", CLAIM_DUE_REMINDERS, ("token", 0, 0, 0)),
+    ("claimed reminders", "reminders", CLAIMED_REMINDERS, ("token", 1000)),
+    ("unfolded practice events", "practice_events", UNFOLDED_PRACTICE_EVENTS, ("default", "2024-01-01", 0)),
+    ("pending practice events", "practice_events", PENDING_PRACTICE_EVENTS, (0, 1000)),
+]
+
+
+def affirmation_document(row: sqlite3.Row) -> dict:
+    return {
+        "_id": row["id"],
+        "user_id": row["user_id"],
+        "text": row["text"],
+        "order": row["position"],
+        "is_example": bool(row["is_example"]),
+        "image_hash": row["image_hash"],
+        "created_at": row["created_at"],
+        "seq": row["seq"],
+    }
+
+
+def progress_document(row: sqlite3.Row) -> dict:
+    return {
+        "_id": row["id"],
+        "user_id": row["user_id"],
+        "date": row["date"],
+        "completed_affirmations": json.loads(row["completed_affirmations"]),
+        "total_affirmations": row["total_affirmations"],
+        "completion_percentage": row["completion_percentage"],
+        "practice_count": row["practice_count"],
+        "seq": row["seq"],
+        "folded_seq": row["folded_seq"],
+    }
+
+
+def reminder_document(row: sqlite3.Row) -> dict:
+    return {
+        "_id": row["id"],
+        "user_id": row["user_id"],
+        "notification_id": row["notification_id"],
+        "label": row["label"],
+        "time": row["time"],
+        "timezone": row["timezone"],
+        "next_fire": row["next_fire"],
+    }
+
+
+def progress_row(progress: dict) -> dict:
+    return {
+        "id": str(progress.get("_id") or new_document_id()),
+        "user_id": progress["user_id"],
+        "date": progress["date"],
+        "completed_affirmations": json.dumps(progress.get("completed_affirmations", [])),
+        "total_affirmations": progress.get("total_affirmations", 0),
+        "completion_percentage": progress.get("completion_percentage", 0.0),
+        "practice_count": progress.get("practice_count", 0),
+        "seq": next_sequence(),
+        "folded_seq": progress.get("folded_seq", 0),
+    }
+
+
+def practice_event_document(row: sqlite3.Row) -> dict:
+    return {
+        "_id": row["id"],
+        "user_id": row["user_id"],
+        "date": row["date"],
+        "affirmation_id": row["affirmation_id"],
+        "seq": row["seq"],
+        "created_at": row["created_at"],
+        "compacted": bool(row["compacted"]),
+    }
+
+
+@contextmanager
+def transaction(connection: sqlite3.Connection):
+    # IMMEDIATE takes the write lock up front, so a read inside can't go stale
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+class SQLiteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, path: str, threads: int = 4, slow_query_ms: Optional[float] = None):
+        self.path = path
+        self.threads = threads
+        self.slow_query_ms = slow_query_ms
+        self.operations = Counter()
+        self.failures = Counter()
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="sqlite")
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit; multi-statement writes open their own transaction
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False, cached_statements=256,
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA busy_timeout = 5000")
+            # With WAL, NORMAL only risks the last commits on power loss, never corruption
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _call(self, operation: str, func: Callable, args: tuple):
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            return func(self._connection(), *args)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            STORAGE_OPERATION_LATENCY.labels(operation, outcome).observe(seconds)
+            if self.slow_query_ms is not None and seconds * 1000 >= self.slow_query_ms:
+                logger.warning("Slow SQLite %s (%.1f ms, %s)", operation, seconds * 1000, outcome)
+
+    async def _run(self, operation: str, func: Callable, *args):
+        self.operations[operation] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._call, operation, func, args
+            )
+        except Exception:
+            self.failures[operation] += 1
+            raise
+
+    async def prepare(self) -> None:
+        def create_schema(connection):
+            mode = connection.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            if mode != "wal":
+                logger.warning("SQLite database %s is in %s mode, not WAL", self.path, mode)
+            connection.executescript(TABLES)
+            for table, column, definition in ADDED_COLUMNS:
+                columns = [row["name"] for row in connection.execute(f"PRAGMA table_info({table})")]
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            connection.executescript(INDEXES)
+
+        await self._run("prepare", create_schema)
+        logger.info("Using SQLite storage at %s", self.path)
+
+    async def close(self) -> None:
+        def optimize(connection):
+            # Refreshes planner statistics for the indexes the queries above used
+            connection.execute("PRAGMA optimize")
+
+        await self._run("optimize", optimize)
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def describe(self) -> dict:
+        return {
+            "total": sum(self.operations.values()),
+            "commands": dict(self.operations),
+            "failures": dict(self.failures),
+            "client_options": {"path": self.path, "threads": self.threads, "journal_mode": "wal"},
+        }
+
+    async def explain_queries(self) -> List[dict]:
+        def explain(connection):
+            results = []
+            for name, table, sql, params in QUERIES:
+                details = [row["detail"] for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+                results.append({
+                    "name": name,
+                    "collection": table,
+                    "stages": details,
+                    # SEARCH seeks an index; SCAN reads the whole table (or index)
+                    "collscan": any(detail.startswith("SCAN ") for detail in details),
+                })
+            return results
+
+        return await self._run("explain", explain)
+
+    # Affirmations
+    async def list_affirmations(self, user_id, fields, after=None, limit=None):
+        # Read in keyset-paged batches, so a long list never sits in memory at once
+        remaining = limit
+        while remaining is None or remaining > 0:
+            batch = min(LIST_BATCH_SIZE, remaining) if remaining is not None else LIST_BATCH_SIZE
+            if after is None:
+                rows = await self._run("list_affirmations", lambda c: c.execute(
+                    LIST_AFFIRMATIONS, (user_id, batch)).fetchall())
+            else:
+                after_order, after_id = after
+                rows = await self._run("list_affirmations", lambda c: c.execute(
+                    LIST_AFFIRMATIONS_AFTER, (user_id, after_order, after_id or AFTER_LAST_ID, batch)).fetchall())
+            for row in rows:
+                yield affirmation_document(row)
+            if len(rows) < batch:
+                return
+            after = (rows[-1]["position"], rows[-1]["id"])
+            if remaining is not None:
+                remaining -= len(rows)
+
+    async def count_affirmations(self, user_id, is_example=None):
+        if is_example is None:
+            return await self._run("count_affirmations", lambda c: c.execute(COUNT_AFFIRMATIONS, (user_id,)).fetchone()[0])
+        return await self._run("count_affirmations", lambda c: c.execute(
+            COUNT_AFFIRMATIONS_BY_EXAMPLE, (user_id, int(is_example))).fetchone()[0])
+
+    @staticmethod
+    def _affirmation_row(affirmation: dict) -> dict:
+        return {
+            "id": str(affirmation.get("_id") or new_document_id()),
+            "user_id": affirmation["user_id"],
+            "text": affirmation["text"],
+            "position": affirmation["order"],
+            "is_example": int(affirmation.get("is_example", False)),
+            "image_hash": affirmation.get("image_hash"),
+            "created_at": affirmation["created_at"],
+            "seq": next_sequence(),
+        }
+
+    async def insert_affirmation(self, affirmation):
+        row = self._affirmation_row(affirmation)
+        await self._run("insert_affirmation", lambda c: c.execute(INSERT_AFFIRMATION, row))
+        return row["id"]
+
+    async def insert_affirmations(self, affirmations):
+        rows = [self._affirmation_row(affirmation) for affirmation in affirmations]
+
+        def insert(connection):
+            with transaction(connection):
+                connection.executemany(INSERT_AFFIRMATION, rows)
+
+        await self._run("insert_affirmations", insert)
+        return [row["id"] for row in rows]
+
+    async def update_affirmation(self, user_id, affirmation_id, fields, unset=()):
+        assignments = {AFFIRMATION_FIELD_COLUMNS[field]: value for field, value in fields.items()}
+        # Only legacy MongoDB documents have anything else to unset
+        assignments.update({AFFIRMATION_FIELD_COLUMNS[field]: None for field in unset if field in AFFIRMATION_FIELD_COLUMNS})
+        assignments["seq"] = next_sequence()
+        # Column names come from AFFIRMATION_FIELD_COLUMNS, never from the request
+        sql = "UPDATE affirmations SET {} WHERE id = ? AND user_id = ?".format(
+            ", ".join(f"{column} = ?" for column in assignments)
+        )
+
+        def update(connection):
+            with transaction(connection):
+                connection.execute(sql, (*assignments.values(), affirmation_id, user_id))
+                return connection.execute(GET_AFFIRMATION, (affirmation_id, user_id)).fetchone()
+
+        row = await self._run("update_affirmation", update)
+        return affirmation_document(row) if row else None
+
+    async def delete_affirmation(self, user_id, affirmation_id):
+        def delete(connection):
+            with transaction(connection):
+                if not connection.execute(DELETE_AFFIRMATION, (affirmation_id, user_id)).rowcount:
+                    return False
+                connection.execute(INSERT_TOMBSTONE, (user_id, "affirmations", affirmation_id, next_sequence()))
+                return True
+
+        return await self._run("delete_affirmation", delete)
+
+    @staticmethod
+    def _set_positions(connection, user_id: str, affirmation_ids: List[str]) -> None:
+        connection.executemany(SET_POSITION, [
+            (index * ORDER_GAP, next_sequence(), affirmation_id, user_id)
+            for index, affirmation_id in enumerate(affirmation_ids)
+        ])
+
+    async def set_affirmation_orders(self, user_id, affirmation_ids):
+        def reorder(connection):
+            with transaction(connection):
+                self._set_positions(connection, user_id, affirmation_ids)
+
+        await self._run("set_affirmation_orders", reorder)
+
+    async def move_affirmation(self, user_id, affirmation_id, anchor_id, after):
+        def move(connection):
+            # Neighbours are read and the new position written in one transaction
+            with transaction(connection):
+                if connection.execute(GET_POSITION, (affirmation_id, user_id)).fetchone() is None:
+                    return None
+                for _ in range(2):
+                    anchor = connection.execute(GET_POSITION, (anchor_id, user_id)).fetchone()
+                    if anchor is None:
+                        return None
+                    neighbour = connection.execute(
+                        NEXT_POSITION if after else PREVIOUS_POSITION,
+                        (user_id, anchor["position"], anchor_id, affirmation_id),
+                    ).fetchone()
+                    neighbour = neighbour["position"] if neighbour else None
+                    previous, following = (anchor["position"], neighbour) if after else (neighbour, anchor["position"])
+                    position = order_between(previous, following)
+                    if position is not None:
+                        break
+                    self._set_positions(connection, user_id, [
+                        row["id"] for row in connection.execute(AFFIRMATION_IDS, (user_id,))
+                    ])
+                connection.execute(SET_POSITION, (position, next_sequence(), affirmation_id, user_id))
+                row = connection.execute(GET_AFFIRMATION, (affirmation_id, user_id)).fetchone()
+                return row, order_gap(previous, position, following)
+
+        moved = await self._run("move_affirmation", move)
+        return (affirmation_document(moved[0]), moved[1]) if moved else None
+
+    async def rebalance_affirmation_orders(self, user_id):
+        def rebalance(connection):
+            with transaction(connection):
+                affirmation_ids = [row["id"] for row in connection.execute(AFFIRMATION_IDS, (user_id,))]
+                self._set_positions(connection, user_id, affirmation_ids)
+                return len(affirmation_ids)
+
+        return await self._run("rebalance_affirmation_orders", rebalance)
+
+    async def affirmations_with_inline_images(self):
+        # This backend has always stored images by hash, so nothing predates the blob store
+        for affirmation in ():
+            yield affirmation
+
+    # Daily progress
+    async def get_progress(self, user_id, day):
+        row = await self._run("get_progress", lambda c: c.execute(GET_PROGRESS, (user_id, day)).fetchone())
+        return progress_document(row) if row else None
+
+    async def get_or_create_progress(self, user_id, day, total):
+        def get_or_create(connection):
+            connection.execute(INSERT_PROGRESS_IF_MISSING, (new_document_id(), user_id, day, total, next_sequence()))
+            return connection.execute(GET_PROGRESS, (user_id, day)).fetchone()
+
+        return progress_document(await self._run("get_or_create_progress", get_or_create))
+
+    @staticmethod
+    def _mark_day(connection, user_id: str, day: str, affirmation_ids: List[str], total: int,
+                  practice_delta: int, folded_seq: Optional[int] = None) -> dict:
+        row = connection.execute(GET_PROGRESS, (user_id, day)).fetchone()
+        progress = progress_document(row) if row else {
+            "_id": new_document_id(), "user_id": user_id, "date": day,
+            "completed_affirmations": [], "practice_count": 0,
+        }
+        progress = apply_completions(progress, affirmation_ids, total, practice_delta)
+        if folded_seq is not None:
+            progress["folded_seq"] = folded_seq
+        connection.execute(UPSERT_PROGRESS, progress_row(progress))
+        return progress
+
+    async def mark_complete(self, user_id, day, affirmation_ids, total, practice_delta=1):
+        def mark(connection):
+            with transaction(connection):
+                return self._mark_day(connection, user_id, day, affirmation_ids, total, practice_delta)
+
+        return await self._run("mark_complete", mark)
+
+    async def mark_complete_days(self, user_id, completed_by_date, practice_counts, total):
+        def mark(connection):
+            # Every affected day in one transaction
+            with transaction(connection):
+                return [
+                    self._mark_day(connection, user_id, day, completed_by_date[day], total, practice_counts[day])
+                    for day in sorted(completed_by_date)
+                ]
+
+        return await self._run("mark_complete_days", mark)
+
+    async def progress_history(self, user_id, before, limit):
+        if before:
+            rows = await self._run("progress_history", lambda c: c.execute(
+                PROGRESS_HISTORY_BEFORE, (user_id, before, limit)).fetchall())
+        else:
+            rows = await self._run("progress_history", lambda c: c.execute(
+                PROGRESS_HISTORY, (user_id, limit)).fetchall())
+        for row in rows:
+            yield progress_document(row)
+
+    async def insert_progress(self, progress):
+        # A replaced day already accounts for the practice events logged before it
+        rows = [progress_row({**day, "folded_seq": next_sequence()}) for day in progress]
+
+        def insert(connection):
+            with transaction(connection):
+                connection.executemany(UPSERT_PROGRESS, rows)
+
+        await self._run("insert_progress", insert)
+
+    # Rollups and streaks
+    async def record_progress(self, updates):
+        if not updates:
+            return
+        rows = [
+            {
+                "user_id": progress["user_id"],
+                "granularity": granularity,
+                **period_of(progress["date"], granularity),
+                "day": progress["date"],
+                "day_path": f'$."{progress["date"]}"',
+                "completion": progress["completion_percentage"],
+                "practice_delta": practice_delta,
+            }
+            for progress, practice_delta in updates
+            for granularity in GRANULARITIES
+        ]
+
+        def record(connection):
+            with transaction(connection):
+                connection.executemany(UPSERT_ROLLUP, rows)
+
+        await self._run("record_progress", record)
+
+    async def progress_summary(self, user_id, granularity, periods):
+        rows = await self._run("progress_summary", lambda c: c.execute(
+            PROGRESS_SUMMARY, (user_id, granularity, periods)).fetchall())
+        return [
+            summary_helper({
+                "period": row["period"],
+                "start": row["start_date"],
+                "end": row["end_date"],
+                "days": json.loads(row["days"]),
+                "practice_count": row["practice_count"],
+            })
+            for row in rows
+        ]
+
+    async def rebuild_rollups(self, user_id=None):
+        def rebuild(connection):
+            rollups: Dict[str, dict] = {}
+            cursor = connection.execute(USER_PROGRESS, (user_id,)) if user_id is not None else connection.execute(ALL_PROGRESS)
+            for row in cursor:
+                add_to_rollups(rollups, dict(row))
+            with transaction(connection):
+                if user_id is not None:
+                    connection.execute("DELETE FROM progress_rollups WHERE user_id = ?", (user_id,))
+                else:
+                    connection.execute("DELETE FROM progress_rollups")
+                connection.executemany(INSERT_ROLLUP, [
+                    {**rollup, "days": json.dumps(rollup["days"])} for rollup in rollups.values()
+                ])
+            return len(rollups)
+
+        return await self._run("rebuild_rollups", rebuild)
+
+    async def recompute_streak(self, user_id):
+        return await self._run("recompute_streak", lambda c: streak_from_days(
+            row["date"] for row in c.execute(COMPLETED_DAYS, (user_id,))))
+
+    # Settings
+    async def load_settings(self, user_id, defaults):
+        document = json.dumps({"_id": new_document_id(), "user_id": user_id, **defaults, "seq": next_sequence()})
+
+        def get_or_create(connection):
+            created = connection.execute(INSERT_SETTINGS_IF_MISSING, (user_id, document)).rowcount == 1
+            return connection.execute(GET_SETTINGS, (user_id,)).fetchone()["document"], created
+
+        stored, created = await self._run("load_settings", get_or_create)
+        return json.loads(stored), created
+
+    async def update_settings(self, user_id, fields):
+        def update(connection):
+            with transaction(connection):
+                row = connection.execute(GET_SETTINGS, (user_id,)).fetchone()
+                if row is None:
+                    return None
+                settings = {**json.loads(row["document"]), **fields, "seq": next_sequence()}
+                connection.execute(SET_SETTINGS, (json.dumps(settings), user_id))
+                return settings
+
+        return await self._run("update_settings", update)
+
+    async def all_settings(self):
+        last_user_id = ""
+        while True:
+            rows = await self._run("all_settings", lambda c: c.execute(
+                SETTINGS_PAGE, (last_user_id, LIST_BATCH_SIZE)).fetchall())
+            for row in rows:
+                yield json.loads(row["document"])
+            if len(rows) < LIST_BATCH_SIZE:
+                return
+            last_user_id = rows[-1]["user_id"]
+
+    # Reminders
+    async def set_reminders(self, user_id, reminders):
+        rows = [{"id": new_document_id(), **reminder} for reminder in reminders]
+
+        def replace(connection):
+            with transaction(connection):
+                connection.execute(DELETE_REMINDERS, (user_id,))
+                connection.executemany(INSERT_REMINDER, rows)
+
+        await self._run("set_reminders", replace)
+
+    async def count_reminders(self):
+        return await self._run("count_reminders", lambda c: c.execute(COUNT_REMINDERS).fetchone()[0])
+
+    async def claim_due_reminders(self, minute, token, stale_before):
+        def claim(connection):
+            with transaction(connection):
+                connection.execute(CLAIM_DUE_REMINDERS, (token, minute, minute, stale_before))
+
+        await self._run("claim_due_reminders", claim)
+
+    async def claimed_reminders(self, token, limit):
+        rows = await self._run("claimed_reminders", lambda c: c.execute(CLAIMED_REMINDERS, (token, limit)).fetchall())
+        return [reminder_document(row) for row in rows]
+
+    async def reschedule_reminders(self, next_fires):
+        def reschedule(connection):
+            with transaction(connection):
+                connection.executemany(RESCHEDULE_REMINDER, [(next_fire, _id) for _id, next_fire in next_fires])
+
+        await self._run("reschedule_reminders", reschedule)
+
+    # Practice events
+    async def append_practice_event(self, event):
+        row = {**event, "id": new_document_id(), "compacted": int(event.get("compacted", False))}
+        await self._run("append_practice_event", lambda c: c.execute(INSERT_PRACTICE_EVENT, row))
+        event["_id"] = row["id"]
+
+    async def unfolded_practice_events(self, user_id, day, after_seq):
+        rows = await self._run("unfolded_practice_events", lambda c: c.execute(
+            UNFOLDED_PRACTICE_EVENTS, (user_id, day, after_seq)).fetchall())
+        return [practice_event_document(row) for row in rows]
+
+    async def pending_practice_events(self, before_seq, limit):
+        rows = await self._run("pending_practice_events", lambda c: c.execute(
+            PENDING_PRACTICE_EVENTS, (before_seq, limit)).fetchall())
+        return [practice_event_document(row) for row in rows]
+
+    async def fold_practice_events(self, user_id, day, events, total):
+        def fold(connection):
+            with transaction(connection):
+                row = connection.execute(GET_PROGRESS, (user_id, day)).fetchone()
+                folded_seq = row["folded_seq"] if row else 0
+                unfolded = [event for event in events if event["seq"] > folded_seq]
+                if not unfolded:
+                    return None, 0
+                progress = self._mark_day(
+                    connection, user_id, day, [event["affirmation_id"] for event in unfolded], total, len(unfolded),
+                    folded_seq=unfolded[-1]["seq"],
+                )
+                return progress, len(unfolded)
+
+        return await self._run("fold_practice_events", fold)
+
+    async def mark_practice_events_compacted(self, event_ids):
+        def mark(connection):
+            with transaction(connection):
+                connection.executemany(MARK_PRACTICE_EVENT_COMPACTED, [(event_id,) for event_id in event_ids])
+
+        await self._run("mark_practice_events_compacted", mark)
+
+    # Sync
+    async def changes_since(self, user_id, since):
+        def changes(connection):
+            if since is None:
+                affirmations = connection.execute(ALL_AFFIRMATIONS, (user_id,)).fetchall()
+                progress = connection.execute(ALL_PROGRESS_DAYS, (user_id,)).fetchall()
+                deleted = []
+            else:
+                affirmations = connection.execute(CHANGED_AFFIRMATIONS, (user_id, since)).fetchall()
+                progress = connection.execute(CHANGED_PROGRESS, (user_id, since)).fetchall()
+                deleted = [row["document_id"] for row in connection.execute(
+                    DELETED_DOCUMENTS, (user_id, since, "affirmations"))]
+            row = connection.execute(GET_SETTINGS, (user_id,)).fetchone()
+            settings = json.loads(row["document"]) if row else None
+            if settings is not None and since is not None and settings.get("seq", 0) <= since:
+                settings = None
+            return affirmations, progress, deleted, settings
+
+        # One call on the storage thread reads all of it
+        affirmations, progress, deleted, settings = await self._run("changes_since", changes)
+        return {
+            "affirmations": [affirmation_document(row) for row in affirmations],
+            "deleted_affirmations": deleted,
+            "progress": [progress_document(row) for row in progress],
+            "settings": settings,
+        }
@@ -0,0 +1,837 @@
+"""Storage backends for the API's per-user data.
+
+server.py reads and writes affirmations, daily progress, rollups and
+settings through a Storage, so the same routes run on either backend.
+STORAGE_BACKEND selects one:
+
+    mongo   (default) a MongoDB server at MONGO_URL, database DB_NAME; pool
+            settings come from database.py
+    sqlite  an embedded SQLite file at SQLITE_PATH (default manifest.db), in
+            WAL mode; see sqlite_storage.py
+
+Documents keep the MongoDB shape on both backends ("_id", "order",
+"completed_affirmations", ...), and ids are ObjectId hex strings on both,
+so the response helpers and cursors in server.py don't care which one
+produced them.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from indexes import ensure_indexes, explain_queries
+from rollups import get_summary, rebuild_rollups, record_progress_many
+from streaks import recompute_streaks
+
+logger = logging.getLogger(__name__)
+
+# Data written before users existed belongs to this user
+DEFAULT_USER_ID = "default"
+
+# Listings are read from the database in batches of this many documents
+LIST_BATCH_SIZE = 500
+
+
+def is_document_id(value: str) -> bool:
+    return ObjectId.is_valid(value)
+
+
+def new_document_id() -> str:
+    return str(ObjectId())
+
+
+# Every write stamps the documents it touches with "seq", a change sequence
+# in wall-clock microseconds that strictly increases within the process.
+# Deleted affirmations leave a tombstone with the sequence of the delete.
+_last_sequence = 0
+# SQLite statements take sequences on their executor threads
+_sequence_lock = threading.Lock()
+
+
+def next_sequence() -> int:
+    global _last_sequence
+    with _sequence_lock:
+        _last_sequence = max(time.time_ns() // 1000, _last_sequence + 1)
+        return _last_sequence
+
+
+def reserve_sequences(count: int) -> int:
+    """The first of `count` consecutive sequences, none of which is handed out again.
+
+    Later sequences sort after the whole range, even while it runs ahead of the clock.
+    """
+    global _last_sequence
+    with _sequence_lock:
+        first = max(time.time_ns() // 1000, _last_sequence + 1)
+        _last_sequence = first + count - 1
+        return first
+
+
+def sync_token(since: Optional[int], grace_ms: float) -> int:
+    """The token a sync that starts now hands back.
+
+    Writes take their sequence before they land, so a write may still be in
+    flight with a sequence just below the current time; the token trails the
+    clock by `grace_ms` so the next sync picks such writes up. Changes inside
+    that window are sent twice, which clients apply idempotently.
+    """
+    return max(since or 0, time.time_ns() // 1000 - int(grace_ms * 1000))
+
+
+# Affirmations sort by sparse integer orders. Reordering spaces them
+# ORDER_GAP apart, so moving one affirmation takes the midpoint of its new
+# neighbours and writes only that document; when a gap runs out the list is
+# renumbered. New affirmations take the current sequence as their order, which
+# appends them without reading the list first.
+ORDER_GAP = 1024
+
+# A rebalance holds the user's list at most this long; one that died
+# mid-way stops blocking moves after it
+REBALANCE_TIMEOUT_US = 30 * 1000 * 1000
+# How long a move waits for a running rebalance before giving up
+MOVE_WAIT_SECONDS = 10.0
+
+
+def order_between(previous: Optional[int], following: Optional[int]) -> Optional[int]:
+    """An order sorting strictly between two neighbours, None standing for either end of the list.
+
+    Returns None when the neighbours have no room left between them.
+    """
+    if previous is None:
+        return following - ORDER_GAP if following is not None else 0
+    if following is None:
+        return previous + ORDER_GAP
+    if following - previous < 2:
+        return None
+    return (previous + following) // 2
+
+
+def order_gap(previous: Optional[int], order: int, following: Optional[int]) -> int:
+    """The smaller of the gaps left on either side of `order`."""
+    gaps = [order - previous if previous is not None else ORDER_GAP,
+            following - order if following is not None else ORDER_GAP]
+    return min(gaps)
+
+
+class Storage:
+    """Interface for the API's per-user data.
+
+    Every method is scoped to one user; a document id that belongs to
+    another user behaves like one that doesn't exist.
+    """
+
+    name = ""
+
+    async def prepare(self) -> None:
+        """Create tables or indexes and migrate older data; run once at startup."""
+
+    async def close(self) -> None:
+        pass
+
+    def describe(self) -> dict:
+        """Operation counts for /api/diagnostics/db."""
+        return {}
+
+    async def explain_queries(self) -> List[dict]:
+        """Every registered query with its plan stages and whether it scans a whole table."""
+        raise NotImplementedError
+
+    # Affirmations
+    def list_affirmations(
+        self, user_id: str, fields: List[str], after: Optional[Tuple[int, Optional[str]]] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[dict]:
+        """Affirmations in (order, _id) order, starting after the `after` keyset.
+
+        Documents carry "_id", "order" and the requested `fields`.
+        """
+        raise NotImplementedError
+
+    async def count_affirmations(self, user_id: str, is_example: Optional[bool] = None) -> int:
+        raise NotImplementedError
+
+    async def insert_affirmation(self, affirmation: dict) -> str:
+        """Insert one affirmation and return its new id."""
+        raise NotImplementedError
+
+    async def insert_affirmations(self, affirmations: List[dict]) -> List[str]:
+        """Insert in one ordered batch; returns the new ids in the same order."""
+        raise NotImplementedError
+
+    async def update_affirmation(
+        self, user_id: str, affirmation_id: str, fields: dict, unset: List[str] = (),
+    ) -> Optional[dict]:
+        """Set `fields` (and drop `unset`) and return the updated document."""
+        raise NotImplementedError
+
+    async def delete_affirmation(self, user_id: str, affirmation_id: str) -> bool:
+        raise NotImplementedError
+
+    async def set_affirmation_orders(self, user_id: str, affirmation_ids: List[str]) -> None:
+        """Order the listed affirmations as listed, ORDER_GAP apart."""
+        raise NotImplementedError
+
+    async def move_affirmation(
+        self, user_id: str, affirmation_id: str, anchor_id: str, after: bool,
+    ) -> Optional[Tuple[dict, int]]:
+        """Place an affirmation right after (or before) `anchor_id` by changing its order alone.
+
+        Returns the moved document and order_gap() around its new order, or
+        None if either affirmation doesn't exist. Renumbers the list first
+        when the new neighbours have no room between them.
+        """
+        raise NotImplementedError
+
+    async def rebalance_affirmation_orders(self, user_id: str) -> int:
+        """Respace the user's affirmations ORDER_GAP apart, keeping their order; returns how many there are."""
+        raise NotImplementedError
+
+    def affirmations_with_inline_images(self) -> AsyncIterator[dict]:
+        """Every user's affirmations still carrying a data URL in "image"."""
+        raise NotImplementedError
+
+    async def replace_inline_image(self, affirmation_id, image_hash: str) -> None:
+        raise NotImplementedError
+
+    # Daily progress
+    async def get_progress(self, user_id: str, day: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def get_or_create_progress(self, user_id: str, day: str, total: int) -> dict:
+        raise NotImplementedError
+
+    async def mark_complete(self, user_id: str, day: str, affirmation_ids: List[str], total: int,
+                            practice_delta: int = 1) -> dict:
+        """Atomically add `affirmation_ids` to the day's completions and count the practice."""
+        raise NotImplementedError
+
+    async def mark_complete_days(self, user_id: str, completed_by_date: Dict[str, List[str]],
+                                 practice_counts: Dict[str, int], total: int) -> List[dict]:
+        """mark_complete for several days at once; returns the days in date order."""
+        raise NotImplementedError
+
+    def progress_history(self, user_id: str, before: Optional[str], limit: int) -> AsyncIterator[dict]:
+        """Newest days first, strictly before `before` if given."""
+        raise NotImplementedError
+
+    async def insert_progress(self, progress: List[dict]) -> None:
+        """Write days in one batch, replacing any day the user already has."""
+        raise NotImplementedError
+
+    # Rollups and streaks
+    async def record_progress(self, updates: List[Tuple[dict, int]]) -> None:
+        """Fold updated days (with their practice deltas) into the week and month rollups."""
+        raise NotImplementedError
+
+    async def progress_summary(self, user_id: str, granularity: str, periods: int) -> List[dict]:
+        raise NotImplementedError
+
+    async def rebuild_rollups(self, user_id: Optional[str] = None) -> int:
+        raise NotImplementedError
+
+    async def recompute_streak(self, user_id: str) -> dict:
+        raise NotImplementedError
+
+    # Settings
+    async def load_settings(self, user_id: str, defaults: dict) -> Tuple[dict, bool]:
+        """Get the user's settings, creating them from `defaults` on first use; True if this call created them."""
+        raise NotImplementedError
+
+    async def update_settings(self, user_id: str, fields: dict) -> dict:
+        raise NotImplementedError
+
+    def all_settings(self) -> AsyncIterator[dict]:
+        """Every user's settings; only for one-off backfills."""
+        raise NotImplementedError
+
+    # Reminders, which unlike everything else are read across users by fire time
+    async def set_reminders(self, user_id: str, reminders: List[dict]) -> None:
+        """Replace the user's reminders (see notifications.reminders_from_settings)."""
+        raise NotImplementedError
+
+    async def count_reminders(self) -> int:
+        raise NotImplementedError
+
+    async def claim_due_reminders(self, minute: int, token: str, stale_before: int) -> None:
+        """Claim for `token` every reminder due by `minute` that is unclaimed, or claimed before `stale_before`."""
+        raise NotImplementedError
+
+    async def claimed_reminders(self, token: str, limit: int) -> List[dict]:
+        raise NotImplementedError
+
+    async def reschedule_reminders(self, next_fires: List[Tuple[object, int]]) -> None:
+        """Set each (reminder _id, next_fire) pair and release its claim."""
+        raise NotImplementedError
+
+    # Practice events, an append-only log that practice_log.PracticeCompactor
+    # folds into daily progress. Each day records in "folded_seq" the sequence
+    # of the last event folded into it.
+    async def append_practice_event(self, event: dict) -> None:
+        raise NotImplementedError
+
+    async def unfolded_practice_events(self, user_id: str, day: str, after_seq: int) -> List[dict]:
+        """The day's events with a sequence after `after_seq`, oldest first.
+
+        Readers merge these on every read of the day, so only "affirmation_id"
+        and "seq" are required.
+        """
+        raise NotImplementedError
+
+    async def pending_practice_events(self, before_seq: int, limit: int) -> List[dict]:
+        """Events across users not yet marked compacted, sequenced before `before_seq`, oldest first."""
+        raise NotImplementedError
+
+    async def fold_practice_events(self, user_id: str, day: str, events: List[dict],
+                                   total: int) -> Tuple[Optional[dict], int]:
+        """Apply the `events` (oldest first) sequenced after the day's folded_seq, like mark_complete.
+
+        Returns the updated day and how many events were applied, or
+        (None, 0) if every one of them was folded already.
+        """
+        raise NotImplementedError
+
+    async def mark_practice_events_compacted(self, event_ids: List[object]) -> None:
+        raise NotImplementedError
+
+    # Sync
+    async def changes_since(self, user_id: str, since: Optional[int]) -> dict:
+        """Documents written after sequence `since`, and ids of affirmations deleted since.
+
+        Returns {"affirmations", "deleted_affirmations", "progress", "settings"};
+        settings is None when unchanged. With `since` None, every affirmation
+        (in list order) and every day, and no deletions.
+        """
+        raise NotImplementedError
+
+
+def object_id(value) -> Optional[ObjectId]:
+    if isinstance(value, ObjectId):
+        return value
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+
+def mark_complete_pipeline(affirmation_ids: List[str], total: int, practice_delta: int = 1) -> list:
+    # Aggregation-pipeline update, so the percentage is computed from the updated list.
+    # One stage per id appends it only if it isn't already there.
+    return [
+        {"$set": {
+            "completed_affirmations": {"$ifNull": ["$completed_affirmations", []]},
+            "practice_count": {"$add": [{"$ifNull": ["$practice_count", 0]}, practice_delta]},
+            "total_affirmations": total,
+            "seq": next_sequence()
+        }},
+        *[
+            {"$set": {
+                "completed_affirmations": {
+                    "$cond": [
+                        {"$in": [affirmation_id, "$completed_affirmations"]},
+                        "$completed_affirmations",
+                        {"$concatArrays": ["$completed_affirmations", [affirmation_id]]}
+                    ]
+                }
+            }}
+            for affirmation_id in affirmation_ids
+        ],
+        {"$set": {
+            "completion_percentage": (
+                {"$multiply": [{"$divide": [{"$size": "$completed_affirmations"}, total]}, 100]}
+                if total > 0 else 0
+            )
+        }}
+    ]
+
+
+def apply_completions(progress: dict, affirmation_ids: List[str], total: int, practice_delta: int) -> dict:
+    """What mark_complete_pipeline does to a progress document, in Python."""
+    completed = list(progress["completed_affirmations"])
+    for affirmation_id in affirmation_ids:
+        if affirmation_id not in completed:
+            completed.append(affirmation_id)
+    return {
+        **progress,
+        "completed_affirmations": completed,
+        "practice_count": progress["practice_count"] + practice_delta,
+        "total_affirmations": total,
+        "completion_percentage": len(completed) / total * 100 if total > 0 else 0,
+    }
+
+
+class MongoStorage(Storage):
+    name = "mongo"
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.db = db
+
+    async def prepare(self) -> None:
+        # Data written before users existed belongs to the default user; this has
+        # to happen before the (user_id, ...) unique indexes are built
+        for collection in ("affirmations", "daily_progress", "settings"):
+            result = await self.db[collection].update_many(
+                {"user_id": {"$exists": False}}, {"$set": {"user_id": DEFAULT_USER_ID}}
+            )
+            if result.modified_count:
+                logger.info("Assigned %d %s documents to the default user", result.modified_count, collection)
+        await self._merge_duplicates()
+        await ensure_indexes(self.db)
+        await self._backfill_rollups()
+
+    async def _merge_duplicates(self) -> None:
+        # Upserts raced into duplicate days and settings before the unique
+        # indexes existed; each is merged into one document so they can be built
+        def duplicates(collection, key):
+            return self.db[collection].aggregate([
+                {"$group": {"_id": {field: f"${field}" for field in key}, "ids": {"$push": "$_id"}}},
+                {"$match": {"ids.1": {"$exists": True}}},
+            ], allowDiskUse=True)
+
+        merged_users = set()
+        async for group in duplicates("daily_progress", ("user_id", "date")):
+            days = await self.db.daily_progress.find({"_id": {"$in": group["ids"]}}).sort("seq", 1).to_list(None)
+            # Every completion and every practice counted once
+            progress = {
+                **days[0], "completed_affirmations": [], "practice_count": 0,
+                "total_affirmations": max(day.get("total_affirmations", 0) for day in days),
+            }
+            for day in days:
+                progress = apply_completions(
+                    progress, day.get("completed_affirmations", []), progress["total_affirmations"],
+                    day.get("practice_count", 0),
+                )
+            folded = [day["folded_seq"] for day in days if "folded_seq" in day]
+            if folded:
+                progress["folded_seq"] = max(folded)
+            progress["seq"] = next_sequence()
+            await self.db.daily_progress.replace_one({"_id": progress["_id"]}, progress)
+            await self.db.daily_progress.delete_many({"_id": {"$in": [day["_id"] for day in days[1:]]}})
+            merged_users.add(progress["user_id"])
+            logger.warning("Merged %d copies of %s's progress on %s", len(days), progress["user_id"], progress["date"])
+        for user_id in merged_users:
+            await self.rebuild_rollups(user_id)
+
+        async for group in duplicates("settings", ("user_id",)):
+            # The most recently saved settings win
+            newest = await self.db.settings.find_one({"_id": {"$in": group["ids"]}}, sort=[("seq", -1)])
+            await self.db.settings.delete_many({"_id": {"$in": group["ids"], "$ne": newest["_id"]}})
+            logger.warning("Kept the newest of %d copies of %s's settings", len(group["ids"]), newest["user_id"])
+
+    async def _backfill_rollups(self) -> None:
+        # History written before rollups existed, or rollups written before users did
+        stale = await self.db.progress_rollups.find_one({"user_id": {"$exists": False}}, {"_id": 1})
+        if stale:
+            await self.db.progress_rollups.delete_many({"user_id": {"$exists": False}})
+        missing = (
+            not await self.db.progress_rollups.find_one({}, {"_id": 1})
+            and await self.db.daily_progress.find_one({}, {"_id": 1})
+        )
+        if stale or missing:
+            logger.info("Rebuilt %d progress rollups", await rebuild_rollups(self.db))
+
+    async def close(self) -> None:
+        self.db.client.close()
+
+    async def explain_queries(self) -> List[dict]:
+        return await explain_queries(self.db)
+
+    def list_affirmations(self, user_id, fields, after=None, limit=None):
+        # Keyset pagination on (order, _id); _id breaks ties between equal orders
+        query = {"user_id": user_id}
+        if after is not None:
+            after_order, after_id = after
+            page = {"order": {"$gt": after_order}}
+            if after_id:
+                page = {"$or": [page, {"order": after_order, "_id": {"$gt": ObjectId(after_id)}}]}
+            query.update(page)
+        projection = {**{field: 1 for field in fields}, "order": 1}
+        cursor = self.db.affirmations.find(query, projection).sort([("order", 1), ("_id", 1)])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return cursor.batch_size(limit or LIST_BATCH_SIZE)
+
+    async def count_affirmations(self, user_id, is_example=None):
+        query = {"user_id": user_id}
+        if is_example is not None:
+            query["is_example"] = is_example
+        return await self.db.affirmations.count_documents(query)
+
+    async def insert_affirmation(self, affirmation):
+        result = await self.db.affirmations.insert_one({**affirmation, "seq": next_sequence()})
+        return str(result.inserted_id)
+
+    async def insert_affirmations(self, affirmations):
+        result = await self.db.affirmations.insert_many([{**a, "seq": next_sequence()} for a in affirmations])
+        return [str(_id) for _id in result.inserted_ids]
+
+    async def update_affirmation(self, user_id, affirmation_id, fields, unset=()):
+        _id = object_id(affirmation_id)
+        if _id is None:
+            return None
+        update = {"$set": {**fields, "seq": next_sequence()}}
+        if unset:
+            update["$unset"] = {field: "" for field in unset}
+        return await self.db.affirmations.find_one_and_update(
+            {"_id": _id, "user_id": user_id}, update, return_document=ReturnDocument.AFTER
+        )
+
+    async def delete_affirmation(self, user_id, affirmation_id):
+        _id = object_id(affirmation_id)
+        if _id is None:
+            return False
+        result = await self.db.affirmations.delete_one({"_id": _id, "user_id": user_id})
+        if not result.deleted_count:
+            return False
+        await self.db.tombstones.insert_one({
+            "user_id": user_id, "collection": "affirmations", "document_id": str(_id), "seq": next_sequence(),
+        })
+        return True
+
+    async def set_affirmation_orders(self, user_id, affirmation_ids):
+        ids = [_id for _id in (object_id(a) for a in affirmation_ids) if _id is not None]
+
+        async def requested():
+            return ids
+
+        # Waits out a rebalance of the same list, then applies the requested order over it
+        deadline = time.monotonic() + MOVE_WAIT_SECONDS
+        while await self._respace_affirmations(user_id, requested) is None:
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"Could not reorder affirmations of {user_id}")
+            await asyncio.sleep(0.01)
+
+    async def _neighbour_order(self, user_id, anchor, exclude, after) -> Optional[int]:
+        # The affirmation next to the anchor on one side, in (order, _id) order
+        compare, direction = ("$gt", 1) if after else ("$lt", -1)
+        neighbour = await self.db.affirmations.find_one(
+            {
+                "user_id": user_id,
+                "_id": {"$ne": exclude},
+                "$or": [{"order": {compare: anchor["order"]}}, {"order": anchor["order"], "_id": {compare: anchor["_id"]}}],
+            },
+            {"order": 1},
+            sort=[("order", direction), ("_id", direction)],
+        )
+        return neighbour["order"] if neighbour else None
+
+    async def move_affirmation(self, user_id, affirmation_id, anchor_id, after):
+        _id, anchor_id = object_id(affirmation_id), object_id(anchor_id)
+        if _id is None or anchor_id is None:
+            return None
+        # Tried again after renumbering a full gap, when the moved affirmation
+        # changed between reading its seq and writing, or while a rebalance holds the list
+        deadline = time.monotonic() + MOVE_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            documents = {
+                document["_id"]: document async for document in self.db.affirmations.find(
+                    {"_id": {"$in": [_id, anchor_id]}, "user_id": user_id}, {"order": 1, "seq": 1}
+                )
+            }
+            if len(documents) < 2:
+                return None
+            anchor = documents[anchor_id]
+            neighbour = await self._neighbour_order(user_id, anchor, _id, after)
+            previous, following = (anchor["order"], neighbour) if after else (neighbour, anchor["order"])
+            order = order_between(previous, following)
+            if order is None:
+                await self.rebalance_affirmation_orders(user_id)
+                continue
+            moved = await self.db.affirmations.find_one_and_update(
+                {
+                    "_id": _id, "user_id": user_id, "seq": documents[_id].get("seq"),
+                    "$or": [
+                        {"rebalancing": {"$exists": False}},
+                        {"rebalancing": {"$lt": next_sequence() - REBALANCE_TIMEOUT_US}},
+                    ],
+                },
+                {"$set": {"order": order, "seq": next_sequence()}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if moved:
+                return moved, order_gap(previous, order, following)
+            await asyncio.sleep(0.01)
+        raise RuntimeError(f"Could not move affirmation {affirmation_id}")
+
+    async def rebalance_affirmation_orders(self, user_id):
+        async def current():
+            cursor = self.db.affirmations.find({"user_id": user_id}, {"_id": 1}).sort([("order", 1), ("_id", 1)])
+            return [a["_id"] async for a in cursor]
+
+        count = await self._respace_affirmations(user_id, current)
+        # Another rebalance of this user was running and leaves the list respaced
+        return count if count is not None else await self.count_affirmations(user_id)
+
+    async def _respace_affirmations(self, user_id, read_ids) -> Optional[int]:
+        # Moves only write to unmarked affirmations, so once every affirmation
+        # is marked the list can't change under read_ids: a move either landed
+        # before its affirmation was marked, and is read, or waits until the
+        # marks are cleared. The lock keeps respacings of one user from
+        # interleaving; None when another one holds it.
+        started = next_sequence()
+        lock = {"_id": f"rebalance:{user_id}", "expires": started + REBALANCE_TIMEOUT_US}
+        try:
+            await self.db.counters.update_one(
+                {"_id": lock["_id"], "expires": {"$lt": started}}, {"$set": {"expires": lock["expires"]}}, upsert=True,
+            )
+        except DuplicateKeyError:
+            return None
+        try:
+            await self.db.affirmations.update_many({"user_id": user_id}, {"$set": {"rebalancing": started}})
+            affirmation_ids = await read_ids()
+            if affirmation_ids:
+                await self.db.affirmations.bulk_write([
+                    UpdateOne(
+                        {"_id": _id, "user_id": user_id},
+                        {"$set": {"order": index * ORDER_GAP, "seq": next_sequence()}, "$unset": {"rebalancing": ""}},
+                    )
+                    for index, _id in enumerate(affirmation_ids)
+                ])
+            return len(affirmation_ids)
+        finally:
+            # Affirmations left out of the ids, or all of them after a failure
+            await self.db.affirmations.update_many(
+                {"user_id": user_id, "rebalancing": started}, {"$unset": {"rebalancing": ""}}
+            )
+            await self.db.counters.delete_one(lock)
+
+    def affirmations_with_inline_images(self):
+        return self.db.affirmations.find({"image": {"$type": "string"}}, {"image": 1, "user_id": 1})
+
+    async def replace_inline_image(self, affirmation_id, image_hash):
+        await self.db.affirmations.update_one(
+            {"_id": object_id(affirmation_id)},
+            {"$set": {"image_hash": image_hash, "seq": next_sequence()}, "$unset": {"image": ""}}
+        )
+
+    async def get_progress(self, user_id, day):
+        return await self.db.daily_progress.find_one({"user_id": user_id, "date": day})
+
+    async def get_or_create_progress(self, user_id, day, total):
+        # Get or create the day's progress in one round trip
+        try:
+            return await self.db.daily_progress.find_one_and_update(
+                {"user_id": user_id, "date": day},
+                {"$setOnInsert": {
+                    "completed_affirmations": [],
+                    "total_affirmations": total,
+                    "completion_percentage": 0.0,
+                    "practice_count": 0,
+                    "seq": next_sequence()
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return await self.db.daily_progress.find_one({"user_id": user_id, "date": day})
+
+    async def mark_complete(self, user_id, day, affirmation_ids, total, practice_delta=1):
+        # Single atomic upsert: concurrent taps can't lose increments or completions
+        try:
+            return await self.db.daily_progress.find_one_and_update(
+                {"user_id": user_id, "date": day},
+                mark_complete_pipeline(affirmation_ids, total, practice_delta),
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Lost an upsert race for a new day; the document exists now
+            return await self.db.daily_progress.find_one_and_update(
+                {"user_id": user_id, "date": day},
+                mark_complete_pipeline(affirmation_ids, total, practice_delta),
+                return_document=ReturnDocument.AFTER
+            )
+
+    async def mark_complete_days(self, user_id, completed_by_date, practice_counts, total):
+        dates = list(completed_by_date)
+
+        def day_update(day: str, upsert: bool) -> UpdateOne:
+            return UpdateOne(
+                {"user_id": user_id, "date": day},
+                mark_complete_pipeline(completed_by_date[day], total, practice_counts[day]),
+                upsert=upsert
+            )
+
+        # One bulk write for every affected day
+        try:
+            await self.db.daily_progress.bulk_write([day_update(day, True) for day in dates], ordered=False)
+        except BulkWriteError as e:
+            # Days whose upsert lost a race were created meanwhile; apply those as plain updates
+            lost = [dates[error["index"]] for error in e.details["writeErrors"] if error["code"] == 11000]
+            if len(lost) != len(e.details["writeErrors"]):
+                raise
+            await self.db.daily_progress.bulk_write([day_update(day, False) for day in lost], ordered=False)
+
+        cursor = self.db.daily_progress.find({"user_id": user_id, "date": {"$in": dates}}).sort("date", 1)
+        return await cursor.to_list(len(dates))
+
+    def progress_history(self, user_id, before, limit):
+        query = {"user_id": user_id, "date": {"$lt": before}} if before else {"user_id": user_id}
+        return self.db.daily_progress.find(query).sort("date", -1).limit(limit)
+
+    async def insert_progress(self, progress):
+        # Upserts on the (user_id, date) unique index, in order. A replaced
+        # day already accounts for the practice events logged before it.
+        if progress:
+            requests = []
+            for day in progress:
+                seq = next_sequence()
+                requests.append(ReplaceOne(
+                    {"user_id": day["user_id"], "date": day["date"]}, {**day, "seq": seq, "folded_seq": seq}, upsert=True,
+                ))
+            await self.db.daily_progress.bulk_write(requests)
+
+    async def record_progress(self, updates):
+        await record_progress_many(self.db, updates)
+
+    async def progress_summary(self, user_id, granularity, periods):
+        return await get_summary(self.db, user_id, granularity, periods)
+
+    async def rebuild_rollups(self, user_id=None):
+        return await rebuild_rollups(self.db, user_id)
+
+    async def recompute_streak(self, user_id):
+        return await recompute_streaks(self.db, user_id)
+
+    async def load_settings(self, user_id, defaults):
+        # Get or create the user's settings in one round trip; the document
+        # before the upsert is None only for the call that created it
+        created = {
+            "_id": ObjectId(), **defaults, "notification_times": list(defaults["notification_times"]),
+            "seq": next_sequence(),
+        }
+        try:
+            existing = await self.db.settings.find_one_and_update(
+                {"user_id": user_id},
+                {"$setOnInsert": created},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            return await self.db.settings.find_one({"user_id": user_id}), False
+        if existing is None:
+            return {**created, "user_id": user_id}, True
+        return existing, False
+
+    async def update_settings(self, user_id, fields):
+        return await self.db.settings.find_one_and_update(
+            {"user_id": user_id},
+            {"$set": {**fields, "seq": next_sequence()}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def all_settings(self):
+        return self.db.settings.find({}).batch_size(LIST_BATCH_SIZE)
+
+    async def set_reminders(self, user_id, reminders):
+        await self.db.reminders.delete_many({"user_id": user_id})
+        if reminders:
+            await self.db.reminders.insert_many([dict(reminder) for reminder in reminders])
+
+    async def count_reminders(self):
+        return await self.db.reminders.estimated_document_count()
+
+    async def claim_due_reminders(self, minute, token, stale_before):
+        # Unclaimed reminders have no "claim", so the sparse claim index holds only in-flight ones
+        await self.db.reminders.update_many(
+            {
+                "next_fire": {"$lte": minute},
+                "$or": [{"claim": {"$exists": False}}, {"claimed_at": {"$lt": stale_before}}],
+            },
+            {"$set": {"claim": token, "claimed_at": minute}},
+        )
+
+    async def claimed_reminders(self, token, limit):
+        return await self.db.reminders.find({"claim": token}).limit(limit).to_list(None)
+
+    async def reschedule_reminders(self, next_fires):
+        if next_fires:
+            await self.db.reminders.bulk_write([
+                UpdateOne({"_id": _id}, {"$set": {"next_fire": next_fire}, "$unset": {"claim": "", "claimed_at": ""}})
+                for _id, next_fire in next_fires
+            ], ordered=False)
+
+    async def append_practice_event(self, event):
+        await self.db.practice_events.insert_one(event)
+
+    async def unfolded_practice_events(self, user_id, day, after_seq):
+        cursor = self.db.practice_events.find(
+            {"user_id": user_id, "date": day, "seq": {"$gt": after_seq}}, {"_id": 0, "affirmation_id": 1, "seq": 1}
+        ).sort("seq", 1)
+        return await cursor.to_list(None)
+
+    async def pending_practice_events(self, before_seq, limit):
+        cursor = self.db.practice_events.find({"compacted": False, "seq": {"$lt": before_seq}}).sort("seq", 1)
+        return await cursor.to_list(limit)
+
+    async def fold_practice_events(self, user_id, day, events, total):
+        for _ in range(3):
+            current = await self.db.daily_progress.find_one({"user_id": user_id, "date": day}, {"folded_seq": 1})
+            folded_seq = current.get("folded_seq") if current else None
+            unfolded = [event for event in events if event["seq"] > (folded_seq or 0)]
+            if not unfolded:
+                return None, 0
+            pipeline = mark_complete_pipeline([event["affirmation_id"] for event in unfolded], total, len(unfolded))
+            pipeline.append({"$set": {"folded_seq": unfolded[-1]["seq"]}})
+            try:
+                # Conditional on the watermark read above, so concurrent compactors can't both apply an event
+                progress = await self.db.daily_progress.find_one_and_update(
+                    {"user_id": user_id, "date": day, "folded_seq": folded_seq},
+                    pipeline,
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+                return progress, len(unfolded)
+            except DuplicateKeyError:
+                # The watermark moved, or the day was created, since the read
+                continue
+        raise RuntimeError(f"Could not fold practice events into {day} for {user_id}")
+
+    async def mark_practice_events_compacted(self, event_ids):
+        await self.db.practice_events.update_many({"_id": {"$in": event_ids}}, {"$set": {"compacted": True}})
+
+    async def changes_since(self, user_id, since):
+        scope = {"user_id": user_id}
+        if since is None:
+            affirmations = self.db.affirmations.find(scope).sort([("order", 1), ("_id", 1)])
+            progress = self.db.daily_progress.find(scope).sort("date", 1)
+        else:
+            scope["seq"] = {"$gt": since}
+            affirmations = self.db.affirmations.find(scope).sort("seq", 1)
+            progress = self.db.daily_progress.find(scope).sort("seq", 1)
+        reads = [affirmations.to_list(None), progress.to_list(None), self.db.settings.find_one(scope)]
+        if since is not None:
+            reads.append(self.db.tombstones.find({**scope, "collection": "affirmations"}).to_list(None))
+        # Independent indexed reads, so together they cost about one round trip
+        affirmations, progress, settings, *tombstones = await asyncio.gather(*reads)
+        return {
+            "affirmations": affirmations,
+            "deleted_affirmations": [t["document_id"] for t in tombstones[0]] if tombstones else [],
+            "progress": progress,
+            "settings": settings,
+        }
+
+
+def create_storage(event_listeners: list = (), slow_query_ms: Optional[float] = None) -> Storage:
+    backend = os.environ.get("STORAGE_BACKEND", "mongo")
+    if backend == "sqlite":
+        from sqlite_storage import SQLiteStorage
+
+        return SQLiteStorage(
+            os.environ.get("SQLITE_PATH", "manifest.db"),
+            threads=int(os.environ.get("SQLITE_THREADS", "4")),
+            slow_query_ms=slow_query_ms,
+        )
+    if backend == "mongo":
+        from database import create_client
+
+        client = create_client(os.environ["MONGO_URL"], event_listeners=list(event_listeners))
+        return MongoStorage(client[os.environ["DB_NAME"]])
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
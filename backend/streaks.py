@@ -0,0 +1,97 @@
+import logging
+from datetime import date
+from typing import Iterable
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# A day counts towards the streak once every affirmation was completed
+COMPLETE_FILTER = {"completion_percentage": {"$gte": 100}}
+
+EMPTY_STREAK = {"current_streak": 0, "longest_streak": 0, "last_practice_date": None}
+
+
+def streak_state(settings: dict) -> dict:
+    return {key: settings.get(key, default) for key, default in EMPTY_STREAK.items()}
+
+
+def advance(state: dict, day: str) -> dict:
+    """Apply one completed day to a streak state in O(1).
+
+    Days at or before last_practice_date leave the state untouched; a
+    completion written out of order is only picked up by a recompute.
+    """
+    last_practice = state["last_practice_date"]
+    current_streak = state["current_streak"]
+    if last_practice:
+        days_diff = (date.fromisoformat(day) - date.fromisoformat(last_practice)).days
+        if days_diff <= 0:
+            return dict(state)
+        # Consecutive day extends the streak, a gap starts a new one
+        current_streak = current_streak + 1 if days_diff == 1 else 1
+    else:
+        current_streak = 1
+    return {
+        "current_streak": current_streak,
+        "longest_streak": max(current_streak, state["longest_streak"]),
+        "last_practice_date": day,
+    }
+
+
+def streak_from_days(days: Iterable[str]) -> dict:
+    """Fold completed days (ascending, unique) into a streak state."""
+    state = dict(EMPTY_STREAK)
+    for day in days:
+        state = advance(state, day)
+    return state
+
+
+async def recompute_with_scan(db: AsyncIOMotorDatabase, user_id: str) -> dict:
+    # One indexed cursor over the completed days, folded client-side
+    cursor = db.daily_progress.find({"user_id": user_id, **COMPLETE_FILTER}, {"_id": 0, "date": 1}).sort("date", 1)
+    state = dict(EMPTY_STREAK)
+    async for progress in cursor:
+        state = advance(state, progress["date"])
+    return state
+
+
+async def recompute_with_aggregation(db: AsyncIOMotorDatabase, user_id: str) -> dict:
+    # Gaps and islands: for consecutive days, day number minus rank is constant,
+    # so grouping on it yields one document per streak. Needs MongoDB 5.0+.
+    pipeline = [
+        {"$match": {"user_id": user_id, **COMPLETE_FILTER}},
+        {"$project": {
+            "_id": 0,
+            "date": 1,
+            "day": {"$toLong": {"$divide": [{"$toLong": {"$dateFromString": {"dateString": "$date"}}}, 86400000]}},
+        }},
+        {"$setWindowFields": {"sortBy": {"date": 1}, "output": {"rank": {"$documentNumber": {}}}}},
+        {"$group": {"_id": {"$subtract": ["$day", "$rank"]}, "length": {"$sum": 1}, "end": {"$max": "$date"}}},
+        {"$sort": {"end": -1}},
+        {"$group": {
+            "_id": None,
+            "longest_streak": {"$max": "$length"},
+            "current_streak": {"$first": "$length"},
+            "last_practice_date": {"$first": "$end"},
+        }},
+    ]
+    results = await db.daily_progress.aggregate(pipeline).to_list(1)
+    if not results:
+        return dict(EMPTY_STREAK)
+    return streak_state(results[0])
+
+
+async def recompute_streaks(db: AsyncIOMotorDatabase, user_id: str) -> dict:
+    """Rebuild a user's current/longest streak from their full daily_progress history.
+
+    current_streak is the run ending on the latest completed day, matching
+    what advance() maintains incrementally.
+    """
+    try:
+        return await recompute_with_aggregation(db, user_id)
+    except OperationFailure as e:
+        logger.info("Streak aggregation unavailable (%s); scanning completed days instead", e)
+        return await recompute_with_scan(db, user_id)
+
@@ -0,0 +1,821 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Manifestation & Affirmation backend
+Each scenario prints a JSON report so runs can be compared across commits:
+
+    python backend_bench.py list-bytes --affirmations 50
+    python backend_bench.py settings-read --mongo-url mongodb://localhost:27017
+    python backend_bench.py load --clients 50 --duration 30 --output load.json
+    python backend_bench.py tenants --users 100,1000,10000,100000 --mongo-url mongodb://localhost:27017
+    python backend_bench.py storage --mongo-url mongodb://localhost:27017
+    python backend_bench.py practice-log --clients 50 --mongo-url mongodb://localhost:27017
+
+Scenarios that need a database use mongomock-motor unless --mongo-url
+points at a real mongod (a throwaway database is created and dropped).
+load --storage sqlite runs against a throwaway SQLite file instead.
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# server.py reads these at import time; benchmarks never talk to this URL
+# unless a scenario explicitly asks for a live database
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "manifest_bench")
+
+
+def make_photo(width, height, seed=0):
+    """A camera-roll-like JPEG: noisy enough that it doesn't compress to nothing."""
+    from PIL import Image
+
+    image = Image.effect_noise((width, height), 40 + seed % 20).convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def use_database(args):
+    """Point server.py at the benchmark database and return it."""
+    import server
+    from storage import MongoStorage
+
+    if args.mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        database = AsyncIOMotorClient(args.mongo_url)[f"manifest_bench_{os.getpid()}"]
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+
+        database = AsyncMongoMockClient()["manifest_bench"]
+    server.db = database
+    server.storage = MongoStorage(database)
+    server.affirmation_counts.invalidate()
+    server.settings_caches.invalidate()
+    return database
+
+
+async def drop_database(args, database):
+    if args.mongo_url:
+        await database.client.drop_database(database.name)
+
+
+async def use_storage(args, backend, directory):
+    """Point server.py at a fresh storage of the given backend and return it."""
+    import server
+    from sqlite_storage import SQLiteStorage
+
+    if backend == "mongo":
+        use_database(args)
+        return server.storage
+    storage = SQLiteStorage(str(Path(directory) / "manifest_bench.db"))
+    server.db = None
+    server.storage = storage
+    server.affirmation_counts.invalidate()
+    server.settings_caches.invalidate()
+    return storage
+
+
+async def drop_storage(args, storage):
+    if storage.name == "mongo":
+        await drop_database(args, storage.db)
+    else:
+        await storage.close()
+
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(int(len(samples) * q), len(samples) - 1)] * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 4),
+        "p50_ms": round(pick(0.50), 4),
+        "p95_ms": round(pick(0.95), 4),
+        "p99_ms": round(pick(0.99), 4),
+    }
+
+
+async def time_calls(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await func()
+        samples.append(time.perf_counter() - start)
+    return latency_summary(samples)
+
+
+def api_client():
+    """An httpx client that calls server:app in process, without a network hop."""
+    import httpx
+    import server
+
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench")
+
+
+def report(name, results):
+    print(json.dumps({"scenario": name, "timestamp": datetime.utcnow().isoformat(), **results}, indent=2))
+
+
+def bench_list_bytes(args):
+    """Bytes per GET /api/affirmations response with inline images vs. thumbnail URLs"""
+    import server
+    from image_store import IMAGE_VARIANTS, content_hash, render_variant
+
+    photos = [make_photo(args.width, args.height, seed=i) for i in range(args.distinct_images)]
+    inline_docs, blob_docs = [], []
+    thumb_bytes = 0
+    for i in range(args.affirmations):
+        photo = photos[i % len(photos)]
+        base = {"_id": f"{i:024x}", "text": f"Affirmation {i}", "order": i, "created_at": datetime.utcnow().isoformat()}
+        inline_docs.append({**base, "image": "data:image/jpeg;base64," + base64.b64encode(photo).decode()})
+        blob_docs.append({**base, "image_hash": content_hash(photo)})
+
+    start = time.perf_counter()
+    for photo in photos:
+        thumb_bytes += len(render_variant(photo, IMAGE_VARIANTS["thumb"]))
+    render_seconds = time.perf_counter() - start
+
+    before = len(json.dumps([server.affirmation_helper(doc) for doc in inline_docs]))
+    after = len(json.dumps([server.affirmation_helper(doc) for doc in blob_docs]))
+    report("list-bytes", {
+        "affirmations": args.affirmations,
+        "photo_size": f"{args.width}x{args.height}",
+        "photo_bytes_avg": sum(len(p) for p in photos) // len(photos),
+        "list_bytes_inline": before,
+        "list_bytes_with_urls": after,
+        # Thumbnails are fetched once and then served from the client cache
+        "thumbnail_bytes_first_load": thumb_bytes,
+        "thumbnail_render_ms_avg": round(render_seconds / len(photos) * 1000, 2),
+        "reduction_factor": round(before / after, 1),
+    })
+
+
+async def bench_settings_read(args):
+    """Settings read latency: direct find_one vs. GET /api/settings served from the settings cache"""
+    import server
+
+    database = use_database(args)
+    user_id = server.DEFAULT_USER_ID
+    async with api_client() as client:
+        # Loads the settings into the cache
+        etag = (await client.get("/api/settings")).raise_for_status().headers["ETag"]
+        uncached = await time_calls(lambda: database.settings.find_one({"user_id": user_id}), args.iterations)
+        cached = await time_calls(lambda: client.get("/api/settings"), args.iterations)
+        revalidated = await time_calls(lambda: client.get("/api/settings", headers={"If-None-Match": etag}),
+                                       args.iterations)
+    report("settings-read", {
+        "database": "mongod" if args.mongo_url else "mongomock",
+        "find_one": uncached,
+        "cached_get_settings": cached,
+        "revalidated_get_settings": revalidated,
+        "cache": server.settings_caches.describe(),
+    })
+    await drop_database(args, database)
+
+
+async def bench_instrumentation(args):
+    """Overhead of the metrics middleware per request and of the command listener per MongoDB command"""
+    from datetime import timedelta
+
+    from pymongo import monitoring
+
+    import server
+    from monitoring import CommandMonitor, MetricsMiddleware
+
+    use_database(args)
+    app = server.app
+    instrumented_middleware = list(app.user_middleware)
+
+    async def request_latency():
+        async with api_client() as client:
+            await client.get("/api/settings")
+            # Settings come from the in-process cache, so the middleware is a large share of the request
+            return await time_calls(lambda: client.get("/api/settings"), args.iterations)
+
+    with_metrics = await request_latency()
+    app.user_middleware = [m for m in instrumented_middleware if m.cls is not MetricsMiddleware]
+    app.middleware_stack = app.build_middleware_stack()
+    without_metrics = await request_latency()
+    app.user_middleware = instrumented_middleware
+    app.middleware_stack = app.build_middleware_stack()
+
+    # The listener runs inline on every command; time its callbacks directly
+    monitor = CommandMonitor()
+    connection = ("localhost", 27017)
+    command = {"find": "affirmations", "filter": {"user_id": "bench"}, "$db": "manifest_bench"}
+    reply = {"cursor": {"firstBatch": [{}] * 20, "id": 0}, "ok": 1}
+    start = time.perf_counter()
+    for request_id in range(args.iterations * 10):
+        monitor.started(monitoring.CommandStartedEvent(command, "manifest_bench", request_id, connection, request_id))
+        monitor.succeeded(monitoring.CommandSucceededEvent(
+            timedelta(microseconds=500), reply, "find", request_id, connection, request_id,
+        ))
+    listener_us = (time.perf_counter() - start) / (args.iterations * 10) * 1e6
+
+    report("instrumentation", {
+        "request_with_metrics": with_metrics,
+        "request_without_metrics": without_metrics,
+        "middleware_overhead_ms": round(with_metrics["mean_ms"] - without_metrics["mean_ms"], 4),
+        "listener_us_per_command": round(listener_us, 2),
+    })
+
+
+def bench_response_encoding(args):
+    """Serialization time (stdlib json vs. orjson) and bytes on the wire (identity, gzip, brotli)"""
+    from fastapi.responses import JSONResponse, ORJSONResponse
+
+    import server
+    from compression import compress
+    from image_store import content_hash
+
+    def time_per_call(func):
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            func()
+        return round((time.perf_counter() - start) / args.iterations * 1000, 4)
+
+    payloads = {}
+    for size in (int(n) for n in args.sizes.split(",")):
+        payloads[f"affirmations_{size}"] = [
+            server.affirmation_helper({
+                "_id": f"{i:024x}",
+                "text": f"I am worthy of love, success, and happiness. ({i})",
+                "order": i,
+                "is_example": i < 8,
+                "created_at": datetime.utcnow().isoformat(),
+                "image_hash": content_hash(str(i % 10).encode()) if i % 3 == 0 else None,
+            })
+            for i in range(size)
+        ]
+    for days in (30, 365):
+        payloads[f"history_{days}"] = [
+            server.progress_helper({"_id": f"{i:024x}", **day})
+            for i, day in enumerate(synthetic_history(1, 0.85)[-days:])
+        ]
+        for i, day in enumerate(payloads[f"history_{days}"]):
+            day["completed_affirmations"] = [f"{j:024x}" for j in range(i % 9)]
+
+    results = {}
+    for name, rows in payloads.items():
+        body = ORJSONResponse(rows).body
+        results[name] = {
+            "stdlib_json_ms": time_per_call(lambda: JSONResponse(rows).body),
+            "orjson_ms": time_per_call(lambda: ORJSONResponse(rows).body),
+            "bytes_identity": len(body),
+            "bytes_gzip": len(compress(body, "gzip", gzip_level=args.gzip_level)),
+            "bytes_br": len(compress(body, "br", brotli_quality=args.brotli_quality)),
+            "gzip_ms": time_per_call(lambda: compress(body, "gzip", gzip_level=args.gzip_level)),
+            "br_ms": time_per_call(lambda: compress(body, "br", brotli_quality=args.brotli_quality)),
+        }
+    report("response-encoding", {"gzip_level": args.gzip_level, "brotli_quality": args.brotli_quality, **results})
+
+
+def synthetic_history(years, completion_rate, seed=42, user_id="default"):
+    """daily_progress documents for every day of the last `years` years"""
+    import random
+    from datetime import date, timedelta
+
+    rng = random.Random(seed)
+    today = date.today()
+    days = []
+    for offset in range(years * 365, -1, -1):
+        complete = rng.random() < completion_rate
+        days.append({
+            "user_id": user_id,
+            "date": (today - timedelta(days=offset)).isoformat(),
+            "completed_affirmations": [],
+            "total_affirmations": 8,
+            "completion_percentage": 100.0 if complete else rng.choice([0.0, 25.0, 50.0, 87.5]),
+            "practice_count": rng.randint(1, 20),
+        })
+    return days
+
+
+async def bench_streak_recompute(args):
+    """Full streak recompute over a synthetic multi-year history, vs. the O(1) incremental step"""
+    from indexes import ensure_indexes
+    from streaks import EMPTY_STREAK, advance, recompute_with_aggregation, recompute_with_scan, streak_from_days
+
+    database = use_database(args)
+    await ensure_indexes(database)
+    history = synthetic_history(args.years, args.completion_rate)
+    await database.daily_progress.insert_many(history)
+    expected = streak_from_days(d["date"] for d in history if d["completion_percentage"] >= 100)
+
+    results = {
+        "database": "mongod" if args.mongo_url else "mongomock",
+        "days": len(history),
+        "expected": expected,
+    }
+    strategies = {"scan": recompute_with_scan}
+    if args.mongo_url:
+        strategies["aggregation"] = recompute_with_aggregation
+    for name, recompute in strategies.items():
+        state = await recompute(database, "default")
+        results[name] = {
+            **await time_calls(lambda: recompute(database, "default"), args.iterations),
+            "matches": state == expected,
+        }
+
+    state = dict(EMPTY_STREAK)
+    start = time.perf_counter()
+    for day in history:
+        state = advance(state, day["date"])
+    results["incremental_advance_us"] = round((time.perf_counter() - start) / len(history) * 1e6, 3)
+    report("streak-recompute", results)
+    await drop_database(args, database)
+
+
+async def bench_mark_complete_batch(args):
+    """N single POST /api/progress/mark-complete calls vs. one batch of the same N events"""
+    from datetime import date, timedelta
+
+    database = use_database(args)
+    async with api_client() as client:
+        await client.post("/api/affirmations/seed")
+        affirmation_ids = [a["id"] for a in (await client.get("/api/affirmations")).json()]
+
+        def events(day):
+            return [
+                {"date": day, "affirmation_id": affirmation_ids[i % len(affirmation_ids)]}
+                for i in range(args.events)
+            ]
+
+        singles, batches = [], []
+        for round_number in range(args.rounds):
+            # A fresh day per round so both paths do the same work
+            single_day = (date.today() - timedelta(days=2 * round_number)).isoformat()
+            batch_day = (date.today() - timedelta(days=2 * round_number + 1)).isoformat()
+
+            start = time.perf_counter()
+            for event in events(single_day):
+                (await client.post("/api/progress/mark-complete", json=event)).raise_for_status()
+            singles.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            (await client.post("/api/progress/mark-complete/batch", json={"events": events(batch_day)})).raise_for_status()
+            batches.append(time.perf_counter() - start)
+
+    single, batch = latency_summary(singles), latency_summary(batches)
+    report("mark-complete-batch", {
+        "database": "mongod" if args.mongo_url else "mongomock",
+        "events": args.events,
+        "single_calls": single,
+        "one_batch": batch,
+        "speedup": round(single["mean_ms"] / batch["mean_ms"], 1),
+    })
+    await drop_database(args, database)
+
+
+async def bench_practice_log(args):
+    """Concurrent mark-complete taps on one day: each updating the day vs. appended to the practice log"""
+    import tempfile
+    from datetime import date
+
+    import server
+    from practice_log import PracticeCompactor
+
+    results = {}
+    event_log = server.PRACTICE_EVENT_LOG
+    with tempfile.TemporaryDirectory(prefix="manifest_bench_") as bench_dir:
+        for mode in ("update_day", "event_log_upsert", "event_log"):
+            (Path(bench_dir) / mode).mkdir()
+            storage = await use_storage(args, args.storage, Path(bench_dir) / mode)
+            await storage.prepare()
+            server.PRACTICE_EVENT_LOG = mode != "update_day"
+            if mode == "event_log_upsert":
+                # How log mode read the day before: creating it when missing, a write on every tap
+                async def get_or_create(user_id, day, storage=storage):
+                    total = await server.affirmation_counts[user_id].get()
+                    return await storage.get_or_create_progress(user_id, day, total)
+
+                storage.get_progress = get_or_create
+            # Folding as the server would, so reads merge a realistic number of events
+            compactor = PracticeCompactor(
+                storage, lambda user_id: server.affirmation_counts[user_id].get(), server.practice_folded,
+                interval=args.compact_interval, grace_ms=server.SYNC_GRACE_MS,
+            )
+            compacting = asyncio.create_task(compactor.run()) if server.PRACTICE_EVENT_LOG else None
+            samples = []
+            async with api_client() as client:
+                affirmation_ids = {}
+                for number in range(args.users):
+                    headers = {"X-User-Id": f"bench-{number}"}
+                    (await client.post("/api/affirmations/seed", headers=headers)).raise_for_status()
+                    listed = (await client.get("/api/affirmations", headers=headers)).json()
+                    affirmation_ids[headers["X-User-Id"]] = [a["id"] for a in listed]
+                today = date.today().isoformat()
+                deadline = time.perf_counter() + args.duration
+
+                async def tapper(number):
+                    user_id, tap = f"bench-{number % args.users}", number
+                    while time.perf_counter() < deadline:
+                        ids = affirmation_ids[user_id]
+                        body = {"date": today, "affirmation_id": ids[tap % len(ids)]}
+                        start = time.perf_counter()
+                        (await client.post("/api/progress/mark-complete", json=body,
+                                           headers={"X-User-Id": user_id})).raise_for_status()
+                        samples.append(time.perf_counter() - start)
+                        tap += 1
+
+                start = time.perf_counter()
+                await asyncio.gather(*(tapper(n) for n in range(args.clients)))
+                elapsed = time.perf_counter() - start
+            if compacting:
+                compacting.cancel()
+            results[mode] = {**latency_summary(samples), "taps_per_s": round(len(samples) / elapsed, 1)}
+            await drop_storage(args, storage)
+    server.PRACTICE_EVENT_LOG = event_log
+
+    report("practice-log", {
+        "storage": args.storage,
+        "database": ("mongod" if args.mongo_url else "mongomock") if args.storage == "mongo" else "sqlite",
+        "clients": args.clients,
+        "users": args.users,
+        **results,
+        "throughput_gain": round(results["event_log"]["taps_per_s"] / results["update_day"]["taps_per_s"], 2),
+        "throughput_gain_over_upsert": round(
+            results["event_log"]["taps_per_s"] / results["event_log_upsert"]["taps_per_s"], 2
+        ),
+    })
+
+
+async def bench_tenants(args):
+    """Per-user request latency as the number of users sharing the database grows"""
+    import random
+    from datetime import date, timedelta
+
+    import server
+    from indexes import ensure_indexes
+
+    database = use_database(args)
+    await ensure_indexes(database)
+    rng = random.Random(42)
+    today = date.today()
+    user_counts = sorted(int(n) for n in args.users.split(","))
+
+    async def add_users(first, last):
+        # Written straight to the collections; going through the API would take hours at 100k users
+        for start in range(first, last, args.insert_batch):
+            users = [f"user-{n}" for n in range(start, min(start + args.insert_batch, last))]
+            await database.affirmations.insert_many([
+                {"user_id": user, "text": f"Affirmation {i}", "order": i, "is_example": False, "created_at": today.isoformat()}
+                for user in users for i in range(args.affirmations)
+            ])
+            await database.daily_progress.insert_many([
+                {
+                    "user_id": user,
+                    "date": (today - timedelta(days=offset)).isoformat(),
+                    "completed_affirmations": [],
+                    "total_affirmations": args.affirmations,
+                    "completion_percentage": 0.0,
+                    "practice_count": 0,
+                }
+                for user in users for offset in range(1, args.days + 1)
+            ])
+
+    steps = []
+    existing = 0
+    async with api_client() as client:
+        for user_count in user_counts:
+            await add_users(existing, user_count)
+            existing = user_count
+            # Sampled users start with cold caches, so every step pays for its database reads
+            server.affirmation_counts.invalidate()
+            server.settings_caches.invalidate()
+            sample = [f"user-{rng.randrange(user_count)}" for _ in range(args.requests)]
+
+            samples = {"list_affirmations": [], "history": [], "today": [], "mark_complete": []}
+            for user in sample:
+                headers = {"X-User-Id": user}
+                for name, call in (
+                    ("list_affirmations", lambda: client.get("/api/affirmations", headers=headers)),
+                    ("history", lambda: client.get("/api/progress/history", headers=headers)),
+                    ("today", lambda: client.get("/api/progress/today", headers=headers)),
+                    ("mark_complete", lambda: client.post(
+                        "/api/progress/mark-complete", headers=headers,
+                        json={"date": today.isoformat(), "affirmation_id": "bench"},
+                    )),
+                ):
+                    start = time.perf_counter()
+                    (await call()).raise_for_status()
+                    samples[name].append(time.perf_counter() - start)
+            steps.append({
+                "users": user_count,
+                **{name: latency_summary(values) for name, values in samples.items()},
+            })
+
+    report("tenants", {
+        "database": "mongod" if args.mongo_url else "mongomock",
+        "affirmations_per_user": args.affirmations,
+        "days_per_user": args.days,
+        "steps": steps,
+    })
+    await drop_database(args, database)
+
+
+# The app's usage mix: (weight, name, request factory). Factories get the
+# client's state (user, affirmation ids, image hashes) and return
+# (method, url, json body).
+LOAD_MIX = [
+    (30, "GET /api/affirmations", lambda c: ("GET", "/api/affirmations", None)),
+    (20, "GET /api/progress/today", lambda c: ("GET", "/api/progress/today", None)),
+    (20, "POST /api/progress/mark-complete", lambda c: (
+        "POST", "/api/progress/mark-complete",
+        {"date": c["today"], "affirmation_id": c["rng"].choice(c["affirmation_ids"])},
+    )),
+    (10, "GET /api/settings", lambda c: ("GET", "/api/settings", None)),
+    (8, "GET /api/images/{hash}", lambda c: ("GET", f"/api/images/{c['rng'].choice(c['image_hashes'])}?size=thumb", None)),
+    (5, "GET /api/progress/history", lambda c: ("GET", "/api/progress/history?days=30", None)),
+    (5, "GET /api/progress/summary", lambda c: ("GET", "/api/progress/summary?granularity=week&range=12", None)),
+    (2, "PUT /api/settings", lambda c: ("PUT", "/api/settings", {"morning_time": f"0{c['rng'].randint(6, 9)}:00"})),
+]
+
+
+async def seed_load_data(args, storage):
+    """Per user: affirmations (some with images) and `years` of progress history."""
+    import server
+
+    await storage.prepare()
+    image_hashes = []
+    for i in range(args.images):
+        photo = make_photo(args.image_width, args.image_height, seed=i)
+        image_hashes.append(await server.image_pipeline.ingest(
+            "data:image/jpeg;base64," + base64.b64encode(photo).decode()
+        ))
+
+    users = [f"load-{n}" for n in range(args.users)]
+    for user in users:
+        await storage.insert_affirmations([
+            {
+                "user_id": user,
+                "text": f"I am worthy of love, success, and happiness. ({i})",
+                "order": i,
+                "is_example": False,
+                "created_at": datetime.utcnow().isoformat(),
+                "image_hash": image_hashes[i % len(image_hashes)] if image_hashes and i % 2 == 0 else None,
+            }
+            for i in range(args.affirmations)
+        ])
+        # Up to yesterday, so today's document is created by the load itself
+        await storage.insert_progress(synthetic_history(args.years, 0.85, user_id=user)[:-1])
+    await storage.rebuild_rollups()
+
+    affirmation_ids = {
+        user: [str(affirmation["_id"]) async for affirmation in storage.list_affirmations(user, [])]
+        for user in users
+    }
+    return users, affirmation_ids, image_hashes
+
+
+async def run_load(args, backend):
+    """Seed data on a fresh `backend` storage, drive the load and return the results."""
+    import random
+    import tempfile
+    from datetime import date
+
+    import httpx
+    import server
+    from image_store import FileSystemBlobStore, GridFSBlobStore
+
+    with tempfile.TemporaryDirectory(prefix="manifest_bench_") as bench_dir:
+        storage = await use_storage(args, backend, bench_dir)
+        image_dir = Path(bench_dir) / "images"
+        server.image_pipeline.store = (
+            GridFSBlobStore(storage.db) if backend == "mongo" and args.mongo_url else FileSystemBlobStore(image_dir)
+        )
+        users, affirmation_ids, image_hashes = await seed_load_data(args, storage)
+        if not image_hashes:
+            mix = [entry for entry in LOAD_MIX if "{hash}" not in entry[1]]
+        else:
+            mix = LOAD_MIX
+        weights = [weight for weight, _, _ in mix]
+
+        if args.transport == "http":
+            import uvicorn
+
+            # Real sockets and HTTP parsing, still in this process so mongomock works
+            uvicorn_server = uvicorn.Server(uvicorn.Config(
+                server.app, host="127.0.0.1", port=args.port, lifespan="off", log_level="warning",
+            ))
+            serving = asyncio.create_task(uvicorn_server.serve())
+            while not uvicorn_server.started:
+                await asyncio.sleep(0.01)
+            client = httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{args.port}",
+                limits=httpx.Limits(max_connections=args.clients),
+            )
+        else:
+            client = api_client()
+
+        samples = {name: [] for _, name, _ in mix}
+        errors = {name: 0 for _, name, _ in mix}
+        # Warm-up requests start the image workers and render thumbnails; they aren't recorded
+        measure_from = time.perf_counter() + args.warmup
+        deadline = measure_from + args.duration
+
+        async def virtual_client(number):
+            user = users[number % len(users)]
+            state = {
+                "rng": random.Random(number),
+                "today": date.today().isoformat(),
+                "affirmation_ids": affirmation_ids[user],
+                "image_hashes": image_hashes,
+            }
+            etags = {}
+            while time.perf_counter() < deadline:
+                _, name, make_request = state["rng"].choices(mix, weights)[0]
+                method, url, body = make_request(state)
+                headers = {"X-User-Id": user, "Accept-Encoding": "br, gzip"}
+                if method == "GET" and args.revalidate and url in etags:
+                    # Like the app, which keeps the last ETag per path
+                    headers["If-None-Match"] = etags[url]
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, url, json=body, headers=headers)
+                    await response.aread()
+                except httpx.HTTPError:
+                    errors[name] += start >= measure_from
+                    continue
+                if start >= measure_from:
+                    samples[name].append(time.perf_counter() - start)
+                    errors[name] += response.status_code >= 400
+                if response.status_code < 400 and "etag" in response.headers:
+                    etags[url] = response.headers["etag"]
+
+        async with client:
+            await asyncio.gather(*(virtual_client(n) for n in range(args.clients)))
+        elapsed = time.perf_counter() - measure_from
+        if args.transport == "http":
+            uvicorn_server.should_exit = True
+            await serving
+        await drop_storage(args, storage)
+
+    endpoints = {
+        name: {**latency_summary(values), "rps": round(len(values) / elapsed, 1), "errors": errors[name]}
+        for name, values in samples.items() if values
+    }
+    all_samples = [value for values in samples.values() for value in values]
+    return {
+        "storage": backend,
+        "database": ("mongod" if args.mongo_url else "mongomock") if backend == "mongo" else "sqlite",
+        "transport": args.transport,
+        "clients": args.clients,
+        "users": args.users,
+        "affirmations_per_user": args.affirmations,
+        "history_years": args.years,
+        "images": f"{args.images}x{args.image_width}x{args.image_height}",
+        "revalidate": args.revalidate,
+        "duration_s": round(elapsed, 2),
+        "total": {
+            **latency_summary(all_samples),
+            "rps": round(len(all_samples) / elapsed, 1),
+            "errors": sum(errors.values()),
+        },
+        "endpoints": endpoints,
+    }
+
+
+async def bench_load(args):
+    """Concurrent clients driving the app's usage mix; p50/p95/p99 and RPS per endpoint"""
+    results = await run_load(args, args.storage)
+    report("load", results)
+    if args.output:
+        Path(args.output).write_text(json.dumps({"scenario": "load", **results}, indent=2))
+
+
+async def bench_storage(args):
+    """The load scenario on each storage backend in turn, with per-endpoint latency side by side"""
+    runs = {backend: await run_load(args, backend) for backend in ("mongo", "sqlite")}
+    endpoints = sorted({name for run in runs.values() for name in run["endpoints"]})
+    comparison = {
+        name: {
+            backend: {key: run["endpoints"][name][key] for key in ("p50_ms", "p95_ms", "p99_ms", "rps")}
+            for backend, run in runs.items() if name in run["endpoints"]
+        }
+        for name in endpoints
+    }
+    results = {
+        "mongo_database": runs["mongo"]["database"],
+        "total": {backend: run["total"] for backend, run in runs.items()},
+        "endpoints": comparison,
+    }
+    report("storage", results)
+    if args.output:
+        Path(args.output).write_text(json.dumps({"scenario": "storage", **results}, indent=2))
+
+
+SCENARIOS = {
+    "instrumentation": bench_instrumentation,
+    "list-bytes": bench_list_bytes,
+    "load": bench_load,
+    "settings-read": bench_settings_read,
+    "response-encoding": bench_response_encoding,
+    "streak-recompute": bench_streak_recompute,
+    "mark-complete-batch": bench_mark_complete_batch,
+    "practice-log": bench_practice_log,
+    "storage": bench_storage,
+    "tenants": bench_tenants,
+}
+
+
+def add_load_arguments(parser):
+    """Arguments shared by the load and storage scenarios"""
+    parser.add_argument("--clients", type=int, default=20, help="Concurrent virtual clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to drive load for")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds of unrecorded load first")
+    parser.add_argument("--users", type=int, default=10, help="Distinct X-User-Id values the clients spread over")
+    parser.add_argument("--affirmations", type=int, default=20, help="Affirmations per user")
+    parser.add_argument("--years", type=int, default=2, help="Years of daily_progress per user")
+    parser.add_argument("--images", type=int, default=5, help="Distinct images shared by the affirmations")
+    parser.add_argument("--image-width", type=int, default=3024)
+    parser.add_argument("--image-height", type=int, default=4032)
+    parser.add_argument("--transport", choices=["asgi", "http"], default="asgi",
+                        help="asgi calls the app in process; http serves it with uvicorn on --port")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--no-revalidate", dest="revalidate", action="store_false",
+                        help="Don't send If-None-Match, so every GET is a full read")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="scenario", required=True)
+
+    list_bytes = subparsers.add_parser("list-bytes", help=bench_list_bytes.__doc__)
+    list_bytes.add_argument("--affirmations", type=int, default=50)
+    list_bytes.add_argument("--distinct-images", type=int, default=10)
+    list_bytes.add_argument("--width", type=int, default=3024)
+    list_bytes.add_argument("--height", type=int, default=4032)
+
+    instrumentation = subparsers.add_parser("instrumentation", help=bench_instrumentation.__doc__)
+    instrumentation.add_argument("--iterations", type=int, default=2000)
+
+    load = subparsers.add_parser("load", help=bench_load.__doc__)
+    add_load_arguments(load)
+    load.add_argument("--storage", choices=["mongo", "sqlite"], default="mongo", help="Storage backend to drive")
+
+    add_load_arguments(subparsers.add_parser("storage", help=bench_storage.__doc__))
+
+    settings_read = subparsers.add_parser("settings-read", help=bench_settings_read.__doc__)
+    settings_read.add_argument("--iterations", type=int, default=2000)
+
+    response_encoding = subparsers.add_parser("response-encoding", help=bench_response_encoding.__doc__)
+    response_encoding.add_argument("--sizes", default="50,200,500", help="Comma-separated affirmation list sizes")
+    response_encoding.add_argument("--iterations", type=int, default=200)
+    response_encoding.add_argument("--gzip-level", type=int, default=6)
+    response_encoding.add_argument("--brotli-quality", type=int, default=4)
+
+    streak_recompute = subparsers.add_parser("streak-recompute", help=bench_streak_recompute.__doc__)
+    streak_recompute.add_argument("--years", type=int, default=5)
+    streak_recompute.add_argument("--completion-rate", type=float, default=0.85)
+    streak_recompute.add_argument("--iterations", type=int, default=5)
+
+    mark_complete_batch = subparsers.add_parser("mark-complete-batch", help=bench_mark_complete_batch.__doc__)
+    mark_complete_batch.add_argument("--events", type=int, default=50)
+    mark_complete_batch.add_argument("--rounds", type=int, default=10)
+
+    practice_log = subparsers.add_parser("practice-log", help=bench_practice_log.__doc__)
+    practice_log.add_argument("--clients", type=int, default=50, help="Concurrent clients tapping today")
+    practice_log.add_argument(
+        "--users", type=int, default=50,
+        help="Users the clients spread over; 1 has every client contend for one day",
+    )
+    practice_log.add_argument("--duration", type=float, default=10.0, help="Seconds to tap for, per mode")
+    practice_log.add_argument("--compact-interval", type=float, default=1.0)
+    practice_log.add_argument("--storage", choices=["mongo", "sqlite"], default="mongo", help="Storage backend to drive")
+
+    tenants = subparsers.add_parser("tenants", help=bench_tenants.__doc__)
+    tenants.add_argument(
+        "--users", default="100,1000,10000",
+        help="Comma-separated user counts; try 100,1000,10000,100000 against a local mongod",
+    )
+    tenants.add_argument("--affirmations", type=int, default=8, help="Affirmations per user")
+    tenants.add_argument("--days", type=int, default=30, help="Days of progress history per user")
+    tenants.add_argument("--requests", type=int, default=200, help="Sampled users per step")
+    tenants.add_argument("--insert-batch", type=int, default=1000, help="Users written per insert_many")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument("--mongo-url", help="Benchmark against this mongod instead of mongomock-motor")
+
+    args = parser.parse_args()
+    # One log line per request would drown out the report
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    result = SCENARIOS[args.scenario](args)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,16 @@ Tests all backend endpoints with comprehensive scenarios
 """
 
 import requests
+import base64
 import json
-from datetime import datetime, date
+import gzip
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
 import time
 import os
+import uuid
 from pathlib import Path
 
 # Load environment variables to get the backend URL
@@ -30,6 +36,15 @@ API_BASE = f"{BACKEND_URL}/api"
 
 print(f"Testing backend at: {API_BASE}")
 
+def png_data_url(width, height, color=(200, 120, 40)):
+    """A solid-colour PNG as the picker would send it, built without an imaging library"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    rows = b"".join(b"\x00" + bytes(color) * width for _ in range(height))
+    png = (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+           + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+    return "data:image/png;base64," + base64.b64encode(png).decode()
+
 class BackendTester:
     def __init__(self):
         self.session = requests.Session()
@@ -162,6 +177,233 @@ class BackendTester:
         except Exception as e:
             self.log_result("POST Seed Affirmations", False, f"Exception: {str(e)}")
     
+    def test_pagination(self):
+        """Test keyset pagination and NDJSON streaming of listings"""
+        try:
+            seen = []
+            query = "limit=2&view=summary"
+            for _ in range(100):
+                response = self.session.get(f"{API_BASE}/affirmations?{query}")
+                if response.status_code != 200:
+                    self.log_result("GET Affirmations Paged", False, f"Status: {response.status_code}")
+                    return
+                seen.extend(a['id'] for a in response.json())
+                next_cursor = response.headers.get('X-Next-Cursor')
+                if not next_cursor:
+                    break
+                query = f"limit=2&view=summary&{next_cursor}"
+            full = self.session.get(f"{API_BASE}/affirmations").json()
+            if seen == [a['id'] for a in full]:
+                self.log_result("GET Affirmations Paged", True, f"{len(seen)} affirmations across pages")
+            else:
+                self.log_result("GET Affirmations Paged", False, "Pages don't match the full listing")
+        except Exception as e:
+            self.log_result("GET Affirmations Paged", False, f"Exception: {str(e)}")
+        
+        try:
+            response = self.session.get(f"{API_BASE}/affirmations?format=ndjson")
+            if response.status_code == 200:
+                rows = [json.loads(line) for line in response.text.splitlines() if line]
+                if all('id' in row and 'text' in row for row in rows):
+                    self.log_result("GET Affirmations NDJSON", True, f"Streamed {len(rows)} rows")
+                else:
+                    self.log_result("GET Affirmations NDJSON", False, "Invalid row structure")
+            else:
+                self.log_result("GET Affirmations NDJSON", False, f"Status: {response.status_code}")
+        except Exception as e:
+            self.log_result("GET Affirmations NDJSON", False, f"Exception: {str(e)}")
+    
+    def test_user_isolation(self):
+        """Test that each X-User-Id sees only its own affirmations and settings"""
+        other_user = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        try:
+            created = self.session.post(f"{API_BASE}/affirmations", json={"text": "Only mine"}, headers=other_user)
+            if created.status_code != 200:
+                self.log_result("User Isolation", False, f"Create status: {created.status_code}")
+                return
+            affirmation_id = created.json()['id']
+            mine = self.session.get(f"{API_BASE}/affirmations", headers=other_user).json()
+            default_ids = [a['id'] for a in self.session.get(f"{API_BASE}/affirmations").json()]
+            foreign_delete = self.session.delete(f"{API_BASE}/affirmations/{affirmation_id}")
+            settings = self.session.get(f"{API_BASE}/settings", headers=other_user).json()
+            
+            if [a['id'] for a in mine] != [affirmation_id]:
+                self.log_result("User Isolation", False, f"Other user sees {len(mine)} affirmations")
+            elif affirmation_id in default_ids:
+                self.log_result("User Isolation", False, "Default user sees the other user's affirmation")
+            elif foreign_delete.status_code != 404:
+                self.log_result("User Isolation", False, f"Foreign delete status: {foreign_delete.status_code}")
+            elif settings['current_streak'] != 0:
+                self.log_result("User Isolation", False, "New user did not get default settings")
+            else:
+                self.log_result("User Isolation", True, "Affirmations and settings are scoped per user")
+            self.session.delete(f"{API_BASE}/affirmations/{affirmation_id}", headers=other_user)
+        except Exception as e:
+            self.log_result("User Isolation", False, f"Exception: {str(e)}")
+    
+    def test_ordering(self):
+        """Test concurrent creates and moves: every affirmation keeps a distinct place in the list"""
+        user = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        parallel_requests = 20
+        try:
+            with ThreadPoolExecutor(max_workers=parallel_requests) as pool:
+                created = list(pool.map(
+                    lambda i: requests.post(f"{API_BASE}/affirmations", json={"text": f"Concurrent {i}"},
+                                            headers=user).status_code,
+                    range(parallel_requests)
+                ))
+            listed = self.session.get(f"{API_BASE}/affirmations", headers=user).json()
+            if any(status != 200 for status in created):
+                self.log_result("Concurrent Creates", False, f"Statuses: {sorted(set(created))}")
+                return
+            if len(listed) != parallel_requests or len({a['order'] for a in listed}) != parallel_requests:
+                self.log_result("Concurrent Creates", False, f"{len(listed)} listed, orders {[a['order'] for a in listed]}")
+                return
+            self.log_result("Concurrent Creates", True, f"{parallel_requests} creates got distinct orders")
+            
+            # Move the last affirmation to the front, then one after the first
+            ids = [a['id'] for a in listed]
+            moved = self.session.post(f"{API_BASE}/affirmations/{ids[-1]}/move", json={"before": ids[0]}, headers=user)
+            self.session.post(f"{API_BASE}/affirmations/{ids[5]}/move", json={"after": ids[-1]}, headers=user)
+            expected = [ids[-1], ids[5]] + [i for i in ids[:-1] if i != ids[5]]
+            after = [a['id'] for a in self.session.get(f"{API_BASE}/affirmations", headers=user).json()]
+            if moved.status_code != 200 or after != expected:
+                self.log_result("Move Affirmation", False, f"Status: {moved.status_code}, order not as expected")
+            else:
+                self.log_result("Move Affirmation", True, "Single moves placed before and after their anchors")
+            
+            # Many concurrent moves into the same gap, which forces respacing; a
+            # move racing a rebalance must survive it, so every mover ends up
+            # between the anchor and the one affirmation that wasn't moved
+            anchor, movers = after[0], after[2:]
+            with ThreadPoolExecutor(max_workers=len(movers)) as pool:
+                statuses = list(pool.map(
+                    lambda affirmation_id: requests.post(f"{API_BASE}/affirmations/{affirmation_id}/move",
+                                                         json={"after": anchor}, headers=user).status_code,
+                    movers
+                ))
+            time.sleep(0.5)
+            listed = self.session.get(f"{API_BASE}/affirmations", headers=user).json()
+            if any(status != 200 for status in statuses):
+                self.log_result("Concurrent Moves", False, f"Statuses: {sorted(set(statuses))}")
+            elif sorted(a['id'] for a in listed) != sorted(ids) or listed[0]['id'] != anchor:
+                self.log_result("Concurrent Moves", False, "Affirmations lost or anchor displaced")
+            elif {a['id'] for a in listed[1:1 + len(movers)]} != set(movers) or listed[-1]['id'] != after[1]:
+                self.log_result("Concurrent Moves", False, "A move was undone: not every mover is after the anchor")
+            else:
+                self.log_result("Concurrent Moves", True, f"{len(movers)} parallel moves all landed after their anchor")
+            
+            missing = self.session.post(f"{API_BASE}/affirmations/{ids[0]}/move", json={"after": uuid.uuid4().hex[:24]},
+                                        headers=user)
+            both = self.session.post(f"{API_BASE}/affirmations/{ids[0]}/move", json={"after": ids[1], "before": ids[2]},
+                                     headers=user)
+            self.log_result("Move Validation", missing.status_code == 404 and both.status_code == 400,
+                            f"Missing anchor: {missing.status_code}, both anchors: {both.status_code}")
+        except Exception as e:
+            self.log_result("Affirmation Ordering", False, f"Exception: {str(e)}")
+        finally:
+            for affirmation in self.session.get(f"{API_BASE}/affirmations", headers=user).json():
+                self.session.delete(f"{API_BASE}/affirmations/{affirmation['id']}", headers=user)
+    
+    def test_images(self):
+        """Test image upload, streaming from /api/images/{hash}, strong ETags and removing an image"""
+        user = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        try:
+            created = self.session.post(f"{API_BASE}/affirmations", headers=user,
+                                        json={"text": "With a picture", "image": png_data_url(640, 480)})
+            if created.status_code != 200 or not created.json().get('images'):
+                self.log_result("Image Upload", False, f"Status: {created.status_code} {created.text[:200]}")
+                return
+            affirmation = created.json()
+            original = affirmation['images']['original']
+            image_hash = original.split("/")[-1].split("?")[0]
+            self.log_result("Image Upload", affirmation['image'].startswith(f"/api/images/{image_hash}"),
+                            f"Stored as {image_hash[:12]}…, listed as {affirmation['image']}")
+            
+            response = self.session.get(f"{BACKEND_URL}{original}", stream=True)
+            body = b"".join(response.iter_content(chunk_size=4096))
+            etag = response.headers.get('ETag')
+            if response.status_code != 200 or not response.headers.get('content-type', '').startswith("image/"):
+                self.log_result("Image Streaming", False, f"Status: {response.status_code}")
+            elif not body or int(response.headers.get('Content-Length', -1)) != len(body):
+                self.log_result("Image Streaming", False, f"{len(body)} bytes, Content-Length {response.headers.get('Content-Length')}")
+            else:
+                self.log_result("Image Streaming", True, f"{len(body)} bytes of {response.headers['content-type']}")
+            
+            # Content-addressed, so the tag is strong and stays the same across requests
+            revalidated = self.session.get(f"{BACKEND_URL}{original}", headers={"If-None-Match": etag})
+            if not etag or etag.startswith("W/") or image_hash not in etag:
+                self.log_result("Image ETag", False, f"ETag: {etag}")
+            elif revalidated.status_code != 304 or revalidated.content:
+                self.log_result("Image ETag", False, f"Revalidation status: {revalidated.status_code}")
+            else:
+                self.log_result("Image ETag", True, f"{etag} revalidates with 304")
+            
+            not_an_image = "data:image/png;base64," + base64.b64encode(b"definitely not a picture").decode()
+            bad = self.session.post(f"{API_BASE}/affirmations", headers=user,
+                                    json={"text": "Broken picture", "image": not_an_image})
+            unknown = self.session.get(f"{API_BASE}/images/{'0' * 64}")
+            if bad.status_code != 400:
+                self.log_result("Bad Image", False, f"Status: {bad.status_code}")
+            elif unknown.status_code != 404:
+                self.log_result("Bad Image", False, f"Unknown hash status: {unknown.status_code}")
+            else:
+                self.log_result("Bad Image", True, f"Undecodable upload: 400 {bad.json()['detail']}")
+            
+            cleared = self.session.put(f"{API_BASE}/affirmations/{affirmation['id']}", json={"image": ""}, headers=user)
+            if cleared.status_code != 200 or cleared.json()['image'] is not None or cleared.json()['images'] is not None:
+                self.log_result("Remove Image", False, f"Status: {cleared.status_code} {cleared.text[:200]}")
+            else:
+                self.log_result("Remove Image", True, "An empty image removed the picture")
+        except Exception as e:
+            self.log_result("Images", False, f"Exception: {str(e)}")
+        finally:
+            for affirmation in self.session.get(f"{API_BASE}/affirmations", headers=user).json():
+                self.session.delete(f"{API_BASE}/affirmations/{affirmation['id']}", headers=user)
+    
+    def test_image_variants(self):
+        """Test that each size is served no larger than its bound, cached as immutable, and unknown sizes get a 400"""
+        user = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        bounds = {"thumb": 256, "screen": 1080, "original": 2048}
+        try:
+            # Larger than every bound but the original's, so thumb and screen must be resized
+            affirmation = self.session.post(f"{API_BASE}/affirmations", headers=user,
+                                            json={"text": "Sized picture", "image": png_data_url(1600, 1200)}).json()
+            if set(affirmation.get('images') or {}) != set(bounds):
+                self.log_result("Image Variants", False, f"Sizes listed: {affirmation.get('images')}")
+                return
+            sizes = {}
+            for size, url in affirmation['images'].items():
+                response = self.session.get(f"{BACKEND_URL}{url}")
+                cache_control = response.headers.get('Cache-Control', '')
+                if response.status_code != 200 or "immutable" not in cache_control or "max-age=" not in cache_control:
+                    self.log_result("Image Variants", False, f"{size}: {response.status_code}, Cache-Control {cache_control!r}")
+                    return
+                # WebP VP8 header: width and height are the 14-bit fields after the start code
+                body = response.content
+                start = body.find(b"\x9d\x01\x2a")
+                if body[:4] != b"RIFF" or start < 0:
+                    self.log_result("Image Variants", False, f"{size}: not a lossy WebP")
+                    return
+                width, height = struct.unpack("<HH", body[start + 3:start + 7])
+                sizes[size] = (width & 0x3FFF, height & 0x3FFF, len(body))
+            too_large = [size for size, (width, height, _) in sizes.items() if max(width, height) > bounds[size]]
+            if too_large or not sizes['thumb'][2] < sizes['screen'][2] <= sizes['original'][2]:
+                self.log_result("Image Variants", False, f"Sizes: {sizes}")
+            else:
+                self.log_result("Image Variants", True,
+                                ", ".join(f"{size} {width}x{height}" for size, (width, height, _) in sizes.items()))
+            
+            thumb = affirmation['images']['thumb']
+            unknown = self.session.get(f"{BACKEND_URL}{thumb.split('?')[0]}", params={"size": "poster"})
+            self.log_result("Unknown Image Size", unknown.status_code == 400,
+                            f"Status: {unknown.status_code} {unknown.text[:100]}")
+        except Exception as e:
+            self.log_result("Image Variants", False, f"Exception: {str(e)}")
+        finally:
+            for affirmation in self.session.get(f"{API_BASE}/affirmations", headers=user).json():
+                self.session.delete(f"{API_BASE}/affirmations/{affirmation['id']}", headers=user)
+    
     def test_progress_endpoints(self):
         """Test daily progress tracking endpoints"""
         
@@ -220,6 +462,24 @@ class BackendTester:
             except Exception as e:
                 self.log_result("POST Mark Complete (Repeat)", False, f"Exception: {str(e)}")
             
+            # An invalid day is rejected before anything is written
+            try:
+                before = self.session.get(f"{API_BASE}/progress/today").json()['practice_count']
+                statuses = [
+                    self.session.post(f"{API_BASE}/progress/mark-complete",
+                                      json={"date": day, "affirmation_id": self.created_affirmations[0]}).status_code
+                    for day in ("garbage", "2026-13-01")
+                ]
+                after = self.session.get(f"{API_BASE}/progress/today").json()['practice_count']
+                summary = self.session.post(f"{API_BASE}/progress/summary/rebuild")
+                if statuses != [422, 422] or after != before or summary.status_code != 200:
+                    self.log_result("POST Mark Complete (Invalid Date)", False,
+                                    f"Statuses {statuses}, practice count {before} -> {after}, rebuild {summary.status_code}")
+                else:
+                    self.log_result("POST Mark Complete (Invalid Date)", True, "Rejected with 422, nothing written")
+            except Exception as e:
+                self.log_result("POST Mark Complete (Invalid Date)", False, f"Exception: {str(e)}")
+            
             # Mark all remaining affirmations to test streak logic
             for affirmation_id in self.created_affirmations[1:]:
                 try:
@@ -247,6 +507,127 @@ class BackendTester:
         except Exception as e:
             self.log_result("GET Progress History", False, f"Exception: {str(e)}")
     
+    def test_batch_mark_complete(self):
+        """Test applying a queued batch of practice events"""
+        if not self.created_affirmations:
+            return
+        today = date.today().isoformat()
+        try:
+            before = self.session.get(f"{API_BASE}/progress/today").json()['practice_count']
+            events = [
+                {"date": today, "affirmation_id": affirmation_id, "timestamp": datetime.utcnow().isoformat()}
+                for affirmation_id in self.created_affirmations * 2
+            ]
+            response = self.session.post(f"{API_BASE}/progress/mark-complete/batch", json={"events": events})
+            if response.status_code == 200:
+                days = response.json()
+                if len(days) == 1 and days[0]['practice_count'] == before + len(events):
+                    self.log_result("POST Mark Complete Batch", True, f"Applied {len(events)} events")
+                else:
+                    self.log_result("POST Mark Complete Batch", False, f"Unexpected result: {days}")
+            else:
+                self.log_result("POST Mark Complete Batch", False, f"Status: {response.status_code}")
+        except Exception as e:
+            self.log_result("POST Mark Complete Batch", False, f"Exception: {str(e)}")
+        
+        # One invalid day rejects the whole batch before any day is written
+        try:
+            before = self.session.get(f"{API_BASE}/progress/today").json()['practice_count']
+            events = [
+                {"date": today, "affirmation_id": self.created_affirmations[0]},
+                {"date": "2026-13-01", "affirmation_id": self.created_affirmations[0]},
+            ]
+            response = self.session.post(f"{API_BASE}/progress/mark-complete/batch", json={"events": events})
+            after = self.session.get(f"{API_BASE}/progress/today").json()['practice_count']
+            self.log_result("POST Mark Complete Batch (Invalid Date)", response.status_code == 422 and after == before,
+                            f"Status: {response.status_code}, practice count {before} -> {after}")
+        except Exception as e:
+            self.log_result("POST Mark Complete Batch (Invalid Date)", False, f"Exception: {str(e)}")
+    
+    def test_progress_summary(self):
+        """Test weekly/monthly progress rollups"""
+        for granularity in ("week", "month"):
+            try:
+                response = self.session.get(f"{API_BASE}/progress/summary?granularity={granularity}&range=12")
+                if response.status_code == 200:
+                    summary = response.json()
+                    required_fields = ['period', 'start', 'end', 'days_practiced', 'mean_completion', 'practice_count']
+                    if summary and all(field in summary[0] for field in required_fields):
+                        self.log_result(f"GET Progress Summary ({granularity})", True,
+                                        f"{len(summary)} periods, latest {summary[0]['period']}")
+                    else:
+                        self.log_result(f"GET Progress Summary ({granularity})", False, "Missing rollups or fields")
+                else:
+                    self.log_result(f"GET Progress Summary ({granularity})", False, f"Status: {response.status_code}")
+            except Exception as e:
+                self.log_result(f"GET Progress Summary ({granularity})", False, f"Exception: {str(e)}")
+    
+    def test_concurrent_mark_complete(self):
+        """Test that parallel mark-complete requests don't lose increments"""
+        if not self.created_affirmations:
+            return
+        parallel_requests = 20
+        today = date.today().isoformat()
+        try:
+            before = self.session.get(f"{API_BASE}/progress/today").json()['practice_count']
+            payloads = [
+                {"date": today, "affirmation_id": self.created_affirmations[i % len(self.created_affirmations)]}
+                for i in range(parallel_requests)
+            ]
+            with ThreadPoolExecutor(max_workers=parallel_requests) as pool:
+                statuses = list(pool.map(
+                    lambda payload: requests.post(f"{API_BASE}/progress/mark-complete", json=payload).status_code,
+                    payloads
+                ))
+            after = self.session.get(f"{API_BASE}/progress/today").json()
+            if any(status != 200 for status in statuses):
+                self.log_result("Concurrent Mark Complete", False, f"Statuses: {sorted(set(statuses))}")
+            elif after['practice_count'] != before + parallel_requests:
+                self.log_result("Concurrent Mark Complete", False,
+                                f"Expected practice count {before + parallel_requests}, got {after['practice_count']}")
+            elif not set(self.created_affirmations) <= set(after['completed_affirmations']):
+                self.log_result("Concurrent Mark Complete", False, "Lost a completed affirmation")
+            else:
+                self.log_result("Concurrent Mark Complete", True, f"{parallel_requests} parallel increments applied")
+        except Exception as e:
+            self.log_result("Concurrent Mark Complete", False, f"Exception: {str(e)}")
+    
+    def test_practice_log(self):
+        """Test that taps show up in today's progress at once, and in history once compacted"""
+        headers = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        today = date.today().isoformat()
+        try:
+            log = self.session.get(f"{API_BASE}/diagnostics/practice-log").json()
+            ids = [self.session.post(f"{API_BASE}/affirmations", json={"text": f"Logged {i}"}, headers=headers).json()['id']
+                   for i in range(2)]
+            for affirmation_id in [ids[0], ids[0], ids[1]]:
+                marked = self.session.post(f"{API_BASE}/progress/mark-complete", headers=headers,
+                                           json={"date": today, "affirmation_id": affirmation_id}).json()
+            progress = self.session.get(f"{API_BASE}/progress/today", headers=headers).json()
+            if marked['practice_count'] != 3 or progress['practice_count'] != 3 or progress['completion_percentage'] != 100:
+                self.log_result("Practice Log Read", False, f"Response {marked}, today {progress}")
+                return
+            self.log_result("Practice Log Read", True, f"Event log {'on' if log['enabled'] else 'off'}")
+            if not log['enabled']:
+                return
+            
+            # The compactor folds events older than the sync grace window
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                history = self.session.get(f"{API_BASE}/progress/history", params={"days": 1}, headers=headers).json()
+                if history and history[0]['practice_count'] == 3:
+                    break
+                time.sleep(0.5)
+            settings = self.session.get(f"{API_BASE}/settings", headers=headers).json()
+            if not history or history[0]['practice_count'] != 3:
+                self.log_result("Practice Log Compaction", False, f"History: {history}")
+            elif settings['last_practice_date'] != today:
+                self.log_result("Practice Log Compaction", False, f"Streak not advanced: {settings['current_streak']}")
+            else:
+                self.log_result("Practice Log Compaction", True, "Events folded into the day and the streak")
+        except Exception as e:
+            self.log_result("Practice Log", False, f"Exception: {str(e)}")
+    
     def test_settings_endpoints(self):
         """Test settings management endpoints"""
         
@@ -286,6 +667,261 @@ class BackendTester:
         except Exception as e:
             self.log_result("PUT Settings", False, f"Exception: {str(e)}")
     
+    def test_reminders(self):
+        """Test that saving notification times indexes one server-side reminder per enabled time"""
+        user = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        try:
+            before = self.session.get(f"{API_BASE}/diagnostics/reminders").json()['indexed']
+            times = [
+                {"id": "morning", "time": "07:15", "label": "Morning", "enabled": True},
+                {"id": "noon", "time": "12:00", "label": "Noon", "enabled": False},
+                {"id": "night", "time": "21:45", "label": "Night", "enabled": True},
+            ]
+            # A new user's default settings are indexed when first created, before any save
+            self.session.get(f"{API_BASE}/settings", headers=user)
+            defaults = self.session.get(f"{API_BASE}/diagnostics/reminders").json()['indexed']
+            self.log_result("Default Reminders", defaults - before == 2,
+                            f"{defaults - before} reminders indexed for the default morning and night times")
+            
+            response = self.session.put(f"{API_BASE}/settings", headers=user,
+                                        json={"notification_times": times, "timezone": "Europe/Berlin"})
+            after = self.session.get(f"{API_BASE}/diagnostics/reminders").json()['indexed']
+            if response.status_code != 200 or response.json()['timezone'] != "Europe/Berlin":
+                self.log_result("Reminder Index", False, f"Status: {response.status_code}")
+            elif after - before != 2:
+                self.log_result("Reminder Index", False, f"Expected 2 new reminders, got {after - before}")
+            else:
+                self.log_result("Reminder Index", True, "Two enabled times indexed in Europe/Berlin")
+            
+            self.session.put(f"{API_BASE}/settings", headers=user, json={"notifications_enabled": False})
+            disabled = self.session.get(f"{API_BASE}/diagnostics/reminders").json()['indexed']
+            invalid = self.session.put(f"{API_BASE}/settings", headers=user, json={"timezone": "Mars/Olympus"})
+            if disabled != before:
+                self.log_result("Reminder Index Cleared", False, f"{disabled - before} reminders left after disabling")
+            elif invalid.status_code != 400:
+                self.log_result("Reminder Index Cleared", False, f"Unknown timezone status: {invalid.status_code}")
+            else:
+                self.log_result("Reminder Index Cleared", True, "Disabling notifications removed the reminders")
+        except Exception as e:
+            self.log_result("Reminder Index", False, f"Exception: {str(e)}")
+    
+    def test_conditional_get(self):
+        """Test ETags: a matching If-None-Match gets a 304 without any database commands"""
+        for path in ("/affirmations", "/settings", "/progress/today"):
+            test_name = f"Conditional GET {path}"
+            try:
+                first = self.session.get(f"{API_BASE}{path}")
+                etag = first.headers.get("ETag")
+                if first.status_code != 200 or not etag:
+                    self.log_result(test_name, False, f"Status: {first.status_code}, ETag: {etag}")
+                    continue
+                
+                # Count commands around a cached and an uncached request
+                commands_before = self.session.get(f"{API_BASE}/diagnostics/db").json()['total']
+                cached = self.session.get(f"{API_BASE}{path}", headers={"If-None-Match": etag})
+                commands_cached = self.session.get(f"{API_BASE}/diagnostics/db").json()['total']
+                uncached = self.session.get(f"{API_BASE}{path}")
+                commands_uncached = self.session.get(f"{API_BASE}/diagnostics/db").json()['total']
+                
+                if cached.status_code != 304:
+                    self.log_result(test_name, False, f"Expected 304, got {cached.status_code}")
+                elif commands_cached != commands_before:
+                    self.log_result(test_name, False, f"304 issued {commands_cached - commands_before} DB commands")
+                elif uncached.status_code != 200:
+                    self.log_result(test_name, False, f"Uncached status: {uncached.status_code}")
+                else:
+                    self.log_result(test_name, True,
+                                    f"304 with 0 DB commands vs {commands_uncached - commands_cached} uncached")
+            except Exception as e:
+                self.log_result(test_name, False, f"Exception: {str(e)}")
+        
+        # A write must retire the old tag
+        try:
+            etag = self.session.get(f"{API_BASE}/settings").headers.get("ETag")
+            settings = self.session.get(f"{API_BASE}/settings").json()
+            self.session.put(f"{API_BASE}/settings", json={"morning_time": settings['morning_time']})
+            response = self.session.get(f"{API_BASE}/settings", headers={"If-None-Match": etag})
+            if response.status_code == 200 and response.headers.get("ETag") != etag:
+                self.log_result("ETag Changes On Write", True, "PUT /settings retired the old ETag")
+            else:
+                self.log_result("ETag Changes On Write", False, f"Status: {response.status_code}")
+        except Exception as e:
+            self.log_result("ETag Changes On Write", False, f"Exception: {str(e)}")
+    
+    def test_bootstrap(self):
+        """Test the bootstrap payload and that known section versions skip unchanged data"""
+        try:
+            response = self.session.get(f"{API_BASE}/bootstrap")
+            if response.status_code != 200:
+                self.log_result("Bootstrap", False, f"Status: {response.status_code}")
+                return
+            body = response.json()
+            sections = ("affirmations", "today", "settings", "history")
+            if any('data' not in body[section] for section in sections):
+                self.log_result("Bootstrap", False, "A section is missing its data")
+                return
+            separate = self.session.get(f"{API_BASE}/affirmations").json()
+            if [a['id'] for a in body['affirmations']['data']] != [a['id'] for a in separate]:
+                self.log_result("Bootstrap", False, "Affirmations differ from GET /affirmations")
+            else:
+                self.log_result("Bootstrap", True, f"{len(separate)} affirmations and {len(body['history']['data'])} days")
+            
+            known = ",".join(f"{section}:{body[section]['version']}" for section in sections)
+            self.session.put(f"{API_BASE}/settings", json={"morning_time": body['settings']['data']['morning_time']})
+            repeat = self.session.get(f"{API_BASE}/bootstrap", params={"known": known}).json()
+            changed = [section for section in sections if 'data' in repeat[section]]
+            if changed != ["settings"]:
+                self.log_result("Bootstrap Known Versions", False, f"Sent data for {changed} after a settings write")
+            else:
+                self.log_result("Bootstrap Known Versions", True, "Only the changed section was sent again")
+        except Exception as e:
+            self.log_result("Bootstrap", False, f"Exception: {str(e)}")
+    
+    def test_worker_pools(self):
+        """Test that every worker process sizes its MongoDB pool the same way"""
+        try:
+            reports = []
+            for _ in range(30):
+                # A new connection per request, so the load balancer can pick another worker
+                response = requests.get(f"{API_BASE}/diagnostics/db", headers={"Connection": "close"})
+                if response.status_code != 200:
+                    self.log_result("Worker Pools", False, f"Status: {response.status_code}")
+                    return
+                reports.append(response.json())
+            
+            pids = {report['pid'] for report in reports}
+            workers = reports[0]['workers']
+            options = [report['client_options'] for report in reports]
+            if any(option != options[0] for option in options):
+                self.log_result("Worker Pools", False, f"Workers disagree on client options: {options}")
+            elif len(pids) > workers:
+                self.log_result("Worker Pools", False, f"{len(pids)} processes answered but WEB_CONCURRENCY={workers}")
+            else:
+                pool = options[0].get('maxPoolSize', 'driver default')
+                self.log_result("Worker Pools", True,
+                                f"{len(pids)}/{workers} workers answered, maxPoolSize {pool} each")
+        except Exception as e:
+            self.log_result("Worker Pools", False, f"Exception: {str(e)}")
+    
+    def test_query_plans(self):
+        """Test that no query the API issues scans a whole collection, whichever storage backend runs"""
+        try:
+            backend = self.session.get(f"{API_BASE}/diagnostics/db").json().get('backend')
+            response = self.session.get(f"{API_BASE}/diagnostics/query-plans")
+            if response.status_code != 200:
+                self.log_result("Query Plans", False, f"Status: {response.status_code}")
+                return
+            plans = response.json()
+            if plans['collscans']:
+                self.log_result("Query Plans", False, f"{backend}: full scans in {', '.join(plans['collscans'])}")
+            else:
+                self.log_result("Query Plans", True, f"{backend}: {len(plans['queries'])} queries all use indexes")
+        except Exception as e:
+            self.log_result("Query Plans", False, f"Exception: {str(e)}")
+    
+    def test_backup(self):
+        """Test that an export imported into another user reproduces its affirmations and progress"""
+        source = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        target = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        try:
+            first = self.session.post(f"{API_BASE}/affirmations", json={"text": "Backed up 1"}, headers=source).json()
+            self.session.post(f"{API_BASE}/affirmations", json={"text": "Backed up 2"}, headers=source)
+            self.session.post(f"{API_BASE}/progress/mark-complete", headers=source,
+                              json={"date": date.today().isoformat(), "affirmation_id": first['id']})
+            
+            export = self.session.get(f"{API_BASE}/export", params={"gzip": "true"}, headers=source)
+            if export.status_code != 200 or export.headers.get('content-type') != "application/gzip":
+                self.log_result("Export", False, f"Status: {export.status_code}")
+                return
+            records = [json.loads(line) for line in gzip.decompress(export.content).splitlines()]
+            types = [record['type'] for record in records]
+            self.log_result("Export", types == ["header", "settings", "affirmation", "affirmation", "progress"],
+                            f"Records: {types}")
+            
+            imported = self.session.post(f"{API_BASE}/import", data=export.content,
+                                         headers={**target, "Content-Type": "application/gzip"})
+            # Created right after the import, so it must sort after the whole imported block
+            self.session.post(f"{API_BASE}/affirmations", json={"text": "Created after import"}, headers=target)
+            texts = [a['text'] for a in self.session.get(f"{API_BASE}/affirmations", headers=target).json()]
+            today = self.session.get(f"{API_BASE}/progress/today", headers=target).json()
+            ids = [a['id'] for a in self.session.get(f"{API_BASE}/affirmations", headers=target).json()]
+            if imported.status_code != 200:
+                self.log_result("Import", False, f"Status: {imported.status_code} {imported.text[:200]}")
+            elif texts != ["Backed up 1", "Backed up 2", "Created after import"] or today['completed_affirmations'] != ids[:1]:
+                self.log_result("Import", False, f"Imported {texts}, completed {today['completed_affirmations']}")
+            else:
+                self.log_result("Import", True, f"Imported {imported.json()}")
+            
+            invalid = self.session.post(f"{API_BASE}/import", data=b'{"type": "header", "format": "other"}\n',
+                                        headers=target)
+            self.log_result("Import Validation", invalid.status_code == 400, f"Status: {invalid.status_code}")
+        except Exception as e:
+            self.log_result("Backup", False, f"Exception: {str(e)}")
+    
+    def test_idempotency(self):
+        """Test that writes retried with the same Idempotency-Key run once and replay the first response"""
+        headers = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        try:
+            key = {**headers, "Idempotency-Key": uuid.uuid4().hex}
+            with ThreadPoolExecutor(max_workers=5) as pool:
+                responses = list(pool.map(
+                    lambda _: requests.post(f"{API_BASE}/affirmations", json={"text": "Only once"}, headers=key),
+                    range(5)
+                ))
+            ids = {r.json()['id'] for r in responses if r.status_code == 200}
+            listed = self.session.get(f"{API_BASE}/affirmations", headers=headers).json()
+            replays = sum(r.headers.get('Idempotent-Replayed') == "true" for r in responses)
+            if len(ids) != 1 or len(listed) != 1:
+                self.log_result("Idempotent Create", False, f"{len(ids)} distinct responses, {len(listed)} affirmations")
+            else:
+                self.log_result("Idempotent Create", True, f"One affirmation, {replays} replayed responses")
+            
+            payload = {"date": date.today().isoformat(), "affirmation_id": listed[0]['id']}
+            key = {**headers, "Idempotency-Key": uuid.uuid4().hex}
+            for _ in range(3):
+                self.session.post(f"{API_BASE}/progress/mark-complete", json=payload, headers=key)
+            count = self.session.get(f"{API_BASE}/progress/today", headers=headers).json()['practice_count']
+            self.log_result("Idempotent Mark Complete", count == 1, f"Practice count after 3 retries: {count}")
+            
+            reused = self.session.post(f"{API_BASE}/affirmations", json={"text": "Different"},
+                                       headers={**headers, "Idempotency-Key": key["Idempotency-Key"]})
+            mismatch = self.session.post(f"{API_BASE}/progress/mark-complete", json={**payload, "date": "2000-01-01"},
+                                         headers=key)
+            self.log_result("Idempotency Key Scope", reused.status_code == 200 and mismatch.status_code == 422,
+                            f"Other route: {reused.status_code}, different body: {mismatch.status_code}")
+        except Exception as e:
+            self.log_result("Idempotency", False, f"Exception: {str(e)}")
+    
+    def test_sync(self):
+        """Test delta sync: a full sync, then only what changed after its token"""
+        try:
+            full = self.session.get(f"{API_BASE}/sync")
+            if full.status_code != 200 or not full.json()['full'] or full.json()['settings'] is None:
+                self.log_result("Full Sync", False, f"Status: {full.status_code}")
+                return
+            token = full.json()['token']
+            self.log_result("Full Sync", True, f"{len(full.json()['affirmations'])} affirmations, token {token}")
+            
+            created = self.session.post(f"{API_BASE}/affirmations", json={"text": "Synced affirmation"}).json()
+            delta = self.session.get(f"{API_BASE}/sync", params={"since": token}).json()
+            if created['id'] not in [a['id'] for a in delta['affirmations']]:
+                self.log_result("Delta Sync", False, "Created affirmation missing from delta")
+                return
+            
+            self.session.delete(f"{API_BASE}/affirmations/{created['id']}")
+            delta = self.session.get(f"{API_BASE}/sync", params={"since": delta['token']}).json()
+            if created['id'] not in delta['deleted_affirmations']:
+                self.log_result("Delta Sync", False, "Deleted affirmation has no tombstone")
+            elif delta['full']:
+                self.log_result("Delta Sync", False, "Delta sync reported a full sync")
+            else:
+                self.log_result("Delta Sync", True, "Create and delete both reported after the token")
+            
+            invalid = self.session.get(f"{API_BASE}/sync", params={"since": "abc"})
+            self.log_result("Invalid Sync Token", invalid.status_code == 400, f"Status: {invalid.status_code}")
+        except Exception as e:
+            self.log_result("Delta Sync", False, f"Exception: {str(e)}")
+    
     def test_streak_calculation(self):
         """Test streak calculation by checking settings after completing all affirmations"""
         try:
@@ -304,6 +940,61 @@ class BackendTester:
         except Exception as e:
             self.log_result("Streak Calculation", False, f"Exception: {str(e)}")
     
+    def test_streak_recompute(self):
+        """Test incremental streaks over consecutive and missed days, and a recompute after out-of-order history"""
+        user = {"X-User-Id": f"test-{uuid.uuid4().hex}"}
+        today = date.today()
+        day = lambda offset: (today - timedelta(days=offset)).isoformat()
+        try:
+            ids = [self.session.post(f"{API_BASE}/affirmations", json={"text": f"Streak {i}"}, headers=user).json()['id']
+                   for i in range(2)]
+            
+            def complete(offset):
+                for affirmation_id in ids:
+                    response = self.session.post(f"{API_BASE}/progress/mark-complete", headers=user,
+                                                 json={"date": day(offset), "affirmation_id": affirmation_id})
+                    response.raise_for_status()
+            
+            def streak():
+                settings = self.session.get(f"{API_BASE}/settings", headers=user).json()
+                return settings['current_streak'], settings['longest_streak'], settings['last_practice_date']
+            
+            # Three consecutive days, a missed day, then two more
+            checks = []
+            for offset in (6, 5, 4):
+                complete(offset)
+            checks.append(("consecutive", streak(), (3, 3, day(4))))
+            complete(2)
+            checks.append(("after a gap", streak(), (1, 3, day(2))))
+            complete(1)
+            checks.append(("resumed", streak(), (2, 3, day(1))))
+            # Half of today isn't a completed day
+            self.session.post(f"{API_BASE}/progress/mark-complete", headers=user,
+                              json={"date": day(0), "affirmation_id": ids[0]}).raise_for_status()
+            checks.append(("partial day", streak(), (2, 3, day(1))))
+            wrong = [f"{name}: {got} != {expected}" for name, got, expected in checks if got != expected]
+            self.log_result("Incremental Streak", not wrong,
+                            "; ".join(wrong) or "3 consecutive days, reset after a gap, partial day ignored")
+            
+            # Filling the missed day is written out of order, so only a recompute joins the two runs
+            complete(3)
+            stale = streak()
+            response = self.session.post(f"{API_BASE}/progress/streak/recompute", headers=user)
+            expected = {"current_streak": 6, "longest_streak": 6, "last_practice_date": day(1)}
+            if stale != (2, 3, day(1)):
+                self.log_result("Streak Recompute", False, f"Out-of-order day changed the streak to {stale}")
+            elif response.status_code != 200 or response.json() != expected:
+                self.log_result("Streak Recompute", False, f"Status: {response.status_code} {response.text[:200]}")
+            elif streak() != (6, 6, day(1)):
+                self.log_result("Streak Recompute", False, f"Settings still show {streak()}")
+            else:
+                self.log_result("Streak Recompute", True, "Six days rebuilt into one streak of 6")
+        except Exception as e:
+            self.log_result("Streak Recompute", False, f"Exception: {str(e)}")
+        finally:
+            for affirmation in self.session.get(f"{API_BASE}/affirmations", headers=user).json():
+                self.session.delete(f"{API_BASE}/affirmations/{affirmation['id']}", headers=user)
+    
     def run_all_tests(self):
         """Run all backend tests in sequence"""
         print("🚀 Starting Backend API Tests...")
@@ -316,18 +1007,36 @@ class BackendTester:
         print("\n📝 Testing Affirmation Endpoints...")
         self.test_affirmations_crud()
         self.test_seed_affirmations()
+        self.test_pagination()
+        self.test_user_isolation()
+        self.test_ordering()
+        self.test_images()
+        self.test_image_variants()
         
         # Test progress endpoints
         print("\n📊 Testing Progress Endpoints...")
         self.test_progress_endpoints()
+        self.test_concurrent_mark_complete()
+        self.test_batch_mark_complete()
+        self.test_progress_summary()
+        self.test_practice_log()
         
         # Test settings endpoints
         print("\n⚙️  Testing Settings Endpoints...")
         self.test_settings_endpoints()
+        self.test_reminders()
         
         # Test streak calculation
         print("\n🔥 Testing Streak Logic...")
         self.test_streak_calculation()
+        self.test_streak_recompute()
+        self.test_conditional_get()
+        self.test_idempotency()
+        self.test_sync()
+        self.test_backup()
+        self.test_bootstrap()
+        self.test_worker_pools()
+        self.test_query_plans()
         
         # Print summary
         print("\n" + "=" * 50)
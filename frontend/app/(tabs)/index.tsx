@@ -16,7 +16,7 @@ import { useState, useEffect, useRef } from 'react';
 import { Ionicons } from '@expo/vector-icons';
 import { StatusBar } from 'expo-status-bar';
 import * as ImagePicker from 'expo-image-picker';
-import { useAffirmationStore } from '../../store/affirmationStore';
+import { useAffirmationStore, resolveImageUri } from '../../store/affirmationStore';
 
 // Separate component for affirmation items to avoid hooks in render functions
 interface AffirmationItemProps {
@@ -43,7 +43,7 @@ function AffirmationItem({ item, index, onEdit, onDelete }: AffirmationItemProps
       <View style={styles.affirmationCard}>
         {item.image && (
           <Image
-            source={{ uri: item.image }}
+            source={{ uri: resolveImageUri(item.image) }}
             style={styles.thumbnailImage}
             resizeMode="cover"
           />
@@ -72,7 +72,7 @@ function AffirmationItem({ item, index, onEdit, onDelete }: AffirmationItemProps
 }
 
 export default function HomeScreen() {
-  const { affirmations, fetchAffirmations, addAffirmation, updateAffirmation, deleteAffirmation } = useAffirmationStore();
+  const { affirmations, bootstrap, addAffirmation, updateAffirmation, deleteAffirmation } = useAffirmationStore();
   const [modalVisible, setModalVisible] = useState(false);
   const [editingAffirmation, setEditingAffirmation] = useState<any>(null);
   const [affirmationText, setAffirmationText] = useState('');
@@ -93,7 +93,7 @@ export default function HomeScreen() {
 
   const loadAffirmations = async () => {
     setLoading(true);
-    await fetchAffirmations();
+    await bootstrap();
     setLoading(false);
   };
 
@@ -258,7 +258,7 @@ export default function HomeScreen() {
               {selectedImage ? (
                 <View style={styles.imagePreviewContainer}>
                   <Image
-                    source={{ uri: selectedImage }}
+                    source={{ uri: resolveImageUri(selectedImage) }}
                     style={styles.imagePreview}
                     resizeMode="cover"
                   />
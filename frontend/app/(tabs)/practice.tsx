@@ -12,13 +12,12 @@ import { useState, useEffect, useRef } from 'react';
 import { Ionicons } from '@expo/vector-icons';
 import { StatusBar } from 'expo-status-bar';
 import { LinearGradient } from 'expo-linear-gradient';
-import { useAffirmationStore } from '../../store/affirmationStore';
+import { useAffirmationStore, resolveImageUri } from '../../store/affirmationStore';
 
 const { width } = Dimensions.get('window');
 
 export default function PracticeScreen() {
-  const { affirmations, dailyProgress, fetchAffirmations, fetchTodayProgress, markAffirmationComplete } =
-    useAffirmationStore();
+  const { affirmations, dailyProgress, bootstrap, markAffirmationComplete } = useAffirmationStore();
   const [currentIndex, setCurrentIndex] = useState(0);
   const [loading, setLoading] = useState(true);
   const fadeAnim = useRef(new Animated.Value(1)).current;
@@ -29,7 +28,7 @@ export default function PracticeScreen() {
   }, []);
 
   const loadData = async () => {
-    await Promise.all([fetchAffirmations(), fetchTodayProgress()]);
+    await bootstrap();
     setLoading(false);
   };
 
@@ -153,7 +152,7 @@ export default function PracticeScreen() {
             {/* Visualization Image */}
             {currentAffirmation?.image && (
               <Image 
-                source={{ uri: currentAffirmation.image }} 
+                source={{ uri: resolveImageUri(currentAffirmation.images?.screen ?? currentAffirmation.image) }} 
                 style={styles.visualizationImage}
                 resizeMode="cover"
               />
@@ -14,7 +14,7 @@ import { useAffirmationStore } from '../../store/affirmationStore';
 const { width } = Dimensions.get('window');
 
 export default function ProgressScreen() {
-  const { settings, dailyProgress, fetchSettings, fetchTodayProgress } = useAffirmationStore();
+  const { settings, dailyProgress, bootstrap } = useAffirmationStore();
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
@@ -22,7 +22,7 @@ export default function ProgressScreen() {
   }, []);
 
   const loadData = async () => {
-    await Promise.all([fetchSettings(), fetchTodayProgress()]);
+    await bootstrap();
     setLoading(false);
   };
 
@@ -27,7 +27,7 @@ interface NotificationTime {
 }
 
 export default function SettingsScreen() {
-  const { settings, fetchSettings, updateSettings } = useAffirmationStore();
+  const { settings, bootstrap, updateSettings } = useAffirmationStore();
   const [loading, setLoading] = useState(true);
   const [notificationsEnabled, setNotificationsEnabled] = useState(false);
   const [notificationTimes, setNotificationTimes] = useState<NotificationTime[]>([]);
@@ -60,7 +60,7 @@ export default function SettingsScreen() {
   }, [settings]);
 
   const loadSettings = async () => {
-    await fetchSettings();
+    await bootstrap();
     setLoading(false);
   };
 
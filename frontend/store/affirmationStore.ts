@@ -15,6 +15,43 @@ async function parseJsonResponse<T>(response: Response): Promise<T> {
   }
 }
 
+// ETags of the last successful reads; a 304 means the store is already up to date
+const etags = new Map<string, string>();
+
+// GET that revalidates with If-None-Match; resolves to null when nothing changed
+async function fetchIfChanged<T>(path: string): Promise<T | null> {
+  const etag = etags.get(path);
+  const response = await fetch(`${BACKEND_URL}${path}`, {
+    headers: etag ? { 'If-None-Match': etag } : undefined,
+  });
+  if (response.status === 304) {
+    return null;
+  }
+  const data = await parseJsonResponse<T>(response);
+  const newEtag = response.headers.get('ETag');
+  if (newEtag) {
+    etags.set(path, newEtag);
+  } else {
+    etags.delete(path);
+  }
+  return data;
+}
+
+// Versions of the bootstrap sections held in the store; sections still at
+// these versions come back from /api/bootstrap without their data
+const sectionVersions = new Map<string, string>();
+
+interface BootstrapSection<T> {
+  version: string;
+  data?: T;
+}
+
+// Images are served by the backend as relative `/api/images/...` URLs;
+// older affirmations may still carry an inline data URL.
+export function resolveImageUri(image: string): string {
+  return image.startsWith('/') ? `${BACKEND_URL}${image}` : image;
+}
+
 interface Affirmation {
   id: string;
   text: string;
@@ -22,6 +59,7 @@ interface Affirmation {
   is_example: boolean;
   created_at: string;
   image?: string | null;
+  images?: { thumb: string; screen: string; original: string } | null;
 }
 
 interface DailyProgress {
@@ -47,14 +85,26 @@ interface Settings {
   current_streak: number;
   longest_streak: number;
   last_practice_date: string | null;
+  timezone: string;
+}
+
+interface Bootstrap {
+  affirmations: BootstrapSection<Affirmation[]>;
+  today: BootstrapSection<DailyProgress>;
+  settings: BootstrapSection<Settings>;
+  history: BootstrapSection<DailyProgress[]>;
 }
 
 interface AffirmationStore {
   affirmations: Affirmation[];
   dailyProgress: DailyProgress | null;
   settings: Settings | null;
+  history: DailyProgress[];
   loading: boolean;
 
+  // Loads affirmations, today's progress, settings and history in one request
+  bootstrap: () => Promise<void>;
+
   // Affirmation actions
   fetchAffirmations: () => Promise<void>;
   addAffirmation: (text: string) => Promise<void>;
@@ -74,13 +124,35 @@ export const useAffirmationStore = create<AffirmationStore>((set, get) => ({
   affirmations: [],
   dailyProgress: null,
   settings: null,
+  history: [],
   loading: false,
 
+  bootstrap: async () => {
+    try {
+      const known = Array.from(sectionVersions, ([section, version]) => `${section}:${version}`).join(',');
+      const query = known ? `?known=${encodeURIComponent(known)}` : '';
+      const response = await fetch(`${BACKEND_URL}/api/bootstrap${query}`);
+      const data = await parseJsonResponse<Bootstrap>(response);
+      const changes: Partial<AffirmationStore> = {};
+      if (data.affirmations.data) changes.affirmations = data.affirmations.data;
+      if (data.today.data) changes.dailyProgress = data.today.data;
+      if (data.settings.data) changes.settings = data.settings.data;
+      if (data.history.data) changes.history = data.history.data;
+      set(changes);
+      for (const [section, { version }] of Object.entries(data)) {
+        sectionVersions.set(section, version);
+      }
+    } catch (error) {
+      console.error('Failed to bootstrap:', error);
+    }
+  },
+
   fetchAffirmations: async () => {
     try {
-      const response = await fetch(`${BACKEND_URL}/api/affirmations`);
-      const data = await parseJsonResponse<Affirmation[]>(response);
-      set({ affirmations: data });
+      const data = await fetchIfChanged<Affirmation[]>('/api/affirmations');
+      if (data) {
+        set({ affirmations: data });
+      }
     } catch (error) {
       console.error('Failed to fetch affirmations:', error);
     }
@@ -138,9 +210,10 @@ export const useAffirmationStore = create<AffirmationStore>((set, get) => ({
 
   fetchTodayProgress: async () => {
     try {
-      const response = await fetch(`${BACKEND_URL}/api/progress/today`);
-      const data = await parseJsonResponse<DailyProgress>(response);
-      set({ dailyProgress: data });
+      const data = await fetchIfChanged<DailyProgress>('/api/progress/today');
+      if (data) {
+        set({ dailyProgress: data });
+      }
     } catch (error) {
       console.error('Failed to fetch progress:', error);
     }
@@ -167,9 +240,10 @@ export const useAffirmationStore = create<AffirmationStore>((set, get) => ({
 
   fetchSettings: async () => {
     try {
-      const response = await fetch(`${BACKEND_URL}/api/settings`);
-      const data = await parseJsonResponse<Settings>(response);
-      set({ settings: data });
+      const data = await fetchIfChanged<Settings>('/api/settings');
+      if (data) {
+        set({ settings: data });
+      }
     } catch (error) {
       console.error('Failed to fetch settings:', error);
     }
@@ -177,10 +251,12 @@ export const useAffirmationStore = create<AffirmationStore>((set, get) => ({
 
   updateSettings: async (data: Partial<Settings>) => {
     try {
+      // The server schedules reminders in the device's timezone
+      const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone;
       const response = await fetch(`${BACKEND_URL}/api/settings`, {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(data),
+        body: JSON.stringify({ ...data, timezone }),
       });
       const updatedSettings = await parseJsonResponse<Settings>(response);
       set({ settings: updatedSettings });